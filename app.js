@@ -450,9 +450,29 @@ class VocabularyApp {
         if (this.vocabulariesCache[vocabName] && this.vocabulariesCache[vocabName].words) {
             return;
         }
+        // Словарь из localStorage: та же версия - используем как есть, иначе догружаем только изменения
+        const serverVersion = this.state.availableVocabularies.find(v => v.name === vocabName)?.version;
+        const stored = this.loadStoredVocabulary(vocabName);
+        if (stored && serverVersion) {
+            if (stored.version === serverVersion) {
+                this.vocabulariesCache[vocabName] = stored;
+                return;
+            }
+            try {
+                const synced = await this.syncVocabularyDelta(vocabName, stored);
+                if (synced) {
+                    this.vocabulariesCache[vocabName] = synced;
+                    this.storeVocabulary(vocabName, synced);
+                    return;
+                }
+            } catch (error) {
+                console.warn(`Не удалось получить изменения словаря "${vocabName}", загружаю целиком:`, error);
+            }
+        }
         this.elements.studyArea.innerHTML = `<div class="no-words"><p>Загружаю словарь: ${vocabName}...</p></div>`;
         const response = await fetch(`${TTS_API_BASE_URL}/api/vocabulary/${vocabName}`);
         if (!response.ok) throw new Error(`Ошибка сервера ${response.status}`);
+        const version = response.headers.get('X-Vocabulary-Version');
         const data = await response.json();
         if (!data.words || !data.meta || !data.meta.themes) {
             if (Array.isArray(data)) {
@@ -467,8 +487,39 @@ class VocabularyApp {
         }
         this.vocabulariesCache[vocabName] = {
             words: data.words.map((w, i) => ({ ...w, id: w.id || `${vocabName}_word_${Date.now()}_${i}` })),
-            meta: data.meta
+            meta: data.meta,
+            version
         };
+        if (version) this.storeVocabulary(vocabName, this.vocabulariesCache[vocabName]);
+    }
+    async syncVocabularyDelta(vocabName, stored) {
+        const response = await fetch(`${TTS_API_BASE_URL}/api/vocabulary/${vocabName}/delta?since=${stored.version}`);
+        if (!response.ok) return null; // 410: сервер не знает нашу версию - нужен полный словарь
+        const delta = await response.json();
+        const removed = new Set(delta.removed);
+        const changed = new Map(delta.changed.map(w => [w.id, w]));
+        let words = stored.words.filter(w => !removed.has(w.id)).map(w => changed.get(w.id) || w);
+        delta.added.forEach(({ position, word }) => words.splice(position, 0, word));
+        if (delta.order) {
+            const byId = new Map(words.map(w => [w.id, w]));
+            words = delta.order.map(id => byId.get(id)).filter(Boolean);
+        }
+        return { words, meta: delta.meta || stored.meta, version: delta.version };
+    }
+    loadStoredVocabulary(vocabName) {
+        try {
+            const item = localStorage.getItem(`vocabulary:${vocabName}`);
+            return item ? JSON.parse(item) : null;
+        } catch {
+            return null;
+        }
+    }
+    storeVocabulary(vocabName, data) {
+        try {
+            localStorage.setItem(`vocabulary:${vocabName}`, JSON.stringify(data));
+        } catch (error) {
+            console.warn(`Не удалось сохранить словарь "${vocabName}" в localStorage:`, error);
+        }
     }
     handleLoadingError(errorMessage) {
         this.allWords = [];
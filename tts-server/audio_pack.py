@@ -0,0 +1,305 @@
+# Файл: audio_pack.py
+# Упакованное хранилище аудио: один append-only файл со всеми MP3 и отсортированный индекс для mmap.
+# Используется локальным кэшем сервера при LOCAL_CACHE_BACKEND=pack; как скрипт - сборка pack'а из
+# каталога кэша, перестроение индекса, compaction, статистика и распаковка обратно в каталог.
+#
+# Формат pack'а: заголовок b"TTSPACK1" + id pack'а (16 байт), затем записи
+#   b"TPK1" | md5 (16 байт) | длина (uint32 LE) | данные MP3
+# Формат индекса (<pack>.idx): b"TTSPIDX1" | id pack'а | число записей (uint64) | смещение в pack'е,
+# до которого индекс полон (uint64), затем записи, отсортированные по md5:
+#   md5 (16 байт) | смещение данных (uint64) | длина (uint32)
+#
+# Использование:
+#   python audio_pack.py build --from /tmp/audio_cache --pack /data/audio.pack
+#   python audio_pack.py compact --pack /data/audio.pack
+#   python audio_pack.py index --pack /data/audio.pack
+#   python audio_pack.py stats --pack /data/audio.pack
+#   python audio_pack.py unpack --pack /data/audio.pack --to /tmp/audio_cache
+
+import argparse
+import fcntl
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import uuid
+
+PACK_MAGIC = b"TTSPACK1"; PACK_HEADER = struct.Struct('<8s16s')
+RECORD_MAGIC = b"TPK1"; RECORD_HEADER = struct.Struct('<4s16sI')
+INDEX_MAGIC = b"TTSPIDX1"; INDEX_HEADER = struct.Struct('<8s16sQQ')
+INDEX_ENTRY = struct.Struct('<16sQI')
+LOCK_RETRY_INTERVAL = 0.05  # сек между попытками взять flock
+
+
+def filename_to_key(filename):
+    """'<md5>.mp3' -> 16 байт md5; None для имён другого вида."""
+    if len(filename) != 36 or not filename.endswith('.mp3'): return None
+    try: return bytes.fromhex(filename[:32])
+    except ValueError: return None
+
+def key_to_filename(key): return f"{key.hex()}.mp3"
+
+
+def create_pack(path):
+    """Создаёт пустой pack атомарно (tmp + link): параллельное создание из другого процесса не испортит заголовок."""
+    tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, 'wb') as f: f.write(PACK_HEADER.pack(PACK_MAGIC, uuid.uuid4().bytes))
+    try: os.link(tmp_path, path)
+    except FileExistsError: pass
+    finally: os.remove(tmp_path)
+
+def lock_exclusive(fd):
+    """
+    flock(LOCK_EX) только неблокирующими попытками: gevent не патчит flock, и ждущий worker иначе
+    замер бы целиком (например, на всё время compaction). time.sleep между попытками под gevent
+    уступает управление другим запросам.
+    """
+    while True:
+        try: fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB); return
+        except BlockingIOError: time.sleep(LOCK_RETRY_INTERVAL)
+
+def scan_records(fd, start, end):
+    """Список (md5, смещение данных, длина) целых записей в [start, end); на повреждённой записи скан обрывается."""
+    if end <= start: return []
+    records = []
+    with mmap.mmap(fd, end, prot=mmap.PROT_READ) as mm:
+        offset = start
+        while offset + RECORD_HEADER.size <= end:
+            magic, key, length = RECORD_HEADER.unpack_from(mm, offset)
+            data_offset = offset + RECORD_HEADER.size
+            if magic != RECORD_MAGIC or data_offset + length > end: break
+            records.append((key, data_offset, length)); offset = data_offset + length
+    return records
+
+def write_index(index_path, pack_id, entries, covered_end):
+    """Атомарно пишет индекс: entries - {md5: (смещение, длина)}."""
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, pack_id, len(entries), covered_end))
+        f.write(b''.join(INDEX_ENTRY.pack(key, offset, length) for key, (offset, length) in sorted(entries.items())))
+    os.replace(tmp_path, index_path)
+
+
+class AudioPack:
+    """
+    Открытый pack и его индекс. Поиск: сначала overlay процесса (записи, дописанные после построения
+    индекса), затем бинарный поиск по mmap индекса - страницы индекса общие для всех процессов.
+    Запись дописывается одним write под flock (см. lock_exclusive). Объект привязан к процессу: после
+    fork дескриптор открывается заново, иначе flock разных worker'ов (общее описание файла) не исключал
+    бы друг друга.
+    """
+    def __init__(self, path):
+        self.path = path; self.index_path = f"{path}.idx"; self._lock = threading.Lock(); self._pid = None
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True); create_pack(path)
+        self.reload()
+
+    def reload(self):
+        """(Пере)открывает pack и индекс, например после compaction или fork."""
+        with self._lock: self._reload_locked()
+    def _reload_locked(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_APPEND)
+        magic, pack_id = PACK_HEADER.unpack(os.pread(fd, PACK_HEADER.size, 0))
+        if magic != PACK_MAGIC: os.close(fd); raise ValueError(f"{self.path} is not an audio pack")
+        old_fd = self.fd if self._pid == os.getpid() else None
+        self.fd = fd; self.pack_id = pack_id; self.pack_ino = os.fstat(fd).st_ino; self._pid = os.getpid()
+        if old_fd is not None: os.close(old_fd)
+        # Старые mmap не закрываются явно: параллельный поиск может ещё читать их, GC освободит их сам
+        self._index, self._index_count, covered_end, self.index_ino = self._load_index()
+        self._overlay = {}; self._scanned_end = covered_end
+        self._scan_tail_locked()
+
+    def _load_index(self):
+        try:
+            fd = os.open(self.index_path, os.O_RDONLY)
+        except FileNotFoundError: return None, 0, PACK_HEADER.size, None
+        try:
+            st = os.fstat(fd)
+            if st.st_size < INDEX_HEADER.size: return None, 0, PACK_HEADER.size, st.st_ino
+            mm = mmap.mmap(fd, st.st_size, prot=mmap.PROT_READ)
+        finally: os.close(fd)
+        magic, pack_id, count, covered_end = INDEX_HEADER.unpack_from(mm, 0)
+        if magic != INDEX_MAGIC or pack_id != self.pack_id or st.st_size != INDEX_HEADER.size + count * INDEX_ENTRY.size:
+            return None, 0, PACK_HEADER.size, st.st_ino  # индекс от другого pack'а (compaction в процессе) - читаем pack целиком
+        return mm, count, covered_end, st.st_ino
+
+    def _ensure_process(self):
+        if self._pid != os.getpid(): self.reload()
+
+    def _scan_tail_locked(self):
+        end = os.fstat(self.fd).st_size
+        for key, offset, length in scan_records(self.fd, self._scanned_end, end):
+            self._overlay[key] = (offset, length); self._scanned_end = offset + length
+
+    def lookup(self, key):
+        """(смещение, длина) данных для md5 или None."""
+        self._ensure_process()
+        location = self._overlay.get(key)
+        if location is not None: return location
+        index, count = self._index, self._index_count
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2; position = INDEX_HEADER.size + mid * INDEX_ENTRY.size
+            mid_key = index[position:position + 16]
+            if mid_key < key: lo = mid + 1
+            elif mid_key > key: hi = mid
+            else: _, offset, length = INDEX_ENTRY.unpack_from(index, position); return offset, length
+        return None
+
+    def refresh(self):
+        """Подхватывает записи других процессов и замену pack'а или индекса (compaction, перестроение)."""
+        self._ensure_process()
+        try: pack_ino = os.stat(self.path).st_ino
+        except FileNotFoundError: pack_ino = None
+        try: index_ino = os.stat(self.index_path).st_ino
+        except FileNotFoundError: index_ino = None
+        with self._lock:
+            if pack_ino != self.pack_ino or index_ino != self.index_ino:
+                if pack_ino is None: create_pack(self.path)
+                self._reload_locked()
+            else: self._scan_tail_locked()
+
+    def append(self, key, data):
+        """Дописывает запись и возвращает (смещение, длина) её данных."""
+        self._ensure_process()
+        record = RECORD_HEADER.pack(RECORD_MAGIC, key, len(data)) + bytes(data)
+        with self._lock:
+            while True:
+                lock_exclusive(self.fd)
+                try:
+                    try: replaced = os.stat(self.path).st_ino != self.pack_ino
+                    except FileNotFoundError: replaced = True
+                    if not replaced:
+                        self._scan_tail_locked()  # записи других процессов до нашей
+                        offset = os.fstat(self.fd).st_size + RECORD_HEADER.size
+                        written = 0
+                        while written < len(record): written += os.write(self.fd, record[written:])
+                        self._overlay[key] = (offset, len(data)); self._scanned_end = offset + len(data)
+                        return offset, len(data)
+                finally: fcntl.flock(self.fd, fcntl.LOCK_UN)
+                # pack заменён compaction'ом, пока мы ждали блокировку: пишем в новый
+                if not os.path.exists(self.path): create_pack(self.path)
+                self._reload_locked()
+
+    def pread(self, offset, length):
+        self._ensure_process()
+        return os.pread(self.fd, length, offset)
+
+    def open_reader(self):
+        """
+        Новый файловый объект (без буфера) на тот же pack - со своей позицией, для wsgi.file_wrapper.
+        Открывается через /proc/self/fd, чтобы гарантированно попасть в тот же inode, что и индекс;
+        без /proc (macOS) - по пути, с проверкой, что это всё ещё тот же файл. None, если pack
+        уже заменён compaction'ом: тогда читать можно только через pread.
+        """
+        self._ensure_process()
+        try: return open(f"/proc/self/fd/{self.fd}", 'rb', buffering=0)
+        except OSError: pass
+        try: f = open(self.path, 'rb', buffering=0)
+        except OSError: return None
+        if os.path.samestat(os.fstat(f.fileno()), os.fstat(self.fd)): return f
+        f.close(); return None
+
+    def stats(self):
+        return {"files": self._index_count + len(self._overlay), "indexed": self._index_count, "overlay": len(self._overlay),
+                "bytes": os.fstat(self.fd).st_size if self.fd is not None else 0}
+
+
+# --- Обслуживание pack'а (для запуска как скрипт) ---
+def _read_all(path):
+    """(id pack'а, {md5: (смещение, длина)} - последняя запись каждого ключа, число записей, конец последней целой записи)."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        magic, pack_id = PACK_HEADER.unpack(os.pread(fd, PACK_HEADER.size, 0))
+        if magic != PACK_MAGIC: raise ValueError(f"{path} is not an audio pack")
+        records = scan_records(fd, PACK_HEADER.size, os.fstat(fd).st_size)
+    finally: os.close(fd)
+    entries = {key: (offset, length) for key, offset, length in records}
+    end = records[-1][1] + records[-1][2] if records else PACK_HEADER.size
+    return pack_id, entries, len(records), end
+
+def build_index(path):
+    pack_id, entries, _, end = _read_all(path)
+    write_index(f"{path}.idx", pack_id, entries, end)
+    return len(entries)
+
+def build_from_directory(cache_dir, path):
+    """Дописывает в pack все <md5>.mp3 из cache_dir, которых в нём ещё нет, и перестраивает индекс."""
+    pack = AudioPack(path); added = 0
+    for name in sorted(os.listdir(cache_dir)):
+        key = filename_to_key(name)
+        if key is None or pack.lookup(key) is not None: continue
+        with open(os.path.join(cache_dir, name), 'rb') as f: pack.append(key, f.read())
+        added += 1
+    return added, build_index(path)
+
+def compact(path):
+    """
+    Переписывает pack без повторных и повреждённых записей (с новым id) и строит для него индекс.
+    Держит эксклюзивную блокировку старого pack'а: запись worker'ов ждёт и затем идёт в новый pack.
+    """
+    fd = os.open(path, os.O_RDWR)
+    try:
+        lock_exclusive(fd)
+        _, entries, records, _ = _read_all(path)
+        tmp_path = f"{path}.{os.getpid()}.compact.tmp"; new_id = uuid.uuid4().bytes; new_entries = {}
+        with open(tmp_path, 'wb') as out:
+            out.write(PACK_HEADER.pack(PACK_MAGIC, new_id)); position = PACK_HEADER.size
+            for key, (offset, length) in sorted(entries.items(), key=lambda item: item[1][0]):
+                out.write(RECORD_HEADER.pack(RECORD_MAGIC, key, length)); out.write(os.pread(fd, length, offset))
+                new_entries[key] = (position + RECORD_HEADER.size, length); position += RECORD_HEADER.size + length
+            out.flush(); os.fsync(out.fileno())
+        before = os.fstat(fd).st_size
+        os.replace(tmp_path, path)
+        write_index(f"{path}.idx", new_id, new_entries, position)
+        return {"records_before": records, "files": len(new_entries), "bytes_before": before, "bytes_after": position}
+    finally: os.close(fd)
+
+def pack_stats(path):
+    _, entries, records, end = _read_all(path)
+    size = os.path.getsize(path); live = sum(length + RECORD_HEADER.size for _, length in entries.values()) + PACK_HEADER.size
+    try:
+        with open(f"{path}.idx", 'rb') as f: _, _, indexed, covered_end = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+    except (OSError, struct.error): indexed, covered_end = 0, None
+    return {"files": len(entries), "records": records, "bytes": size, "dead_bytes": size - live, "corrupt_tail_bytes": size - end,
+            "indexed": indexed, "unindexed_bytes": end - covered_end if covered_end is not None else end}
+
+def unpack(path, cache_dir):
+    _, entries, _, _ = _read_all(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        for key, (offset, length) in entries.items():
+            target = os.path.join(cache_dir, key_to_filename(key)); tmp_path = f"{target}.tmp"
+            with open(tmp_path, 'wb') as f: f.write(os.pread(fd, length, offset))
+            os.replace(tmp_path, target)
+    finally: os.close(fd)
+    return len(entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and maintain the packed audio cache (LOCAL_CACHE_BACKEND=pack)")
+    sub = parser.add_subparsers(dest='command', required=True)
+    for name, help_text in (('build', "append <md5>.mp3 files from a cache directory and rebuild the index"), ('index', "rebuild the index from the pack"),
+                            ('compact', "drop duplicate and corrupt records, rebuild the index"), ('stats', "print pack statistics as JSON"),
+                            ('unpack', "extract every file into a cache directory")):
+        command = sub.add_parser(name, help=help_text)
+        command.add_argument('--pack', required=True, help="path to the pack file (index: <pack>.idx)")
+        if name == 'build': command.add_argument('--from', dest='source', required=True, help="audio cache directory")
+        if name == 'unpack': command.add_argument('--to', dest='target', required=True, help="target directory")
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        added, indexed = build_from_directory(args.source, args.pack); print(f"added {added} files, index has {indexed} entries")
+    elif args.command == 'index': print(f"index has {build_index(args.pack)} entries")
+    elif args.command == 'compact': print(json.dumps(compact(args.pack)))
+    elif args.command == 'stats': print(json.dumps(pack_stats(args.pack), indent=2))
+    elif args.command == 'unpack': print(f"extracted {unpack(args.pack, args.target)} files")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+# Файл: benchmarks/bench_utils.py
+# Общие помощники бенчмарков: перцентили, окружение запуска и запись результатов в JSON.
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VOCABULARIES_DIR = os.path.join(SERVER_DIR, 'vocabularies')
+
+
+def percentile(sorted_values, q):
+    """Перцентиль q (0..100) по уже отсортированному списку, линейная интерполяция."""
+    if not sorted_values: return None
+    k = (len(sorted_values) - 1) * q / 100.0
+    lo = int(k); hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(latencies, duration=None):
+    """Сводка по списку задержек (сек): count, throughput, mean и p50/p95/p99 в миллисекундах."""
+    values = sorted(latencies)
+    summary = {"count": len(values)}
+    if duration: summary["throughput_per_sec"] = round(len(values) / duration, 2)
+    if values:
+        summary["mean_ms"] = round(sum(values) / len(values) * 1000, 3)
+        for q in (50, 95, 99): summary[f"p{q}_ms"] = round(percentile(values, q) * 1000, 3)
+        summary["max_ms"] = round(values[-1] * 1000, 3)
+    return summary
+
+
+def scratch_paths(scratch_dir):
+    """
+    Переменные окружения, направляющие всё, что сервер пишет на диск (кэш, pack, SQLite, снимок
+    индекса Drive, история словарей), в scratch_dir - независимо от окружения запуска.
+    """
+    cache_dir = os.path.join(scratch_dir, 'audio_cache')
+    return {'LOCAL_CACHE_DIR': cache_dir, 'LOCAL_CACHE_PACK': os.path.join(cache_dir, 'audio.pack'),
+            'SHARED_STATE_DB': os.path.join(scratch_dir, 'state.db'), 'GDRIVE_INDEX_FILE': os.path.join(scratch_dir, 'gdrive_index.json'),
+            'VOCAB_HISTORY_DIR': os.path.join(scratch_dir, 'vocab_history'), 'VOCABULARIES_DIR': VOCABULARIES_DIR}
+
+
+def environment_info():
+    try: commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SERVER_DIR, capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception: commit = None
+    return {"timestamp": datetime.now().isoformat(), "git_commit": commit, "python": sys.version.split()[0],
+            "platform": platform.platform(), "cpu_count": os.cpu_count()}
+
+
+def write_results(path, kind, params, results):
+    """Пишет результаты в JSON (для сравнения прогонов между коммитами) и возвращает документ."""
+    document = {"benchmark": kind, "environment": environment_info(), "params": params, "results": results}
+    if path:
+        with open(path, 'w', encoding='utf-8') as f: json.dump(document, f, ensure_ascii=False, indent=2)
+        print(f"Results written to {path}", file=sys.stderr)
+    return document
+
+
+class Stopwatch:
+    def __enter__(self): self.started = time.perf_counter(); return self
+    def __exit__(self, *exc): self.elapsed = time.perf_counter() - self.started
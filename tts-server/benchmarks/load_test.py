@@ -0,0 +1,208 @@
+# Файл: benchmarks/load_test.py
+# Нагрузочный тест, повторяющий сценарий app.js: /api/vocabularies/list -> /api/vocabulary/<name> ->
+# для каждого слова и части /synthesize_by_id (синхронно, как app.js) -> /audio/<hash>.mp3.
+# С --async запросы идут с async=1 и при 202 опрашивается /jobs. Каждый запрос по умолчанию открывает
+# новое соединение: как и за балансировщиком, запросы одного пользователя попадают на разные worker'ы
+# (--keep-alive - одно соединение на пользователя).
+#
+# Сервер запускается настоящим gunicorn с gunicorn_config.py (gevent worker'ы), но с подставными
+# Google Drive (GDRIVE_FAKE_DIR) и TTS (TTS_BACKENDS=mock), поэтому тест не ходит в сеть.
+# Сценарии:
+#   cold  - пустой локальный кэш и пустой Drive: каждое аудио генерируется mock-бэкендом;
+#   warm  - все аудио уже в локальном кэше;
+#   drive - локальный кэш пуст, все аудио есть только в (подставном) Google Drive.
+#
+# Использование:
+#   python benchmarks/load_test.py --output results/load.json
+#   python benchmarks/load_test.py --scenario warm --users 50 --words 20 --workers 2
+#   python benchmarks/load_test.py --scenario cold --async
+
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_utils import SERVER_DIR, Stopwatch, scratch_paths, summarize, write_results
+
+SCENARIOS = ('cold', 'warm', 'drive')
+PARTS = ('german', 'russian', 'sentence')
+
+
+def audio_files_for_vocabularies(scratch_dir):
+    """Имена MP3 для всех частей всех слов - теми же функциями, что и сервер."""
+    os.environ.update(scratch_paths(os.path.join(scratch_dir, 'import'))); os.environ.pop('GOOGLE_DRIVE_FOLDER_ID', None)
+    sys.path.insert(0, SERVER_DIR)
+    import server
+    names = set()
+    for vocab in server.vocabulary_registry.list():
+        entry = server.vocabulary_registry.get(vocab['name'])
+        for _, _, text, lang in server.iter_word_parts(entry):
+            names.add(f"{server.tts_system._get_text_hash(lang, text)}.mp3")
+    return sorted(names), server.MockBackend.SILENT_FRAME * server.Config.MOCK_TTS_FRAMES
+
+
+def free_port():
+    with socket.socket() as s: s.bind(('127.0.0.1', 0)); return s.getsockname()[1]
+
+
+class Client:
+    """
+    HTTP-клиент одного виртуального пользователя: новое соединение на каждый запрос или, с keep_alive,
+    одно соединение (одно переподключение при обрыве). Время запроса включает установку соединения.
+    """
+    def __init__(self, port, record, keep_alive=False):
+        self.port = port; self.record = record; self.keep_alive = keep_alive; self.conn = None
+    def get(self, kind, path):
+        for attempt in (1, 2):
+            try:
+                with Stopwatch() as sw:
+                    if self.conn is None: self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=130)
+                    self.conn.request('GET', path); response = self.conn.getresponse(); body = response.read()
+                if not self.keep_alive: self.conn.close(); self.conn = None
+                self.record(kind, sw.elapsed, response.status)
+                return response.status, body
+            except (http.client.HTTPException, OSError):
+                if self.conn: self.conn.close()
+                self.conn = None
+                if attempt == 2: self.record(kind, None, 'connection_error'); return None, b''
+    def get_json(self, kind, path):
+        status, body = self.get(kind, path)
+        try: return status, json.loads(body) if body else None
+        except ValueError: return status, None
+
+
+def run_session(client, rng, words_per_session, record, use_async=False):
+    """Одна учебная сессия, как в app.js."""
+    status, vocabularies = client.get_json('vocabularies_list', '/api/vocabularies/list')
+    if status != 200 or not vocabularies: return
+    vocab_name = rng.choice(vocabularies)['name']
+    status, vocabulary = client.get_json('vocabulary', f'/api/vocabulary/{quote(vocab_name)}')
+    if status != 200 or not vocabulary: return
+    words = vocabulary.get('words', [])
+    for word in rng.sample(words, min(words_per_session, len(words))):
+        for part in PARTS:
+            if not word.get(part): continue
+            with Stopwatch() as part_sw:
+                status, data = client.get_json('synthesize_by_id', f"/synthesize_by_id?id={quote(word['id'])}&part={part}&vocab={quote(vocab_name)}" + ("&async=1" if use_async else ""))
+                while status == 202 and data and data.get('poll_url'):
+                    status, data = client.get_json('job_poll', f"{data['poll_url']}?wait=5")
+                if status == 200 and data and data.get('url'): client.get('audio', data['url'])
+            record('part_total', part_sw.elapsed if status == 200 else None, status)
+
+
+def start_server(scenario_dir, port, env_overrides, workers, log_path):
+    env = dict(os.environ, PORT=str(port), **env_overrides)
+    env.pop('GOOGLE_DRIVE_FOLDER_ID', None)
+    command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn_config.py']
+    if workers: command += ['--workers', str(workers)]
+    command.append('server:app')
+    log = open(log_path, 'wb')
+    process = subprocess.Popen(command, cwd=SERVER_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None: raise RuntimeError(f"gunicorn exited with code {process.returncode}, see {log_path}")
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2); conn.request('GET', '/health'); conn.getresponse().read(); conn.close()
+            return process
+        except OSError: time.sleep(0.2)
+    process.kill(); raise RuntimeError(f"gunicorn did not start in time, see {log_path}")
+
+
+def stop_server(process):
+    process.send_signal(signal.SIGTERM)
+    try: process.wait(timeout=35)
+    except subprocess.TimeoutExpired: process.kill(); process.wait()
+
+
+def run_scenario(scenario, args, audio_files, audio_bytes, scratch_dir):
+    scenario_dir = os.path.join(scratch_dir, scenario); paths = scratch_paths(scenario_dir)
+    cache_dir = paths['LOCAL_CACHE_DIR']; drive_dir = os.path.join(scenario_dir, 'drive')
+    os.makedirs(cache_dir); os.makedirs(drive_dir)
+    prefilled = {'warm': cache_dir, 'drive': drive_dir}.get(scenario)
+    if prefilled:
+        for name in audio_files:
+            with open(os.path.join(prefilled, name), 'wb') as f: f.write(audio_bytes)
+    env = {
+        **paths, 'GDRIVE_FAKE_DIR': drive_dir, 'GDRIVE_FAKE_LATENCY': str(args.drive_latency),
+        'TTS_BACKENDS': 'mock', 'MOCK_TTS_LATENCY': str(args.tts_latency), 'GENERATION_WORKERS': str(args.generation_workers),
+    }
+    port = free_port(); log_path = os.path.join(scenario_dir, 'gunicorn.log')
+    process = start_server(scenario_dir, port, env, args.workers, log_path)
+
+    samples = {}; errors = {}; lock = threading.Lock()
+    def record(kind, latency, status):
+        with lock:
+            if latency is not None and status in (200, 202, 206, 304): samples.setdefault(kind, []).append(latency)
+            else: errors.setdefault(kind, {}).setdefault(str(status), 0); errors[kind][str(status)] += 1
+    def user(index):
+        rng = random.Random(args.seed + index); client = Client(port, record, args.keep_alive)
+        for _ in range(args.sessions): run_session(client, rng, args.words, record, args.use_async)
+
+    try:
+        with Stopwatch() as wall:
+            threads = [threading.Thread(target=user, args=(i,)) for i in range(args.users)]
+            for t in threads: t.start()
+            for t in threads: t.join()
+        status, server_metrics = Client(port, lambda *a: None).get_json('metrics', '/metrics')
+    finally:
+        stop_server(process)
+
+    total_requests = sum(len(v) for k, v in samples.items() if k != 'part_total') + sum(sum(e.values()) for k, e in errors.items() if k != 'part_total')
+    result = {
+        "duration_seconds": round(wall.elapsed, 3),
+        "requests_total": total_requests,
+        "throughput_rps": round(total_requests / wall.elapsed, 2),
+        "endpoints": {kind: summarize(values, wall.elapsed) for kind, values in sorted(samples.items())},
+        "errors": errors,
+        "server_metrics": server_metrics if status == 200 else None,
+    }
+    if not args.keep: shutil.rmtree(scenario_dir, ignore_errors=True)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay app.js study sessions against gunicorn with fake Drive and TTS")
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help="scenario to run (repeatable); default: all")
+    parser.add_argument('--users', type=int, default=20, help="concurrent virtual users")
+    parser.add_argument('--sessions', type=int, default=2, help="study sessions per user")
+    parser.add_argument('--words', type=int, default=10, help="words per session")
+    parser.add_argument('--workers', type=int, help="override gunicorn worker count from gunicorn_config.py")
+    parser.add_argument('--generation-workers', type=int, default=4, help="GENERATION_WORKERS for the server")
+    parser.add_argument('--tts-latency', type=float, default=0.3, help="mock TTS latency, seconds")
+    parser.add_argument('--drive-latency', type=float, default=0.05, help="fake Google Drive latency per API call, seconds")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="request async=1 and poll /jobs on 202 instead of the synchronous wait app.js uses")
+    parser.add_argument('--keep-alive', action='store_true', help="reuse one connection per virtual user instead of a new connection per request")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keep', action='store_true', help="keep scratch directories (gunicorn logs, caches)")
+    parser.add_argument('--output', help="write JSON results to this file")
+    args = parser.parse_args()
+
+    scratch_dir = tempfile.mkdtemp(prefix='tts-load-')
+    try:
+        audio_files, audio_bytes = audio_files_for_vocabularies(scratch_dir)
+        results = {}
+        for scenario in args.scenario or SCENARIOS:
+            print(f"▶ {scenario}: {args.users} users x {args.sessions} sessions x {args.words} words", file=sys.stderr)
+            results[scenario] = run_scenario(scenario, args, audio_files, audio_bytes, scratch_dir)
+            part = results[scenario]["endpoints"].get("part_total", {})
+            print(f"  {results[scenario]['throughput_rps']} req/s, per part p50={part.get('p50_ms')} ms p95={part.get('p95_ms')} ms p99={part.get('p99_ms')} ms", file=sys.stderr)
+    finally:
+        if not args.keep: shutil.rmtree(scratch_dir, ignore_errors=True)
+    params = {k: v for k, v in vars(args).items() if k not in ('output', 'keep')}
+    document = write_results(args.output, 'load_test', params, results)
+    if not args.output: print(json.dumps(document, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# Файл: benchmarks/micro.py
+# Микро-бенчмарки горячих путей server.py без HTTP: поиск слова в словаре, хэш текста,
+# rate limiter (локальный и общий через SQLite), метрики, кэши (каталог, pack, память).
+#
+# Использование:
+#   python benchmarks/micro.py --output results/micro.json
+#   python benchmarks/micro.py --only rate_limiter_shared --iterations 2000
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_utils import SERVER_DIR, scratch_paths, summarize, write_results
+
+
+def measure(fn, iterations, warmup):
+    """Запускает fn iterations раз (после warmup прогревочных) и возвращает сводку задержек."""
+    for _ in range(warmup): fn()
+    latencies = []; clock = time.perf_counter
+    started = clock()
+    for _ in range(iterations):
+        t = clock(); fn(); latencies.append(clock() - t)
+    # summarize() считает в миллисекундах; масштабируем на 1000, чтобы получить микросекунды без потери точности
+    summary = summarize([v * 1000 for v in latencies], (clock() - started) * 1000)
+    summary["throughput_per_sec"] = round(summary["throughput_per_sec"] * 1000, 2)
+    return {key.replace('_ms', '_us'): value for key, value in summary.items()}
+
+
+def build_cases(server, scratch_dir):
+    """Словарь {имя: fn} для измерения. Все объекты создаются в scratch_dir."""
+    registry = server.vocabulary_registry
+    vocab_name = registry.list()[0]['name']
+    word_ids = list(registry.get(vocab_name).by_id)
+    texts = [text for _, _, text, _ in server.iter_word_parts(registry.get(vocab_name))]
+    state = {'i': 0}
+    def next_index(n): state['i'] = (state['i'] + 1) % n; return state['i']
+
+    unlimited = 10 ** 9
+    local_limiter = server.SmartTTSRateLimiter(unlimited, unlimited, name='bench-local')
+    shared_store = server.SharedStateStore(os.path.join(scratch_dir, 'micro-state.db'))
+    shared_limiter = server.SmartTTSRateLimiter(unlimited, unlimited, store=shared_store, name='bench-shared')
+    metrics = server.ThreadSafeMetrics(server.SharedStateStore(os.path.join(scratch_dir, 'micro-metrics.db')), flush_interval=2.0)
+
+    audio = server.MockBackend.SILENT_FRAME * server.Config.MOCK_TTS_FRAMES
+    local_cache = server.LocalAudioCache(os.path.join(scratch_dir, 'micro-cache'), 64 * 1024 * 1024)
+    names = [f"{server.tts_system._get_text_hash('de', text)}.mp3" for text in texts[:200]]
+    for name in names: local_cache.write(name, audio)
+    pack_cache = server.PackAudioCache(os.path.join(scratch_dir, 'micro-pack', 'audio.pack'))
+    for name in names: pack_cache.write(name, audio)
+    memory_cache = server.MemoryAudioCache(8 * 1024 * 1024, 512 * 1024)
+    for name in names: memory_cache.put(name, audio)
+
+    return {
+        "find_word_in_vocab": lambda: server.find_word_in_vocab(vocab_name, word_ids[next_index(len(word_ids))]),
+        "text_hash": lambda: server.tts_system._get_text_hash('de', texts[next_index(len(texts))]),
+        "rate_limiter_local": local_limiter.try_acquire,
+        "rate_limiter_shared": shared_limiter.try_acquire,
+        "metrics_counter": metrics.record_cache_hit,
+        "metrics_histogram": lambda: metrics.observe_phase('bench', 0.01),
+        "local_cache_contains": lambda: local_cache.contains(names[next_index(len(names))]),
+        "pack_cache_contains": lambda: pack_cache.contains(names[next_index(len(names))]),
+        "memory_cache_get": lambda: memory_cache.get(names[next_index(len(names))]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for server.py hot paths")
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--warmup', type=int, default=500)
+    parser.add_argument('--only', action='append', help="run only this case (repeatable)")
+    parser.add_argument('--output', help="write JSON results to this file")
+    args = parser.parse_args()
+
+    scratch_dir = tempfile.mkdtemp(prefix='tts-micro-')
+    os.environ.update(scratch_paths(os.path.join(scratch_dir, 'import'))); os.environ.pop('GOOGLE_DRIVE_FOLDER_ID', None)
+    os.environ.setdefault('TTS_BACKENDS', 'mock')
+    sys.path.insert(0, SERVER_DIR)
+    try:
+        import server
+        cases = build_cases(server, scratch_dir)
+        results = {}
+        for name, fn in cases.items():
+            if args.only and name not in args.only: continue
+            # Общий лимитер ходит в SQLite на каждый вызов - меньше итераций, чтобы прогон оставался коротким
+            iterations = min(args.iterations, 2000) if name == 'rate_limiter_shared' else args.iterations
+            results[name] = measure(fn, iterations, args.warmup)
+            print(f"{name:24} p50={results[name].get('p50_us')} us p99={results[name].get('p99_us')} us", file=sys.stderr)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    document = write_results(args.output, 'micro', {k: v for k, v in vars(args).items() if k != 'output'}, results)
+    if not args.output: print(json.dumps(document, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
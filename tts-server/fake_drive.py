@@ -0,0 +1,134 @@
+# Файл: fake_drive.py
+# Офлайн-имитация Google Drive API v3 в объёме, который использует server.py:
+# files().list / files().get_media (uri + http.request, как у googleapiclient; Range поддерживается) и changes().
+# Используется для проверки индекса Drive без сети и для бенчмарков (Config.GDRIVE_FAKE_DIR).
+
+import hashlib
+import os
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+
+
+class _FakeHttpResponse(dict):
+    """Аналог httplib2.Response: словарь заголовков + атрибут status."""
+    def __init__(self, status, headers):
+        super().__init__(headers); self.status = status
+
+
+class _FakeRequest:
+    def __init__(self, fn): self._fn = fn
+    def execute(self, num_retries=0): return self._fn()
+
+
+class _FakeHttp:
+    """Транспорт запроса get_media (без OAuth, как httplib2.Http): отдаёт содержимое файла с учётом заголовка Range."""
+    def __init__(self, service, file_id): self._service = service; self._file_id = file_id
+    def request(self, uri, method="GET", headers=None, **kwargs):
+        self._service._call('media')
+        content = self._service._content(self._file_id)
+        if content is None: return _FakeHttpResponse(404, {}), b''
+        total = len(content); match = re.match(r'bytes=(\d+)-(\d*)', (headers or {}).get('range', ''))
+        if not match: return _FakeHttpResponse(200, {'content-length': str(total)}), content
+        start = int(match.group(1)); end = min(int(match.group(2)) if match.group(2) else total - 1, total - 1)
+        if start >= total: return _FakeHttpResponse(416, {'content-range': f'bytes */{total}'}), b''
+        return _FakeHttpResponse(206, {'content-range': f'bytes {start}-{end}/{total}'}), content[start:end + 1]
+
+
+class _FakeMediaRequest(_FakeRequest):
+    def __init__(self, service, file_id):
+        super().__init__(lambda: service._content(file_id))
+        self.uri = f"fake://drive/files/{file_id}?alt=media"; self.headers = {}; self.http = _FakeHttp(service, file_id)
+
+
+class _FakeFiles:
+    def __init__(self, service): self._service = service
+    def list(self, q='', fields=None, pageSize=100, pageToken=None, **kwargs):
+        return _FakeRequest(lambda: self._service._list_files(q, pageSize, pageToken))
+    def get_media(self, fileId, **kwargs):
+        return _FakeMediaRequest(self._service, fileId)
+
+
+class _FakeChanges:
+    def __init__(self, service): self._service = service
+    def getStartPageToken(self, **kwargs):
+        return _FakeRequest(lambda: self._service._start_page_token())
+    def list(self, pageToken, pageSize=100, fields=None, spaces=None, **kwargs):
+        return _FakeRequest(lambda: self._service._list_changes(pageToken, pageSize))
+
+
+class FakeDriveService:
+    """
+    In-memory папка Google Drive. Файлы добавляются через add_file/remove_file, каждое изменение
+    попадает в журнал changes. latency (сек) добавляется к каждому вызову API; calls считает вызовы
+    по типам ('files.list', 'changes.list', 'media', ...).
+    """
+    DEFAULT_FOLDER_ID = 'fake-folder'
+
+    def __init__(self, folder_id=DEFAULT_FOLDER_ID, latency=0.0):
+        self.folder_id = folder_id; self.latency = latency; self.calls = Counter()
+        self._files = {}; self._changes = []; self._lock = threading.Lock()
+
+    @classmethod
+    def from_directory(cls, path, folder_id=DEFAULT_FOLDER_ID, latency=None):
+        """
+        Папка, содержащая все *.mp3 из каталога path. Содержимое читается лениво при скачивании.
+        id файлов выводятся из имён, поэтому, как и у настоящего Drive, совпадают во всех процессах.
+        """
+        latency = float(os.getenv('GDRIVE_FAKE_LATENCY', 0)) if latency is None else latency
+        service = cls(folder_id, latency)
+        for name in sorted(os.listdir(path)):
+            if name.endswith('.mp3'): service.add_file(name, path=os.path.join(path, name), file_id=hashlib.md5(name.encode('utf-8')).hexdigest())
+        return service
+
+    # --- Управление содержимым ---
+    def add_file(self, name, content=b'', path=None, parents=None, file_id=None):
+        file_id = file_id or uuid.uuid4().hex
+        with self._lock:
+            self._files[file_id] = {'id': file_id, 'name': name, 'parents': parents or [self.folder_id], 'trashed': False, 'content': content, 'path': path}
+            self._changes.append(file_id)
+        return file_id
+    def remove_file(self, name):
+        with self._lock:
+            for file_id, file in self._files.items():
+                if file['name'] == name and not file['trashed']:
+                    file['trashed'] = True; self._changes.append(file_id); return True
+        return False
+
+    # --- Интерфейс googleapiclient ---
+    def files(self): return _FakeFiles(self)
+    def changes(self): return _FakeChanges(self)
+
+    def _call(self, kind):
+        self.calls[kind] += 1
+        if self.latency: time.sleep(self.latency)
+    def _content(self, file_id):
+        file = self._files.get(file_id)
+        if file is None or file['trashed']: return None
+        if file['path'] is not None:
+            with open(file['path'], 'rb') as f: return f.read()
+        return file['content']
+    def _list_files(self, q, page_size, page_token):
+        self._call('files.list')
+        match = re.search(r"'([^']+)' in parents", q); folder_id = match.group(1) if match else None
+        with self._lock:
+            files = [f for f in self._files.values() if not f['trashed'] and (folder_id is None or folder_id in f['parents'])]
+        start = int(page_token or 0); page = files[start:start + page_size]
+        response = {'files': [{'id': f['id'], 'name': f['name']} for f in page]}
+        if start + page_size < len(files): response['nextPageToken'] = str(start + page_size)
+        return response
+    def _start_page_token(self):
+        self._call('changes.getStartPageToken')
+        with self._lock: return {'startPageToken': str(len(self._changes))}
+    def _list_changes(self, page_token, page_size):
+        self._call('changes.list')
+        with self._lock:
+            start = int(page_token); file_ids = self._changes[start:start + page_size]
+            changes = [{'fileId': file_id, 'removed': False,
+                        'file': {'name': self._files[file_id]['name'], 'parents': self._files[file_id]['parents'], 'trashed': self._files[file_id]['trashed']}}
+                       for file_id in file_ids]
+            end = start + len(file_ids)
+            if end < len(self._changes): return {'changes': changes, 'nextPageToken': str(end)}
+            return {'changes': changes, 'newStartPageToken': str(end)}
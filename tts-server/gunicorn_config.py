@@ -6,6 +6,7 @@ from gevent import monkey
 monkey.patch_all()
 
 import os
+import time
 
 # === Основные настройки Gunicorn (сохраняем ваши настройки) ===
 # Worker class для gevent
@@ -76,6 +77,13 @@ def when_ready(server):
     server.log.info(f"👥 Workers: {workers}")
     server.log.info(f"🔧 Worker class: {worker_class}")
 
+    # Метрики и общий лимит TTS живут в SQLite, общей для всех worker'ов: обнуляем их один раз в master.
+    # Словари, индекс Drive и сжатые ответы строятся здесь же, до fork, и достаются worker'ам готовыми
+    if preload_app:
+        from server import preload, tts_system
+        tts_system.shared_state.reset()
+        preload()
+
 # === Monkey patching проверка ===
 def post_fork(server, worker):
     """Вызывается после fork worker процесса"""
@@ -88,4 +96,14 @@ def post_fork(server, worker):
     else:
         worker.log.warning("⚠️ Gevent monkey patching may have failed")
     
-    worker.log.info(f"🔧 Worker {worker.pid} started")
\ No newline at end of file
+    worker.log.info(f"🔧 Worker {worker.pid} started")
+
+    # Клиенты и потоки, которые нельзя унаследовать от master'а
+    worker.tts_forked_at = time.monotonic()
+    if preload_app:
+        from server import on_worker_start
+        on_worker_start()
+
+def post_worker_init(worker):
+    """Вызывается, когда worker готов принимать запросы: время от fork видно при каждом перезапуске по max_requests"""
+    worker.log.info(f"⏱️ Worker {worker.pid} ready in {(time.monotonic() - worker.tts_forked_at) * 1000:.0f} ms after fork")
@@ -2,35 +2,57 @@
 # ВЕРСИЯ 2.5.1 (Pagination fix) - ПОЛНАЯ ВЕРСИЯ
 # Исправлена загрузка списка файлов из Google Drive для поддержки более 1000 записей.
 
+import time
+_MODULE_STARTED = time.perf_counter()
 import os
 import json
 import hashlib
-import time
 from pathlib import Path
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, g, has_request_context
+from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.wsgi import wrap_file
+from werkzeug.datastructures import ContentRange
 from flask_cors import CORS
-from gtts import gTTS
 import logging
 import threading
 from datetime import datetime, timedelta
-from collections import deque
+from collections import deque, OrderedDict
 import sys
 import atexit
 import signal
+import shutil
+import subprocess
+import heapq
+import uuid
+import fcntl
+import sqlite3
+import gzip
+import base64
+import bisect
+import contextlib
+import unicodedata
+import _thread
+import gc
+import inspect
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+import audio_pack
+
+# --- Библиотеки для работы с Google Drive: только проверка наличия, импорт - при первом подключении к Drive ---
+GDRIVE_AVAILABLE = all(importlib.util.find_spec(module) is not None for module in ('googleapiclient', 'google.oauth2'))
+if not GDRIVE_AVAILABLE: logging.warning("Google Drive libraries not available. Running in local-only mode.")
 
-# --- Библиотеки для работы с Google Drive ---
+# --- Brotli (необязательно): без него ответы API словарей сжимаются только gzip ---
 try:
-    from googleapiclient.discovery import build
-    from google.oauth2.service_account import Credentials
-    from googleapiclient.http import MediaIoBaseUpload, MediaIoBaseDownload
-    GDRIVE_AVAILABLE = True
+    import brotli
+    BROTLI_AVAILABLE = True
 except ImportError:
-    GDRIVE_AVAILABLE = False
-    logging.warning("Google Drive libraries not available. Running in local-only mode.")
+    BROTLI_AVAILABLE = False
 
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from limits.storage import MemoryStorage
 
 # --- Конфигурация ---
 class Config:
@@ -40,11 +62,47 @@ class Config:
     FOLDER_ID = os.getenv('GOOGLE_DRIVE_FOLDER_ID')
     CREDENTIALS_FILE = 'credentials.json'
     SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
-    LOCAL_CACHE_DIR = "/tmp/audio_cache"
+    GDRIVE_INDEX_FILE = os.getenv('GDRIVE_INDEX_FILE', '/tmp/gdrive_index.json')  # снимок индекса Drive, общий для worker'ов
+    GDRIVE_REFRESH_INTERVAL = int(os.getenv('GDRIVE_REFRESH_INTERVAL', 300))  # сек, 0 = без фонового обновления
+    GDRIVE_FAKE_DIR = os.getenv('GDRIVE_FAKE_DIR')  # каталог с MP3 для офлайн-имитации Drive (тесты, бенчмарки)
+    # Размер куска при чтении ответа Drive. Файл скачивается одним запросом, тело ответа читается по
+    # мере прихода: клиент получает первые 16 КБ, не дожидаясь конца файла, без лишних round-trip'ов.
+    GDRIVE_CHUNK_SIZE = int(os.getenv('GDRIVE_CHUNK_SIZE_KB', 16)) * 1024
+    GDRIVE_DOWNLOAD_TIMEOUT = float(os.getenv('GDRIVE_DOWNLOAD_TIMEOUT', 20))  # сек на соединение и на паузу между кусками ответа
+    SHARED_STATE_DB = os.getenv('SHARED_STATE_DB', '/tmp/tts_shared_state.db')  # метрики и лимит TTS, общие для worker'ов
+    METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 2))
+    LOCAL_CACHE_DIR = os.getenv('LOCAL_CACHE_DIR', "/tmp/audio_cache")
+    LOCAL_CACHE_MAX_BYTES = int(os.getenv('LOCAL_CACHE_MAX_MB', 512)) * 1024 * 1024  # 0 = без ограничения
+    LOCAL_CACHE_BACKEND = os.getenv('LOCAL_CACHE_BACKEND', 'dir')  # dir - файл на аудио; pack - один pack-файл с mmap-индексом (audio_pack.py)
+    LOCAL_CACHE_PACK = os.getenv('LOCAL_CACHE_PACK', os.path.join(LOCAL_CACHE_DIR, 'audio.pack'))  # индекс: <pack>.idx
+    MEMORY_CACHE_MAX_BYTES = int(os.getenv('MEMORY_CACHE_MAX_MB', 32)) * 1024 * 1024  # горячий слой в RAM (на worker), 0 = выключен
+    MEMORY_CACHE_MAX_ITEM_BYTES = 512 * 1024
+    MEMORY_CACHE_PROMOTE_HITS = int(os.getenv('MEMORY_CACHE_PROMOTE_HITS', 2))  # с какого попадания на диск файл копируется в RAM; разовые запросы не вытесняют горячие файлы
+    TTS_BACKENDS = os.getenv('TTS_BACKENDS', 'gtts')  # порядок = приоритет; при отказе бэкенда пробуется следующий (gtts, espeak, mock)
+    GTTS_CONCURRENCY = int(os.getenv('GTTS_CONCURRENCY', 1)); GTTS_TIMEOUT = float(os.getenv('GTTS_TIMEOUT', 30))
+    ESPEAK_COMMAND = os.getenv('ESPEAK_COMMAND', 'espeak-ng'); ESPEAK_CONCURRENCY = int(os.getenv('ESPEAK_CONCURRENCY', 2)); ESPEAK_TIMEOUT = float(os.getenv('ESPEAK_TIMEOUT', 20))
+    MOCK_TTS_LATENCY = float(os.getenv('MOCK_TTS_LATENCY', 0.5)); MOCK_TTS_FRAMES = int(os.getenv('MOCK_TTS_FRAMES', 40)); MOCK_TTS_CONCURRENCY = int(os.getenv('MOCK_TTS_CONCURRENCY', 8))
+    GENERATION_WORKERS = int(os.getenv('GENERATION_WORKERS', 2))  # одновременные генерации TTS на worker
+    GENERATION_MAX_ATTEMPTS = int(os.getenv('GENERATION_MAX_ATTEMPTS', 4))
+    GENERATION_RETRY_BASE_DELAY = float(os.getenv('GENERATION_RETRY_BASE_DELAY', 5))  # сек, удваивается с каждой неудачей
+    GENERATION_WAIT_TIMEOUT = float(os.getenv('GENERATION_WAIT_TIMEOUT', 20))  # сколько синхронный запрос ждёт генерацию до ответа 202
+    WARMUP_WORKERS = int(os.getenv('WARMUP_WORKERS', 8))  # параллельные загрузки из Google Drive при прогреве
+    BUNDLE_DEFAULT_PARTS = os.getenv('BUNDLE_DEFAULT_PARTS', 'german,russian,sentence')  # порядок частей в аудио карточки
+    BUNDLE_GAP_MS = int(os.getenv('BUNDLE_GAP_MS', 700)); BUNDLE_MAX_GAP_MS = 5000  # тишина между частями
+    SERVER_TIMING = os.getenv('SERVER_TIMING', 'true').lower() == 'true'  # заголовок Server-Timing с фазами запроса
+    SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 1000))  # запросы дольше пишутся в лог с разбивкой по фазам, 0 = выкл.
+    PROFILE_MAX_SECONDS = 60
+    AUDIO_MAX_AGE = 31536000  # имена файлов - хэши содержимого, поэтому ответы неизменяемы
     SUPPORTED_LANGUAGES = {'de', 'ru', 'en', 'fr', 'es'}
     MAX_TEXT_LENGTH = 250
     IS_RENDER = os.getenv('RENDER') == 'true'
-    VOCABULARIES_DIR = "vocabularies"
+    VOCABULARIES_DIR = os.getenv('VOCABULARIES_DIR', "vocabularies")
+    MAX_BATCH_ITEMS = int(os.getenv('MAX_BATCH_ITEMS', 500))
+    VOCAB_RELOAD_INTERVAL = float(os.getenv('VOCAB_RELOAD_INTERVAL', 2))  # как часто (сек) проверять mtime/size файлов словарей
+    VOCAB_QUERY_DEFAULT_LIMIT = int(os.getenv('VOCAB_QUERY_DEFAULT_LIMIT', 100)); VOCAB_QUERY_MAX_LIMIT = int(os.getenv('VOCAB_QUERY_MAX_LIMIT', 1000))
+    VOCAB_RESPONSE_CACHE_BYTES = int(os.getenv('VOCAB_RESPONSE_CACHE_MB', 16)) * 1024 * 1024  # готовые (в т.ч. сжатые) ответы API словарей
+    VOCAB_HISTORY_DIR = os.getenv('VOCAB_HISTORY_DIR', 'vocab_history')  # отпечатки прошлых версий словарей для /delta; дополняется из git при старте
+    VOCAB_HISTORY_MAX_VERSIONS = int(os.getenv('VOCAB_HISTORY_MAX_VERSIONS', 50))  # на словарь; более старые версии получают полный словарь
 
 
 # --- Настройка логирования ---
@@ -53,194 +111,1901 @@ logger = logging.getLogger(__name__)
 
 # --- Flask App ---
 app = Flask(__name__)
-CORS(app, origins=Config.CORS_ORIGINS.split(','))
+CORS(app, origins=Config.CORS_ORIGINS.split(','), expose_headers=['X-Vocabulary-Version'])
 limiter = Limiter(get_remote_address, app=app, default_limits=["200 per day", "50 per hour"])
 
 
-# --- Gevent-safe метрики (Без изменений) ---
-class ThreadSafeMetrics:
-    def __init__(self):
-        self.start_time = time.time()
-        self._data = {'request_count': 0, 'tts_generation_count': 0, 'cache_hits': 0, 'cache_misses': 0, 'gdrive_uploads': 0, 'gdrive_downloads': 0, 'errors': 0}
-        self._lock = threading.RLock()
-    def _safe_increment(self, key):
+# --- Общее для всех worker'ов хранилище метрик и лимитов (SQLite в режиме WAL) ---
+class SharedStateStore:
+    """
+    Небольшая SQLite-база, общая для процессов gunicorn. Соединение создаётся лениво в каждом
+    процессе (соединения SQLite нельзя переносить через fork). Таблицы:
+      metrics(name, labels, value) - счётчики и бакеты гистограмм; worker'ы прибавляют к общей строке;
+      rate_events(limiter, ts) - отметки времени запросов к TTS для общего лимита;
+      meta(key, value) - время запуска сервера и т.п.;
+      jobs(id, ...) - состояние заданий генерации, чтобы /jobs отвечал с любого worker'а;
+      cache_files(name, size, used_at) - файлы локального кэша для общего лимита объёма (LocalAudioCache).
+    """
+    def __init__(self, path):
+        self.path = path; self._conn = None; self._pid = None; self._lock = threading.Lock()
+    def _connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL"); conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS metrics (name TEXT, labels TEXT, value REAL, PRIMARY KEY (name, labels))")
+            self._fold_worker_rows(conn)
+            conn.execute("CREATE TABLE IF NOT EXISTS rate_events (limiter TEXT, ts REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS rate_events_ts ON rate_events (limiter, ts)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_files (name TEXT PRIMARY KEY, size INTEGER, used_at REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_files_used_at ON cache_files (used_at)")
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('cache_bytes', '0')")
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, filename TEXT, lang TEXT, text TEXT, priority INTEGER, status TEXT, attempts INTEGER, "
+                         "error TEXT, created_at REAL, finished_at REAL, next_attempt_at REAL, pid INTEGER)")
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('started_at', ?)", (str(time.time()),))
+            self._conn = conn; self._pid = os.getpid()
+        return self._conn
+    @staticmethod
+    def _fold_worker_rows(conn):
+        """Схема до версии без колонки worker хранила строки на каждый pid: сворачивает их в общие."""
+        if 'worker' not in {row[1] for row in conn.execute("PRAGMA table_info(metrics)")}: return
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            with self._lock: self._data[key] += 1
-        except Exception: self._data[key] += 1
+            if 'worker' in {row[1] for row in conn.execute("PRAGMA table_info(metrics)")}:
+                conn.execute("CREATE TABLE metrics_folded (name TEXT, labels TEXT, value REAL, PRIMARY KEY (name, labels))")
+                conn.execute("INSERT INTO metrics_folded SELECT name, labels, SUM(value) FROM metrics GROUP BY name, labels")
+                conn.execute("DROP TABLE metrics"); conn.execute("ALTER TABLE metrics_folded RENAME TO metrics")
+            conn.execute("COMMIT")
+        except Exception: conn.execute("ROLLBACK"); raise
+    def execute(self, sql, params=()):
+        with self._lock: return self._connection().execute(sql, params).fetchall()
+    def transaction(self, fn):
+        """Выполняет fn(conn) в транзакции BEGIN IMMEDIATE (эксклюзивная запись между процессами)."""
+        with self._lock:
+            conn = self._connection(); conn.execute("BEGIN IMMEDIATE")
+            try: result = fn(conn); conn.execute("COMMIT"); return result
+            except Exception: conn.execute("ROLLBACK"); raise
+    def reset(self):
+        """Обнуляет метрики, лимиты и задания (вызывается один раз при старте сервера, до fork)."""
+        def clear(conn):
+            conn.execute("DELETE FROM metrics"); conn.execute("DELETE FROM rate_events"); conn.execute("DELETE FROM jobs")
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('started_at', ?)", (str(time.time()),))
+        self.transaction(clear)
+    def close(self):
+        """Закрывает соединение этого процесса; следующий запрос откроет новое."""
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid(): self._conn.close()
+            self._conn = None; self._pid = None
+    def started_at(self):
+        rows = self.execute("SELECT value FROM meta WHERE key = 'started_at'")
+        return float(rows[0][0]) if rows else time.time()
+
+# --- Метрики: локальные приращения + периодический сброс в общее хранилище ---
+class ThreadSafeMetrics:
+    """
+    Счётчики и гистограммы задержек. Каждый процесс копит приращения в памяти и не чаще раза в
+    flush_interval секунд добавляет их в SharedStateStore; чтение (get_stats, render_prometheus)
+    суммирует данные всех worker'ов. Без store метрики остаются в пределах процесса.
+    """
+    COUNTERS = ('request_count', 'tts_generation_count', 'cache_hits', 'cache_misses', 'gdrive_uploads', 'gdrive_downloads', 'coalesced_requests', 'memory_hits', 'not_modified', 'errors')
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    REQUEST_HISTOGRAM = 'tts_http_request_duration_seconds'
+    PHASE_HISTOGRAM = 'tts_audio_phase_duration_seconds'
+
+    def __init__(self, store=None, flush_interval=2.0):
+        self.store = store; self.flush_interval = flush_interval
+        self.start_time = time.time(); self._last_flush = time.monotonic()
+        self._pending = {}; self._lock = threading.RLock()
+    def _add(self, name, labels='', value=1):
+        key = (name, labels)
+        with self._lock: self._pending[key] = self._pending.get(key, 0) + value
+        if self.store is not None and time.monotonic() - self._last_flush >= self.flush_interval: self.flush()
+    def _safe_increment(self, key): self._add(f"tts_{key}_total")
     def record_request(self): self._safe_increment('request_count')
     def record_tts_generation(self): self._safe_increment('tts_generation_count')
     def record_cache_hit(self): self._safe_increment('cache_hits')
     def record_cache_miss(self): self._safe_increment('cache_misses')
     def record_gdrive_upload(self): self._safe_increment('gdrive_uploads')
     def record_gdrive_download(self): self._safe_increment('gdrive_downloads')
+    def record_coalesced(self): self._safe_increment('coalesced_requests')
+    def record_memory_hit(self): self._safe_increment('memory_hits')
+    def record_not_modified(self): self._safe_increment('not_modified')
     def record_error(self): self._safe_increment('errors')
-    def get_stats(self):
+
+    def observe(self, histogram, labels, seconds):
+        """Добавляет наблюдение в гистограмму (кумулятивные бакеты в формате Prometheus)."""
+        label_str = ','.join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+        with self._lock:
+            for bound in self.LATENCY_BUCKETS:
+                if seconds <= bound:
+                    key = (f"{histogram}_bucket", f'{label_str},le="{bound}"'); self._pending[key] = self._pending.get(key, 0) + 1
+            key = (f"{histogram}_bucket", f'{label_str},le="+Inf"'); self._pending[key] = self._pending.get(key, 0) + 1
+        self._add(f"{histogram}_count", label_str); self._add(f"{histogram}_sum", label_str, seconds)
+    def observe_request(self, endpoint, seconds): self.observe(self.REQUEST_HISTOGRAM, {"endpoint": endpoint or "unknown"}, seconds)
+    def observe_phase(self, phase, seconds): self.observe(self.PHASE_HISTOGRAM, {"phase": phase}, seconds)
+
+    def flush(self):
+        with self._lock: pending, self._pending = self._pending, {}; self._last_flush = time.monotonic()
+        if not pending or self.store is None:
+            with self._lock:
+                for key, value in pending.items(): self._pending[key] = self._pending.get(key, 0) + value
+            return
         try:
+            # Одна строка на метрику для всех процессов: перезапущенные по max_requests worker'ы не оставляют своих строк
+            self.store.transaction(lambda conn: conn.executemany(
+                "INSERT INTO metrics VALUES (?, ?, ?) ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value",
+                [(name, labels, value) for (name, labels), value in pending.items()]))
+        except Exception as e:
+            logger.warning(f"Metrics flush failed, will retry: {e}")
             with self._lock:
-                data = self._data.copy()
-                uptime = time.time() - self.start_time
-                total_cache_ops = data['cache_hits'] + data['cache_misses']
-                hit_rate = (data['cache_hits'] / total_cache_ops * 100) if total_cache_ops > 0 else 0
-                return {"uptime_seconds": round(uptime, 2), "requests_total": data['request_count'], "tts_generations_total": data['tts_generation_count'], "cache_hit_rate_percent": round(hit_rate, 2), "cache_hits": data['cache_hits'], "cache_misses": data['cache_misses'], "gdrive_uploads": data['gdrive_uploads'], "gdrive_downloads": data['gdrive_downloads'], "errors_total": data['errors'], "requests_per_minute": round((data['request_count'] / uptime) * 60, 2) if uptime > 0 else 0}
+                for key, value in pending.items(): self._pending[key] = self._pending.get(key, 0) + value
+    def _snapshot(self):
+        """Суммарные значения {(name, labels): value} по всем worker'ам."""
+        if self.store is None:
+            with self._lock: return dict(self._pending)
+        self.flush()
+        return {(name, labels): value for name, labels, value in self.store.execute("SELECT name, labels, value FROM metrics")}
+
+    def _latency_summary(self, data, histogram, label):
+        """Оценка p50/p95/p99 по бакетам гистограммы (линейная интерполяция внутри бакета)."""
+        series = {}
+        for (name, labels), value in data.items():
+            if name != f"{histogram}_bucket": continue
+            parts = dict(p.split('=', 1) for p in labels.split(',') if p)
+            le = parts.pop('le').strip('"'); series.setdefault(parts.get(label, '""').strip('"'), []).append((float('inf') if le == '+Inf' else float(le), value))
+        summary = {}
+        for key, buckets in series.items():
+            buckets.sort(); total = buckets[-1][1]
+            if not total: continue
+            label_str = f'{label}="{key}"'
+            result = {"count": int(total), "avg_ms": round(data.get((f"{histogram}_sum", label_str), 0) / total * 1000, 2)}
+            for q in (0.5, 0.95, 0.99):
+                rank = q * total; prev_bound, prev_count = 0.0, 0
+                for bound, count in buckets:
+                    if count >= rank:
+                        if bound == float('inf'): bound = prev_bound
+                        fraction = (rank - prev_count) / (count - prev_count) if count > prev_count else 1
+                        result[f"p{int(q * 100)}_ms"] = round((prev_bound + (bound - prev_bound) * fraction) * 1000, 2); break
+                    prev_bound, prev_count = bound, count
+            summary[key] = result
+        return summary
+
+    def get_stats(self):
+        try:
+            snapshot = self._snapshot()
+            data = {key: int(snapshot.get((f"tts_{key}_total", ''), 0)) for key in self.COUNTERS}
+            start_time = self.store.started_at() if self.store is not None else self.start_time
+            uptime = time.time() - start_time
+            total_cache_ops = data['cache_hits'] + data['cache_misses']
+            hit_rate = (data['cache_hits'] / total_cache_ops * 100) if total_cache_ops > 0 else 0
+            return {"uptime_seconds": round(uptime, 2), "requests_total": data['request_count'], "tts_generations_total": data['tts_generation_count'], "cache_hit_rate_percent": round(hit_rate, 2), "cache_hits": data['cache_hits'], "cache_misses": data['cache_misses'], "gdrive_uploads": data['gdrive_uploads'], "gdrive_downloads": data['gdrive_downloads'], "coalesced_requests": data['coalesced_requests'], "memory_hits": data['memory_hits'], "not_modified": data['not_modified'], "errors_total": data['errors'], "requests_per_minute": round((data['request_count'] / uptime) * 60, 2) if uptime > 0 else 0,
+                    "latency": {"endpoints": self._latency_summary(snapshot, self.REQUEST_HISTOGRAM, 'endpoint'), "audio_phases": self._latency_summary(snapshot, self.PHASE_HISTOGRAM, 'phase')}}
         except Exception as e:
             logger.error(f"Error getting stats: {e}")
             return {"uptime_seconds": round(time.time() - self.start_time, 2), "error": "Stats collection issue"}
 
-# --- Rate Limiter (Без изменений) ---
+    def render_prometheus(self):
+        """Все метрики (суммарно по worker'ам) в текстовом формате Prometheus."""
+        def order(item):
+            (name, labels), _ = item
+            series, _, le = labels.partition(',le="')
+            family = name.rsplit('_', 1)[0] if name.startswith((self.REQUEST_HISTOGRAM, self.PHASE_HISTOGRAM)) else name
+            return family, series, name != f"{family}_bucket", float(le.rstrip('"')) if le else 0.0, name
+        lines = []; families = set()
+        for (name, labels), value in sorted(self._snapshot().items(), key=order):
+            family = order(((name, labels), value))[0]
+            if family not in families:
+                families.add(family); lines.append(f"# TYPE {family} {'counter' if family == name else 'histogram'}")
+            value = int(value) if float(value).is_integer() else repr(float(value))
+            lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+        lines.append("# TYPE tts_uptime_seconds gauge")
+        lines.append(f"tts_uptime_seconds {time.time() - (self.store.started_at() if self.store is not None else self.start_time):.0f}")
+        return "\n".join(lines) + "\n"
+
+# --- Rate Limiter ---
 class SmartTTSRateLimiter:
-    def __init__(self, max_requests_per_minute=6, max_requests_per_hour=60):
+    """
+    Скользящие окна "в минуту" и "в час" для запросов к TTS. С store лимит общий для всех
+    worker'ов (отметки хранятся в SQLite, проверка и запись атомарны), иначе - в пределах процесса.
+    """
+    def __init__(self, max_requests_per_minute=6, max_requests_per_hour=60, store=None, name='gtts'):
         self.max_per_minute = max_requests_per_minute; self.max_per_hour = max_requests_per_hour; self.minute_requests = deque(); self.hour_requests = deque(); self._lock = threading.RLock()
-    def can_make_request(self):
+        self.store = store; self.name = name
+    def _shared_check(self, conn, record):
+        now = time.time()
+        conn.execute("DELETE FROM rate_events WHERE limiter = ? AND ts < ?", (self.name, now - 3600))
+        (in_minute, in_hour), = conn.execute("SELECT SUM(ts >= ?), COUNT(*) FROM rate_events WHERE limiter = ?", (now - 60, self.name)).fetchall()
+        if (in_minute or 0) >= self.max_per_minute: return False, "minute_limit"
+        if in_hour >= self.max_per_hour: return False, "hour_limit"
+        if record: conn.execute("INSERT INTO rate_events VALUES (?, ?)", (self.name, now))
+        return True, "ok"
+    def _local_check(self, record):
+        with self._lock:
+            now = datetime.now(); one_minute_ago = now - timedelta(minutes=1); one_hour_ago = now - timedelta(hours=1)
+            while self.minute_requests and self.minute_requests[0] < one_minute_ago: self.minute_requests.popleft()
+            while self.hour_requests and self.hour_requests[0] < one_hour_ago: self.hour_requests.popleft()
+            if len(self.minute_requests) >= self.max_per_minute: return False, "minute_limit"
+            if len(self.hour_requests) >= self.max_per_hour: return False, "hour_limit"
+            if record: self.minute_requests.append(now); self.hour_requests.append(now)
+            return True, "ok"
+    def _check(self, record):
         try:
-            with self._lock:
-                now = datetime.now(); one_minute_ago = now - timedelta(minutes=1); one_hour_ago = now - timedelta(hours=1)
-                while self.minute_requests and self.minute_requests[0] < one_minute_ago: self.minute_requests.popleft()
-                while self.hour_requests and self.hour_requests[0] < one_hour_ago: self.hour_requests.popleft()
-                if len(self.minute_requests) >= self.max_per_minute: return False, "minute_limit"
-                if len(self.hour_requests) >= self.max_per_hour: return False, "hour_limit"
-                return True, "ok"
-        except Exception: return True, "ok"
-    def record_request(self):
+            if self.store is not None: return self.store.transaction(lambda conn: self._shared_check(conn, record))
+            return self._local_check(record)
+        except Exception as e: logger.warning(f"Rate limiter check failed: {e}"); return True, "ok"
+    def can_make_request(self): return self._check(record=False)
+    def try_acquire(self):
+        """Атомарно проверяет лимит и, если он не исчерпан, учитывает запрос. Возвращает (ok, reason)."""
+        return self._check(record=True)
+
+# --- Тайминги фаз запроса (Server-Timing, журнал медленных запросов) ---
+class _Span:
+    __slots__ = ('spans', 'name', 'started')
+    def __init__(self, spans, name): self.spans = spans; self.name = name
+    def __enter__(self): self.started = time.perf_counter(); return self
+    def __exit__(self, *exc): self.spans.append((self.name, time.perf_counter() - self.started))
+
+_NULL_SPAN = contextlib.nullcontext()
+
+def timing_span(name):
+    """Замер фазы текущего запроса. Вне запроса или при выключенных таймингах - пустой контекст без затрат."""
+    spans = g.get('spans') if has_request_context() else None
+    return _NULL_SPAN if spans is None else _Span(spans, name)
+
+def merge_spans(spans):
+    """[(имя, сек)] -> [(имя, сек)] с суммированием повторов, в порядке первого появления."""
+    merged = {}
+    for name, seconds in spans: merged[name] = merged.get(name, 0.0) + seconds
+    return list(merged.items())
+
+# --- Профилировщик по выборкам стеков (для /admin/profile) ---
+def _original(module, name, default):
+    """Оригинал функции, подменённой gevent monkey patching (настоящие потоки ОС и sleep)."""
+    if 'gevent' not in sys.modules: return default
+    from gevent import monkey
+    return monkey.get_original(module, name)
+
+_MAIN_THREAD_IDENT = _original('_thread', 'get_ident', _thread.get_ident)()  # модуль импортируется в главном потоке ОС; fork его сохраняет
+
+class SamplingProfiler:
+    """
+    Раз в interval секунд снимает стеки всех потоков ОС (sys._current_frames) из отдельного настоящего
+    потока ОС: под gevent обычный поток был бы гринлетом и не получал бы управления, пока занят CPU.
+    Под gevent все гринлеты живут в одном потоке ОС, поэтому выборка показывает выполняющийся сейчас
+    гринлет; ожидание в цикле событий gevent помечается как (idle). Результат - collapsed stacks
+    ("кадр;кадр;... число"), которые понимают flamegraph.pl и speedscope. Без запуска затрат нет.
+    """
+    def __init__(self):
+        self._lock = threading.Lock(); self.running = False
+
+    @staticmethod
+    def _frame_label(code): return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _sample(self, counts, own_ident, thread_names):
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident: continue
+            stack = []
+            while frame is not None: stack.append(self._frame_label(frame.f_code)); frame = frame.f_back
+            if stack and stack[0].startswith(('run (hub.py', 'wait (hub.py', 'switch (hub.py')): stack = [stack[-1], '(idle)']
+            else: stack.reverse()
+            key = ';'.join([thread_names.get(ident, f"thread-{ident}")] + stack)
+            counts[key] = counts.get(key, 0) + 1
+
+    def profile(self, seconds, interval):
+        """Профилирует seconds секунд; возвращает (collapsed stacks, число выборок) или None, если профилирование уже идёт."""
+        with self._lock:
+            if self.running: return None
+            self.running = True
+        counts = {}; state = {"samples": 0, "stop": False, "done": False}
+        real_sleep = _original('time', 'sleep', time.sleep); get_ident = _original('_thread', 'get_ident', _thread.get_ident)
+        thread_names = {t.ident: t.name for t in threading.enumerate() if t.ident is not None}; thread_names[_MAIN_THREAD_IDENT] = 'main'
+        def sampler():
+            own_ident = get_ident()
+            try:
+                while not state["stop"]:
+                    self._sample(counts, own_ident, thread_names); state["samples"] += 1; real_sleep(interval)
+            finally: state["done"] = True
         try:
-            with self._lock: now = datetime.now(); self.minute_requests.append(now); self.hour_requests.append(now)
-        except Exception: pass
+            _original('_thread', 'start_new_thread', _thread.start_new_thread)(sampler, ())
+            time.sleep(seconds)  # под gevent - кооперативный sleep: запрос не блокирует worker
+            state["stop"] = True
+            while not state["done"]: time.sleep(interval)
+        finally:
+            state["stop"] = True; self.running = False
+        collapsed = "\n".join(f"{stack} {count}" for stack, count in sorted(counts.items(), key=lambda item: -item[1]))
+        return collapsed, state["samples"]
 
-# --- Google Drive Cache (ИСПРАВЛЕННАЯ ВЕРСИЯ С ПАГИНАЦИЕЙ) ---
-class GoogleDriveCache:
+profiler = SamplingProfiler()
+
+# --- Single-flight: объединение одновременных запросов одного ключа ---
+class _InflightCall:
+    __slots__ = ('event', 'result', 'error')
+    def __init__(self): self.event = threading.Event(); self.result = None; self.error = None
+
+class SingleFlight:
+    """
+    Для каждого ключа одновременно выполняется только один вызов fn.
+    Остальные вызывающие с тем же ключом ждут его завершения и получают тот же результат (или исключение).
+    """
     def __init__(self):
+        self._calls = {}; self._lock = threading.Lock()
+    def do(self, key, fn):
+        """Возвращает (result, shared); shared=True, если результат получен от чужого вызова."""
+        call, leader = self.acquire(key)
+        if not leader: return self.wait(call), True
+        try:
+            result = fn()
+            self.release(key, call, result=result)
+            return result, False
+        except Exception as e:
+            self.release(key, call, error=e); raise
+    def acquire(self, key):
+        """
+        Для вызовов, которые завершаются позже, чем возвращает функция (например, потоковый ответ):
+        возвращает (call, leader). Лидер обязан вызвать release(), остальные ждут через wait(call).
+        """
+        with self._lock:
+            call = self._calls.get(key); leader = call is None
+            if leader: call = self._calls[key] = _InflightCall()
+        return call, leader
+    def release(self, key, call, result=None, error=None):
+        call.result = result; call.error = error
+        with self._lock:
+            if self._calls.get(key) is call: del self._calls[key]
+        call.event.set()
+    def wait(self, call):
+        call.event.wait()
+        if call.error is not None: raise call.error
+        return call.result
+
+# --- Очередь генерации TTS: пул worker'ов, приоритеты, повторы с экспоненциальной задержкой ---
+class GenerationError(Exception):
+    """
+    Неудачная попытка генерации. retryable=False - повторять бессмысленно; retry_after - минимальная пауза (сек);
+    counts_as_failure=False - неудача не связана с самим текстом (например, лимит) и не пишется в историю.
+    """
+    def __init__(self, message, retryable=True, retry_after=0, counts_as_failure=True):
+        super().__init__(message); self.retryable = retryable; self.retry_after = retry_after; self.counts_as_failure = counts_as_failure
+
+def _process_alive(pid):
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except (OSError, TypeError): return True
+    return True
+
+class GenerationJob:
+    __slots__ = ('id', 'filename', 'lang', 'text', 'priority', 'status', 'attempts', 'error', 'created_at', 'finished_at', 'next_attempt_at')
+    def __init__(self, filename, lang, text, priority, job_id=None):
+        self.id = job_id or uuid.uuid4().hex; self.filename = filename; self.lang = lang; self.text = text; self.priority = priority
+        self.status = 'queued'; self.attempts = 0; self.error = None; self.created_at = time.time(); self.finished_at = None; self.next_attempt_at = 0
+    @property
+    def finished(self): return self.status in ('done', 'failed')
+    def to_dict(self):
+        return {"job_id": self.id, "status": self.status, "attempts": self.attempts, "error": self.error, "url": f"/audio/{self.filename}" if self.status == 'done' else None,
+                "created_at": datetime.fromtimestamp(self.created_at).isoformat(), "next_attempt_at": datetime.fromtimestamp(self.next_attempt_at).isoformat() if self.status == 'retrying' else None}
+
+class GenerationQueue:
+    """
+    Очередь заданий генерации аудио с пулом из workers потоков (под gevent - гринлетов).
+    Задания с одинаковым именем файла объединяются; интерактивные запросы (PRIORITY_INTERACTIVE)
+    обслуживаются раньше прогрева (PRIORITY_WARMUP). Неудачные попытки повторяются до max_attempts раз
+    с задержкой base_delay * 2^(n-1), где n - число неудач этого текста по истории failures.
+    История ограничена max_failures записями.
+    Задания живут в памяти worker'а, который их создал; с store их состояние копируется в общую
+    SQLite, и get()/wait() на другом worker'е работают по этой копии. Задание завершившегося
+    worker'а ставится в очередь заново тем, кто его запросил.
+    """
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_WARMUP = 10
+
+    REMOTE_POLL_INTERVAL = 0.05  # сек, опрос общего хранилища при ожидании чужого задания (чтение WAL без блокировок)
+
+    def __init__(self, handler, workers=2, max_attempts=4, base_delay=5.0, max_delay=300.0, job_ttl=600, max_failures=1000, store=None):
+        self.handler = handler; self.workers = workers; self.max_attempts = max_attempts; self.store = store; self._store_expired_at = 0.0
+        self.base_delay = base_delay; self.max_delay = max_delay; self.job_ttl = job_ttl; self.max_failures = max_failures
+        self.failures = OrderedDict()  # "lang:text" -> (время последней неудачи, число неудач подряд)
+        self._jobs = {}; self._active = {}; self._ready = []; self._delayed = []; self._seq = 0
+        self._cond = threading.Condition(); self._pid = None
+
+    def _ensure_workers(self):
+        # Потоки не переживают fork, поэтому пул запускается лениво в каждом процессе
+        if self._pid == os.getpid(): return
+        self._pid = os.getpid()
+        for i in range(self.workers): threading.Thread(target=self._worker_loop, name=f"tts-generation-{i}", daemon=True).start()
+
+    def _backoff(self, failures): return min(self.base_delay * 2 ** max(failures - 1, 0), self.max_delay)
+    def _push_locked(self, job, not_before=0):
+        self._seq += 1
+        if not_before > time.time(): job.status = 'retrying' if job.attempts else 'queued'; job.next_attempt_at = not_before; heapq.heappush(self._delayed, (not_before, self._seq, job))
+        else: job.status = 'queued'; heapq.heappush(self._ready, (job.priority, self._seq, job))
+        self._cond.notify_all()
+
+    def submit(self, filename, lang, text, priority=PRIORITY_INTERACTIVE, job_id=None):
+        """Ставит генерацию в очередь. Возвращает (job, coalesced): coalesced=True, если задание уже было в очереди."""
+        self._ensure_workers()
+        job, coalesced = self._submit(filename, lang, text, priority, job_id)
+        if not coalesced: self._publish(job); self._expire_store()
+        return job, coalesced
+    def _submit(self, filename, lang, text, priority, job_id):
+        with self._cond:
+            self._expire_locked()
+            job = self._active.get(filename)
+            if job is not None:
+                if priority < job.priority:
+                    job.priority = priority
+                    if job.status == 'queued': self._push_locked(job)  # старая запись в куче будет пропущена как устаревшая
+                return job, True
+            job = GenerationJob(filename, lang, text, priority, job_id)
+            self._jobs[job.id] = job; self._active[filename] = job
+            last_failed_at, failures = self.failures.get(f"{lang}:{text}", (0, 0))
+            self._push_locked(job, last_failed_at + self._backoff(failures) if failures else 0)
+            return job, False
+
+    def get(self, job_id):
+        """Своё задание - из памяти; чужое - снимок из store (задание умершего worker'а при этом ставится в очередь здесь)."""
+        with self._cond: job = self._jobs.get(job_id)
+        if job is not None or self.store is None: return job
+        job, pid = self._load(job_id)
+        if job is not None and not job.finished and pid != os.getpid() and not _process_alive(pid):
+            logger.info(f"♻️ Job {job_id} belonged to exited worker {pid}, requeued here")
+            job, _ = self.submit(job.filename, job.lang, job.text, job.priority, job_id=job.id)
+        return job
+
+    def wait(self, job, timeout, until_attempt=False):
+        """
+        Ждёт завершения задания не дольше timeout секунд. until_attempt=True - достаточно окончания
+        текущей попытки (синхронные клиенты не ждут повторов). Возвращает True, если задание завершено.
+        """
+        deadline = time.monotonic() + timeout; attempts = job.attempts
+        with self._cond: local = self._jobs.get(job.id) is job
+        if not local: return self._wait_remote(job, deadline, attempts, until_attempt)
+        with self._cond:
+            while not job.finished and not (until_attempt and job.attempts > attempts):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: break
+                self._cond.wait(remaining)
+            return job.finished
+    def _wait_remote(self, job, deadline, attempts, until_attempt):
+        """Ожидание снимка чужого задания: перечитывает его из store, обновляя job на месте."""
+        while not job.finished and not (until_attempt and job.attempts > attempts):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: break
+            time.sleep(min(self.REMOTE_POLL_INTERVAL, remaining))
+            fresh, _ = self._load(job.id)
+            if fresh is not None:
+                for field in GenerationJob.__slots__: setattr(job, field, getattr(fresh, field))
+        return job.finished
+
+    def _publish(self, job):
+        """Копирует состояние задания в store. Завершённое задание не перезаписывается устаревшим состоянием."""
+        if self.store is None: return
+        try:
+            self.store.execute("INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET priority = excluded.priority, status = excluded.status, "
+                               "attempts = excluded.attempts, error = excluded.error, finished_at = excluded.finished_at, next_attempt_at = excluded.next_attempt_at, pid = excluded.pid "
+                               "WHERE jobs.status NOT IN ('done', 'failed')",
+                               (job.id, job.filename, job.lang, job.text, job.priority, job.status, job.attempts, job.error, job.created_at, job.finished_at, job.next_attempt_at, os.getpid()))
+        except Exception as e: logger.warning(f"Could not publish job {job.id}: {e}")
+    def _load(self, job_id):
+        """(снимок задания, pid владельца) из store или (None, None)."""
+        try: rows = self.store.execute("SELECT filename, lang, text, priority, status, attempts, error, created_at, finished_at, next_attempt_at, pid FROM jobs WHERE id = ?", (job_id,))
+        except Exception as e: logger.warning(f"Could not load job {job_id}: {e}"); return None, None
+        if not rows: return None, None
+        filename, lang, text, priority, status, attempts, error, created_at, finished_at, next_attempt_at, pid = rows[0]
+        job = GenerationJob(filename, lang, text, priority, job_id)
+        job.status = status; job.attempts = attempts; job.error = error; job.created_at = created_at; job.finished_at = finished_at; job.next_attempt_at = next_attempt_at or 0
+        return job, pid
+    def _expire_store(self):
+        if self.store is None or time.monotonic() - self._store_expired_at < 60: return
+        self._store_expired_at = time.monotonic(); now = time.time()
+        try: self.store.execute("DELETE FROM jobs WHERE finished_at < ? OR created_at < ?", (now - self.job_ttl, now - 86400))
+        except Exception as e: logger.warning(f"Could not expire jobs: {e}")
+
+    def _expire_locked(self):
+        cutoff = time.time() - self.job_ttl
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished_at < cutoff]: del self._jobs[job_id]
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, _, job = heapq.heappop(self._delayed); self._push_locked(job)
+                while self._ready:
+                    priority, _, job = heapq.heappop(self._ready)
+                    if job.status == 'queued' and priority == job.priority: job.status = 'running'; return job
+                self._cond.wait(self._delayed[0][0] - now if self._delayed else None)
+
+    def _worker_loop(self):
+        while True:
+            job = self._next_job(); key = f"{job.lang}:{job.text}"; self._publish(job)
+            try:
+                self.handler(job)
+                with self._cond: self.failures.pop(key, None); job.status = 'done'
+            except Exception as e:
+                with self._cond:
+                    job.attempts += 1; job.error = str(e); failures = job.attempts
+                    if getattr(e, 'counts_as_failure', True):
+                        _, failures = self.failures.pop(key, (0, 0)); failures += 1; self.failures[key] = (time.time(), failures)
+                        while len(self.failures) > self.max_failures: self.failures.popitem(last=False)
+                    if getattr(e, 'retryable', True) and job.attempts < self.max_attempts:
+                        delay = max(self._backoff(failures), getattr(e, 'retry_after', 0))
+                        logger.info(f"🔁 Generation of {job.filename} failed ({e}), retry {job.attempts}/{self.max_attempts - 1} in {delay:.1f}s")
+                        self._push_locked(job, time.time() + delay)
+                    else: job.status = 'failed'
+            finally:
+                with self._cond:
+                    if job.finished: job.finished_at = time.time(); self._active.pop(job.filename, None)
+                    self._cond.notify_all()
+                self._publish(job)
+
+    def stats(self):
+        with self._cond:
+            counts = {}
+            for job in self._jobs.values(): counts[job.status] = counts.get(job.status, 0) + 1
+            return {"workers": self.workers, "ready": len(self._ready), "delayed": len(self._delayed), "jobs": counts, "failure_history": len(self.failures)}
+
+# --- TTS-бэкенды: gTTS, офлайн-движок (espeak-ng) и детерминированный mock ---
+class TTSBackend:
+    """
+    Движок синтеза речи. synthesize() возвращает байты MP3 или бросает GenerationError.
+    Одновременно выполняется не больше max_concurrency синтезов; timeout ограничивает и ожидание
+    свободного слота, и сам синтез (под gevent - через gevent.Timeout).
+    """
+    name = 'base'
+    def __init__(self, max_concurrency=1, timeout=30.0):
+        self.max_concurrency = max_concurrency; self.timeout = timeout; self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._slot_waits = 0; self._slot_wait_seconds = 0.0; self._slot_wait_max = 0.0
+    def supports(self, lang): return True
+    def synthesize(self, text, lang):
+        started = time.perf_counter(); acquired = self._slots.acquire(timeout=self.timeout); waited = time.perf_counter() - started
+        self._slot_waits += 1; self._slot_wait_seconds += waited; self._slot_wait_max = max(self._slot_wait_max, waited)
+        if not acquired: raise GenerationError(f"{self.name}: no free synthesis slot", retry_after=self.timeout, counts_as_failure=False)
+        timer = _gevent_timeout(self.timeout)
+        try:
+            if timer is not None: timer.start()
+            return self._synthesize(text, lang)
+        except GenerationError: raise
+        except subprocess.TimeoutExpired: raise GenerationError(f"{self.name}: timed out after {self.timeout}s")
+        except Exception as e: raise GenerationError(f"{self.name}: {e}") from e
+        except BaseException as e:
+            if e is timer: raise GenerationError(f"{self.name}: timed out after {self.timeout}s")
+            raise
+        finally:
+            if timer is not None: timer.close()
+            self._slots.release()
+    def _synthesize(self, text, lang): raise NotImplementedError
+    def stats(self):
+        avg_wait = self._slot_wait_seconds / self._slot_waits if self._slot_waits else 0.0
+        return {"name": self.name, "max_concurrency": self.max_concurrency, "timeout": self.timeout,
+                "slot_wait_avg_ms": round(avg_wait * 1000, 2), "slot_wait_max_ms": round(self._slot_wait_max * 1000, 2)}
+
+def _gevent_timeout(seconds):
+    """gevent.Timeout, если процесс работает под gevent (monkey patching), иначе None."""
+    if 'gevent' not in sys.modules: return None
+    from gevent import monkey, Timeout
+    return Timeout(seconds) if monkey.is_module_patched('socket') else None
+
+class GTTSBackend(TTSBackend):
+    """Google Translate TTS (сеть, квота). Квота контролируется общим SmartTTSRateLimiter; GTTS_TIMEOUT передаётся и в сам gTTS."""
+    name = 'gtts'
+    def __init__(self, limiter, **kwargs):
+        super().__init__(**kwargs); self.limiter = limiter
+    def supports(self, lang): return lang in Config.SUPPORTED_LANGUAGES
+    def _synthesize(self, text, lang):
+        can_request, reason = self.limiter.try_acquire()
+        if not can_request:
+            logger.warning(f"⏳ Rate limit: {reason}")
+            raise GenerationError(f"Rate limit: {reason}", retry_after=60 if reason == 'minute_limit' else 600, counts_as_failure=False)
+        from gtts import gTTS
+        # timeout есть у gTTS начиная с 2.5: таймаут HTTP-запроса, а не только gevent.Timeout вокруг синтеза
+        options = {'timeout': self.timeout} if 'timeout' in inspect.signature(gTTS).parameters else {}
+        try: tts = gTTS(text=text, lang=lang, slow=False, **options); in_memory_file = BytesIO(); tts.write_to_fp(in_memory_file)
+        except Exception as e:
+            if any(k in str(e).lower() for k in ['quota', 'limit', '429']): logger.error("🚫 TTS quota exceeded"); raise GenerationError(f"TTS quota exceeded: {e}", retry_after=600)
+            raise
+        return in_memory_file.getvalue()
+
+class EspeakBackend(TTSBackend):
+    """
+    Офлайн-синтез: espeak-ng пишет WAV в stdout, затем lame или ffmpeg кодирует его в MP3.
+    Каждый синтез - отдельная пара процессов; их число ограничено max_concurrency.
+    """
+    name = 'espeak'
+    VOICES = {'de': 'de', 'ru': 'ru', 'en': 'en', 'fr': 'fr', 'es': 'es'}
+    def __init__(self, command='espeak-ng', **kwargs):
+        super().__init__(**kwargs); self.command = shutil.which(command) or shutil.which('espeak')
+        self.encoder = [shutil.which('lame'), '--quiet', '-', '-'] if shutil.which('lame') else [shutil.which('ffmpeg'), '-loglevel', 'error', '-i', 'pipe:0', '-f', 'mp3', 'pipe:1'] if shutil.which('ffmpeg') else None
+        if not self.command or not self.encoder: logger.warning("⚠️ espeak backend unavailable: espeak-ng and lame/ffmpeg are required")
+    def supports(self, lang): return bool(self.command and self.encoder) and lang in self.VOICES
+    def _synthesize(self, text, lang):
+        # Текст - через stdin: в argv текст, начинающийся с '-', espeak прочитал бы как опцию (-f файл, -w путь)
+        wav = subprocess.run([self.command, '-v', self.VOICES[lang], '--stdout', '--stdin'], input=text.encode('utf-8'), capture_output=True, timeout=self.timeout, check=True).stdout
+        return subprocess.run(self.encoder, input=wav, capture_output=True, timeout=self.timeout, check=True).stdout
+
+class MockBackend(TTSBackend):
+    """
+    Детерминированный бэкенд для нагрузочных тестов: через latency секунд возвращает MP3 из frames
+    тихих кадров (MPEG-2 Layer III, 24 кГц, моно, 32 кбит/с - как у gTTS) одинакового размера.
+    """
+    name = 'mock'
+    SILENT_FRAME = bytes([0xFF, 0xF3, 0x44, 0xC0]) + bytes(92)  # 96 байт = 24 мс тишины
+    def __init__(self, latency=0.0, frames=40, **kwargs):
+        super().__init__(**kwargs); self.latency = latency; self.frames = frames
+    def _synthesize(self, text, lang):
+        if self.latency: time.sleep(self.latency)
+        return self.SILENT_FRAME * self.frames
+
+def build_tts_backends(names, limiter):
+    """Создаёт бэкенды в порядке приоритета из строки вида "gtts,espeak"."""
+    factories = {
+        'gtts': lambda: GTTSBackend(limiter, max_concurrency=Config.GTTS_CONCURRENCY, timeout=Config.GTTS_TIMEOUT),
+        'espeak': lambda: EspeakBackend(Config.ESPEAK_COMMAND, max_concurrency=Config.ESPEAK_CONCURRENCY, timeout=Config.ESPEAK_TIMEOUT),
+        'mock': lambda: MockBackend(Config.MOCK_TTS_LATENCY, Config.MOCK_TTS_FRAMES, max_concurrency=Config.MOCK_TTS_CONCURRENCY, timeout=max(Config.MOCK_TTS_LATENCY * 10, 5)),
+    }
+    backends = []
+    for name in (n.strip() for n in names.split(',') if n.strip()):
+        if name in factories: backends.append(factories[name]())
+        else: logger.error(f"Unknown TTS backend '{name}' ignored")
+    return backends
+
+# --- Google Drive Cache (пагинация + общий для worker'ов снимок индекса) ---
+class GoogleDriveCache:
+    """
+    Индекс файлов папки Google Drive (имя -> file id).
+    Индекс сохраняется в локальный снимок (Config.GDRIVE_INDEX_FILE), общий для всех worker'ов:
+    полный листинг папки выполняется только если снимка нет, дальше индекс догоняется через
+    changes API начиная с сохранённого токена. Снимок пишется атомарно и читается без блокировок;
+    с Drive в каждый момент синхронизируется только один worker, остальные пользуются текущим снимком.
+    """
+    def __init__(self, service_factory=None, index_path=None, refresh_interval=None):
         self.gdrive_enabled = False; self.service = None; self.folder_id = None; self.file_cache = {}; self._init_lock = threading.Lock(); self._initialized = False
-    def _initialize(self):
+        self._service_factory = service_factory; self.index_path = index_path or Config.GDRIVE_INDEX_FILE
+        self.refresh_interval = Config.GDRIVE_REFRESH_INTERVAL if refresh_interval is None else refresh_interval
+        self.start_page_token = None; self.synced_at = 0; self._refresher_pid = None; self._service_pid = None; self._media_session = None; self._media_session_pid = None
+    def _build_service(self):
+        if self._service_factory: return self._service_factory()
+        if Config.GDRIVE_FAKE_DIR:
+            from fake_drive import FakeDriveService
+            logger.warning(f"🧪 Using fake Google Drive backed by {Config.GDRIVE_FAKE_DIR}")
+            return FakeDriveService.from_directory(Config.GDRIVE_FAKE_DIR, Config.FOLDER_ID or FakeDriveService.DEFAULT_FOLDER_ID)
+        if not (Config.FOLDER_ID and os.path.exists(Config.CREDENTIALS_FILE)): return None
+        from googleapiclient.discovery import build
+        from google.oauth2.service_account import Credentials
+        creds = Credentials.from_service_account_file(Config.CREDENTIALS_FILE, scopes=Config.SCOPES)
+        return build('drive', 'v3', credentials=creds)
+    def _client(self):
+        """Клиент Drive этого процесса: соединения httplib2 нельзя делить с другими процессами, после fork клиент создаётся заново."""
+        if self._service_pid != os.getpid(): self.service = self._build_service(); self._service_pid = os.getpid()
+        return self.service
+    def _initialize(self, start_refresher=True):
         with self._init_lock:
             if self._initialized: return
             if not GDRIVE_AVAILABLE: logger.warning("⚠️ Google Drive libraries not installed. Local-only mode."); self._initialized = True; return
             try:
-                if Config.FOLDER_ID and os.path.exists(Config.CREDENTIALS_FILE):
-                    creds = Credentials.from_service_account_file(Config.CREDENTIALS_FILE, scopes=Config.SCOPES)
-                    self.service = build('drive', 'v3', credentials=creds)
-                    self.folder_id = Config.FOLDER_ID
-                    self._populate_cache()
+                service = self._client()
+                if service is not None:
+                    self.folder_id = Config.FOLDER_ID or getattr(service, 'folder_id', None)
+                    self._sync_index()
                     self.gdrive_enabled = True; logger.info("☁️ Google Drive connected successfully")
+                    if start_refresher: self._start_refresher()
                 else: logger.warning("⚠️ Google Drive not configured. Local-only mode.")
             except Exception as e: logger.error(f"❌ Google Drive initialization error: {e}"); logger.info("🔄 Switching to local-only mode")
             finally: self._initialized = True
-            
-    def _populate_cache(self):
+
+    # --- Снимок индекса на диске ---
+    def _sync_lock(self, wait):
+        """
+        Межпроцессная блокировка синхронизации с Drive (flock на соседнем .lock файле). Берётся только
+        неблокирующими попытками: gevent не патчит flock, и ждущий worker иначе замер бы целиком на время
+        сетевых вызовов другого. wait=True - повторять попытки, засыпая между ними (под gevent sleep
+        уступает управление). Возвращает файл блокировки или None, если она занята и wait=False.
+        """
+        lock_file = open(f"{self.index_path}.lock", "a+")
+        while True:
+            try: fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB); return lock_file
+            except BlockingIOError:
+                if not wait: lock_file.close(); return None
+                time.sleep(0.1)
+    def _read_snapshot(self):
         try:
-            logger.info("📥 Loading file list from Google Drive (all pages)...")
-            page_token = None
+            with open(self.index_path, 'r', encoding='utf-8') as f: snapshot = json.load(f)
+        except (OSError, ValueError): return None
+        if snapshot.get('folder_id') != self.folder_id or not snapshot.get('start_page_token'): return None
+        return snapshot
+    def _write_snapshot(self):
+        snapshot = {"folder_id": self.folder_id, "start_page_token": self.start_page_token, "synced_at": self.synced_at, "files": self.file_cache}
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(snapshot, f)
+        os.replace(tmp_path, self.index_path)
+    def _adopt_snapshot(self, snapshot):
+        self.file_cache = snapshot['files']; self.start_page_token = snapshot['start_page_token']; self.synced_at = snapshot.get('synced_at', 0)
+
+    def _sync_index(self, force=False):
+        """
+        Приводит индекс в актуальное состояние: снимок моложе refresh_interval используется как есть,
+        старый снимок догоняется через changes API, при отсутствии снимка выполняется полный листинг.
+        Если синхронизацию уже выполняет другой процесс, используется текущий снимок (без снимка - ждём его).
+        """
+        snapshot = self._read_snapshot()
+        if snapshot:
+            self._adopt_snapshot(snapshot)
+            if not force and time.time() - self.synced_at < self.refresh_interval:
+                logger.info(f"📂 Google Drive index loaded from snapshot: {len(self.file_cache)} files"); return
+        lock_file = self._sync_lock(wait=force or snapshot is None)
+        if lock_file is None: return  # снимок обновляет другой worker, подхватим его при следующем обновлении
+        try:
+            snapshot = self._read_snapshot()  # мог обновиться, пока ждали блокировку
+            if snapshot:
+                self._adopt_snapshot(snapshot)
+                if not force and time.time() - self.synced_at < self.refresh_interval:
+                    logger.info(f"📂 Google Drive index loaded from snapshot: {len(self.file_cache)} files"); return
+                self._apply_changes()
+            else:
+                # Токен берём ДО листинга, чтобы не потерять изменения, сделанные во время листинга
+                token = self._client().changes().getStartPageToken().execute().get('startPageToken')
+                self.file_cache = self._populate_cache(); self.start_page_token = token
+            self.synced_at = time.time()
+            self._write_snapshot()
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN); lock_file.close()
+
+    def _populate_cache(self):
+        """Полный листинг папки. Возвращает новый словарь имя -> id (исключения пробрасываются)."""
+        logger.info("📥 Loading file list from Google Drive (all pages)...")
+        files = {}; page_token = None
+        while True:
+            # 'nextPageToken' в fields нужен для получения токена следующей страницы
+            response = self._client().files().list(
+                q=f"'{self.folder_id}' in parents and trashed=false",
+                fields="nextPageToken, files(id, name)",
+                pageSize=1000,
+                pageToken=page_token
+            ).execute()
+
+            for file in response.get('files', []):
+                files[file.get('name')] = file.get('id')
+
+            # Если следующей страницы нет - выходим из цикла
+            page_token = response.get('nextPageToken', None)
+            if page_token is None:
+                break
+
+        logger.info(f"✅ Found {len(files)} files in Google Drive cache")
+        return files
+
+    def _apply_changes(self):
+        """Догоняет индекс изменениями Drive с момента start_page_token."""
+        files = dict(self.file_cache); names_by_id = {file_id: name for name, file_id in files.items()}
+        page_token = self.start_page_token; applied = 0
+        while page_token:
+            response = self._client().changes().list(
+                pageToken=page_token, spaces='drive', pageSize=1000,
+                fields="nextPageToken, newStartPageToken, changes(fileId, removed, file(name, parents, trashed))"
+            ).execute()
+            for change in response.get('changes', []):
+                file_id = change.get('fileId'); file = change.get('file') or {}
+                old_name = names_by_id.pop(file_id, None)
+                if old_name is not None: files.pop(old_name, None)
+                if not change.get('removed') and not file.get('trashed') and self.folder_id in file.get('parents', []):
+                    files[file['name']] = file_id; names_by_id[file_id] = file['name']
+                applied += 1
+            if 'newStartPageToken' in response: self.start_page_token = response['newStartPageToken']; break
+            page_token = response.get('nextPageToken')
+        self.file_cache = files
+        logger.info(f"🔄 Google Drive index synced: {applied} changes applied, {len(files)} files")
+
+    def refresh(self, force=False):
+        """Обновляет индекс (см. _sync_index). Ошибки логируются, старый индекс остаётся в силе."""
+        if not self.gdrive_enabled: return False
+        try: self._sync_index(force=force); return True
+        except Exception as e: logger.error(f"Error refreshing Google Drive index: {e}"); return False
+    def _start_refresher(self):
+        """Фоновое периодическое обновление индекса. Запускается в каждом процессе отдельно (потоки не переживают fork)."""
+        if not self.refresh_interval or self._refresher_pid == os.getpid(): return
+        self._refresher_pid = os.getpid()
+        def loop():
             while True:
-                # <--- ИЗМЕНЕНИЕ 1: Добавляем 'nextPageToken' в fields для получения токена следующей страницы.
-                response = self.service.files().list(
-                    q=f"'{self.folder_id}' in parents and trashed=false",
-                    fields="nextPageToken, files(id, name)",
-                    pageSize=1000,
-                    pageToken=page_token
-                ).execute()
-
-                for file in response.get('files', []):
-                    self.file_cache[file.get('name')] = file.get('id')
-
-                # <--- ИЗМЕНЕНИЕ 2: Проверяем, есть ли следующая страница. Если нет - выходим из цикла.
-                page_token = response.get('nextPageToken', None)
-                if page_token is None:
-                    break 
-
-            logger.info(f"✅ Found {len(self.file_cache)} files in Google Drive cache")
-        except Exception as e: 
-            logger.error(f"Error loading cache from Google Drive: {e}")
-            
+                time.sleep(self.refresh_interval)
+                self.refresh()
+        threading.Thread(target=loop, name="gdrive-index-refresh", daemon=True).start()
+
     def ensure_initialized(self):
         if not self._initialized: self._initialize()
+    def preload(self):
+        """
+        В master до fork: загружает индекс (снимок или листинг), который worker'ы получают через
+        copy-on-write. Клиент master'а после этого отбрасывается, фоновое обновление не запускается.
+        """
+        self._initialize(start_refresher=False); self.service = None; self._service_pid = None
+    def connect_worker(self):
+        """В worker'е после fork: свой клиент Drive и фоновое обновление индекса."""
+        if not self.gdrive_enabled: return
+        self._client(); self._start_refresher()
     def check_exists(self, filename):
         self.ensure_initialized(); return self.gdrive_enabled and filename in self.file_cache
     def upload(self, in_memory_file, filename):
         logger.error(f"FATAL: Attempted to call upload() for {filename} from production server. This is not allowed."); return False
-    def download_to_stream(self, filename):
+    def iter_download(self, filename, chunk_size=None):
+        """
+        Итератор по кускам файла из Drive: один запрос alt=media, тело читается по chunk_size байт без буферизации всего файла.
+        None, если Drive недоступен или файла нет в индексе; ошибки скачивания выбрасываются при итерации.
+        """
         self.ensure_initialized();
         if not self.gdrive_enabled: return None
         file_id = self.file_cache.get(filename)
         if not file_id: return None
+        return self._iter_chunks(file_id, chunk_size or Config.GDRIVE_CHUNK_SIZE)
+    def _iter_chunks(self, file_id, chunk_size):
+        request = self._client().files().get_media(fileId=file_id)
+        credentials = getattr(request.http, 'credentials', None)
+        if credentials is None:  # транспорт без OAuth (fake_drive): httplib2 читает ответ целиком, отдаём его одним куском
+            response, body = request.http.request(request.uri, headers=request.headers)
+            if response.status != 200: raise IOError(f"Drive download failed: HTTP {response.status}")
+            yield body; return
+        with self._session(credentials).get(request.uri, stream=True, timeout=Config.GDRIVE_DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            yield from response.iter_content(chunk_size)
+    def _session(self, credentials):
+        """requests-сессия этого процесса для потокового скачивания (httplib2 не умеет отдавать тело по частям)."""
+        if self._media_session_pid != os.getpid():
+            from google.auth.transport.requests import AuthorizedSession
+            self._media_session = AuthorizedSession(credentials); self._media_session_pid = os.getpid()
+        return self._media_session
+
+# --- Локальный кэш аудио: in-memory индекс и LRU-вытеснение по объёму ---
+class LocalAudioCache:
+    """
+    Индекс файлов LOCAL_CACHE_DIR в памяти: имя -> [размер, время последнего доступа] в порядке LRU.
+    Проверка попадания не трогает файловую систему. Когда суммарный объём превышает max_bytes,
+    удаляются давно не использованные файлы. Индекс строится одним проходом scandir при старте.
+    Файлы пишутся через временный файл и rename, поэтому читатели никогда не видят недописанный MP3.
+    С store (SharedStateStore) учёт общий для всех worker'ов: каждый файл - строка cache_files, общий
+    объём - в meta, вытеснение выбирает самые давние файлы любого worker'а. Каталог сканирует только
+    master при старте; worker'ы берут индекс из таблицы (refresh), а время доступа отправляют в неё
+    пачками не чаще TOUCH_FLUSH_INTERVAL. Файл, вытесненный другим worker'ом, отсеивает exists().
+    """
+    STALE_TMP_SECONDS = 600  # временные файлы старше этого остались от упавших процессов
+    TOUCH_FLUSH_INTERVAL = 30  # сек между записями времени доступа в общую таблицу
+    EVICTION_BATCH = 64
+    def __init__(self, cache_dir, max_bytes=0, store=None):
+        self.cache_dir = Path(cache_dir); self.max_bytes = max_bytes; self.store = store
+        self._index = OrderedDict(); self._total_bytes = 0; self._evictions = 0; self._lock = threading.Lock()
+        self._touched = {}; self._touches_flushed_at = time.monotonic()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.rebuild()
+
+    def rebuild(self):
+        """Строит индекс по каталогу (один scandir); с store заменяет им общую таблицу."""
+        started = time.monotonic(); found = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.tmp'): self._remove_stale_tmp(entry); continue
+                if not entry.name.endswith('.mp3'): continue
+                try: st = entry.stat()
+                except OSError: continue
+                found.append((max(st.st_atime, st.st_mtime), entry.name, st.st_size))
+        found.sort()
+        with self._lock:
+            self._index = OrderedDict((name, [size, ts]) for ts, name, size in found)
+            self._total_bytes = sum(size for _, _, size in found)
+            victims = [] if self.store is not None else self._pop_victims_locked()
+        if self.store is not None:
+            def replace(conn):
+                conn.execute("DELETE FROM cache_files")
+                conn.executemany("INSERT INTO cache_files VALUES (?, ?, ?)", [(name, size, ts) for ts, name, size in found])
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('cache_bytes', ?)", (str(self._total_bytes),))
+                return self._evict_shared(conn)
+            victims = self._shared(replace, [])
+            self._forget(victims)
+        self._unlink(victims)
+        logger.info(f"🗂️ Local cache index rebuilt: {len(found)} files, {self._total_bytes / 1048576:.1f} MB in {(time.monotonic() - started) * 1000:.0f} ms")
+
+    def refresh(self):
+        """Перечитывает индекс из общей таблицы (worker после fork: индекс master'а мог устареть). Без store - ничего."""
+        if self.store is None: return
+        rows = self._shared(lambda conn: conn.execute("SELECT name, size, used_at FROM cache_files ORDER BY used_at").fetchall(), None)
+        if rows is None: return
+        with self._lock:
+            self._index = OrderedDict((name, [size, used_at]) for name, size, used_at in rows)
+            self._total_bytes = sum(size for _, size, _ in rows)
+
+    def path(self, filename): return self.cache_dir / filename
+    def contains(self, filename):
+        """Проверка попадания по индексу (без stat); отмечает файл как недавно использованный."""
+        with self._lock:
+            item = self._index.get(filename)
+            if item is None: return False
+            item[1] = time.time(); self._index.move_to_end(filename)
+            if self.store is None: return True
+            self._touched[filename] = item[1]
+            flush = time.monotonic() - self._touches_flushed_at > self.TOUCH_FLUSH_INTERVAL
+        if flush: self._shared(self._flush_touches)
+        return True
+    def exists(self, filename):
+        """Как contains, но с проверкой диска: файл мог вытеснить другой worker. Пропавший файл убирается из индекса."""
+        if not self.contains(filename): return False
+        if self.path(filename).exists(): return True
+        self.discard(filename); return False
+    def adopt(self, filename):
+        """Добавляет в индекс файл, появившийся на диске помимо этого процесса (например, записанный другим worker'ом)."""
+        size = self.size(filename)
+        if size is None: return False
+        self._add(filename, size); return True
+    def size(self, filename):
+        try: return self.path(filename).stat().st_size
+        except OSError: return None
+    def read(self, filename):
+        try:
+            with open(self.path(filename), 'rb') as f: return f.read()
+        except OSError: return None
+    def open_file(self, filename):
+        """(файл без буфера, смещение, длина) для отдачи через wsgi.file_wrapper; None, если файла нет."""
+        try: f = open(self.path(filename), 'rb', buffering=0)
+        except OSError: return None
+        return f, 0, os.fstat(f.fileno()).st_size
+    def write(self, filename, data):
+        """Атомарно записывает файл в кэш (временный файл + rename) и добавляет его в индекс."""
+        with self.open_writer(filename) as writer: writer.write(data)
+    def open_writer(self, filename):
+        """CacheFileWriter для записи файла по частям (например, при скачивании из Drive)."""
+        return CacheFileWriter(self, filename)
+    def discard(self, filename):
+        self._forget([filename])
+        if self.store is not None: self._shared(lambda conn: self._remove_rows(conn, [filename]))
+
+    def _add(self, filename, size):
+        now = time.time()
+        with self._lock:
+            old = self._index.pop(filename, None)
+            if old: self._total_bytes -= old[0]
+            self._index[filename] = [size, now]; self._total_bytes += size
+            victims = [] if self.store is not None else self._pop_victims_locked(keep=filename)
+        if self.store is not None:
+            def record(conn):
+                self._flush_touches(conn)
+                previous = conn.execute("SELECT size FROM cache_files WHERE name = ?", (filename,)).fetchone()
+                conn.execute("INSERT OR REPLACE INTO cache_files VALUES (?, ?, ?)", (filename, size, now))
+                conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + ? WHERE key = 'cache_bytes'", (size - (previous[0] if previous else 0),))
+                return self._evict_shared(conn, keep=filename)
+            victims = self._shared(record, [])
+            self._forget(victims)
+        self._unlink(victims)
+    def _pop_victims_locked(self, keep=None):
+        victims = []
+        if not self.max_bytes: return victims
+        while self._total_bytes > self.max_bytes and self._index:
+            name, (size, _) = next(iter(self._index.items()))
+            if name == keep: break
+            del self._index[name]; self._total_bytes -= size; victims.append(name)
+        self._evictions += len(victims)
+        return victims
+
+    # Общий учёт (вызывается внутри транзакции store)
+    def _shared(self, fn, default=None):
+        try: return self.store.transaction(fn)
+        except Exception as e: logger.warning(f"Local cache accounting failed: {e}"); return default
+    def _flush_touches(self, conn):
+        with self._lock: touched = self._touched; self._touched = {}; self._touches_flushed_at = time.monotonic()
+        if touched: conn.executemany("UPDATE cache_files SET used_at = MAX(used_at, ?) WHERE name = ?", [(ts, name) for name, ts in touched.items()])
+    def _evict_shared(self, conn, keep=None):
+        """Удаляет из таблицы самые давние файлы, пока общий объём больше max_bytes. Возвращает их имена для unlink."""
+        victims = []
+        if not self.max_bytes: return victims
+        total = int(conn.execute("SELECT value FROM meta WHERE key = 'cache_bytes'").fetchone()[0])
+        while total > self.max_bytes:
+            rows = conn.execute("SELECT name, size FROM cache_files WHERE name != ? ORDER BY used_at LIMIT ?", (keep or '', self.EVICTION_BATCH)).fetchall()
+            if not rows: break
+            for name, size in rows:
+                if total <= self.max_bytes: break
+                victims.append(name); total -= size
+        self._remove_rows(conn, victims)
+        self._evictions += len(victims)
+        return victims
+    def _remove_rows(self, conn, names):
+        if not names: return
+        freed = 0
+        for name in names:
+            row = conn.execute("DELETE FROM cache_files WHERE name = ? RETURNING size", (name,)).fetchone()
+            if row: freed += row[0]
+        conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) - ? WHERE key = 'cache_bytes'", (freed,))
+    def _forget(self, names):
+        with self._lock:
+            for name in names:
+                item = self._index.pop(name, None)
+                if item: self._total_bytes -= item[0]
+
+    def _remove_stale_tmp(self, entry):
+        try:
+            if time.time() - entry.stat().st_mtime > self.STALE_TMP_SECONDS: os.remove(entry.path)
+        except OSError: pass
+    def _unlink(self, victims):
+        for name in victims:
+            try: os.remove(self.path(name))
+            except OSError: pass
+        if victims: logger.info(f"🧹 Evicted {len(victims)} files from local cache")
+
+    def stats(self):
+        if self.store is not None:
+            shared = self._shared(lambda conn: (conn.execute("SELECT COUNT(*) FROM cache_files").fetchone()[0],
+                                                int(conn.execute("SELECT value FROM meta WHERE key = 'cache_bytes'").fetchone()[0])))
+            if shared is not None: return {"backend": "dir", "files": shared[0], "bytes": shared[1], "max_bytes": self.max_bytes, "evictions": self._evictions, "indexed_here": len(self._index)}
+        with self._lock:
+            return {"backend": "dir", "files": len(self._index), "bytes": self._total_bytes, "max_bytes": self.max_bytes, "evictions": self._evictions}
+
+class CacheFileWriter:
+    """
+    Запись одного файла кэша по частям во временный файл рядом с целевым. commit() атомарно
+    переименовывает его и добавляет в индекс, abort() удаляет. Как контекстный менеджер
+    делает commit при успехе и abort при исключении.
+    """
+    def __init__(self, cache, filename):
+        self.cache = cache; self.filename = filename; self.size = 0
+        self.tmp_path = cache.cache_dir / f".{filename}.{os.getpid()}.{threading.get_ident()}.{uuid.uuid4().hex[:8]}.tmp"
+        self._file = open(self.tmp_path, 'wb')
+    def write(self, chunk): self._file.write(chunk); self.size += len(chunk)
+    def commit(self):
+        try: self._file.close(); os.replace(self.tmp_path, self.cache.path(self.filename))
+        except OSError: self.abort(); raise
+        self.cache._add(self.filename, self.size)
+    def abort(self):
+        self._file.close()
+        try: os.remove(self.tmp_path)
+        except OSError: pass
+    def __enter__(self): return self
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None: self.commit()
+        else: self.abort()
+
+# --- Локальный кэш аудио в одном pack-файле ---
+class PackAudioCache:
+    """
+    Тот же интерфейс, что у LocalAudioCache, но все MP3 лежат в одном append-only pack-файле
+    (audio_pack.AudioPack): индекс отображён через mmap и общий для всех worker'ов, поэтому старт
+    не сканирует каталог. Вытеснения нет - повторные записи убирает `audio_pack.py compact`.
+    Записи, дописанные после построения индекса, каждый новый процесс находит сканом хвоста pack'а.
+    Master перестраивает индекс при старте (reindex), но worker'ы, перезапущенные по max_requests,
+    сканируют всё дописанное с тех пор - при активной генерации `audio_pack.py index` стоит запускать по cron.
+    """
+    def __init__(self, pack_path):
+        started = time.monotonic(); self.pack = audio_pack.AudioPack(pack_path); self.cache_dir = Path(os.path.dirname(os.path.abspath(pack_path)))
+        stats = self.pack.stats()
+        logger.info(f"🗂️ Audio pack opened: {stats['indexed']} indexed + {stats['overlay']} unindexed files, {stats['bytes'] / 1048576:.1f} MB in {(time.monotonic() - started) * 1000:.0f} ms")
+    def _location(self, filename):
+        key = audio_pack.filename_to_key(filename)
+        return self.pack.lookup(key) if key is not None else None
+    def contains(self, filename): return self._location(filename) is not None
+    exists = contains  # записи pack'а не вытесняются
+    def refresh(self): self.pack.refresh()
+    def adopt(self, filename):
+        """Подхватывает записи, дописанные другими worker'ами (и замену pack'а после compaction)."""
+        if audio_pack.filename_to_key(filename) is None: return False
+        self.pack.refresh(); return self.contains(filename)
+    def size(self, filename):
+        location = self._location(filename)
+        return location[1] if location else None
+    def read(self, filename):
+        location = self._location(filename)
+        return self.pack.pread(*location) if location else None
+    def open_file(self, filename):
+        location = self._location(filename)
+        if location is None: return None
+        f = self.pack.open_reader()
+        if f is None: return BytesIO(self.pack.pread(*location)), 0, location[1]  # запись целиком в памяти, но из того же pack'а
+        return (f, *location)
+    def reindex(self):
+        """Перестраивает индекс pack'а, если в нём есть неиндексированные записи (вызывается в master до fork)."""
+        if not self.pack.stats()['overlay']: return
+        started = time.monotonic(); count = audio_pack.build_index(self.pack.path); self.pack.reload()
+        logger.info(f"🗂️ Audio pack reindexed: {count} files in {(time.monotonic() - started) * 1000:.0f} ms")
+    def write(self, filename, data):
+        with self.open_writer(filename) as writer: writer.write(data)
+    def open_writer(self, filename): return PackFileWriter(self, filename)
+    def discard(self, filename): pass  # записи pack'а не удаляются по одной
+    def stats(self):
+        return {"backend": "pack", **self.pack.stats(), "max_bytes": 0, "evictions": 0}
+
+class PackFileWriter:
+    """Как CacheFileWriter, но копит куски в памяти и дописывает их в pack одной записью при commit()."""
+    def __init__(self, cache, filename):
+        self.cache = cache; self.filename = filename; self.size = 0; self._chunks = []
+        self._key = audio_pack.filename_to_key(filename)
+        if self._key is None: raise ValueError(f"Pack cache stores only <md5>.mp3 files, got {filename}")
+    def write(self, chunk): self._chunks.append(bytes(chunk)); self.size += len(chunk)
+    def commit(self):
+        data = b''.join(self._chunks); self._chunks = []
+        self.cache.pack.append(self._key, data)
+    def abort(self): self._chunks = []
+    def __enter__(self): return self
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None: self.commit()
+        else: self.abort()
+
+class _FileSlice:
+    """
+    Файл, ограниченный диапазоном [start, end): read() не выходит за end. fileno/seek/tell - самого
+    файла (абсолютные смещения), как ожидает socket.sendfile gunicorn'а: он берёт текущую позицию и
+    Content-Length и отправляет ровно этот кусок pack'а (sendfile(2) с sync-worker'ами, под gevent -
+    чтение и send() по 8 КБ).
+    """
+    def __init__(self, raw, start, end):
+        self.raw = raw; self.end = end; raw.seek(start)
+    def read(self, size=-1):
+        remaining = self.end - self.raw.tell()
+        if remaining <= 0: return b''
+        return self.raw.read(remaining if size is None or size < 0 else min(size, remaining))
+    def fileno(self): return self.raw.fileno()
+    def seek(self, offset, whence=os.SEEK_SET): return self.raw.seek(offset, whence)
+    def tell(self): return self.raw.tell()
+    def close(self): self.raw.close()
+
+# --- Горячий слой аудио в памяти ---
+class MemoryAudioCache:
+    """
+    Ограниченный по объёму LRU-кэш содержимого MP3 в памяти процесса для самых популярных файлов.
+    Файл попадает сюда только на promote_hits-м обращении к диску, чтобы разовые запросы (прогон
+    по словарю, прогрев) не вытесняли действительно горячие файлы. Попадание на диск стоит open и
+    чтения файла кусками: под gevent socket.sendfile - это read()+send() по 8 КБ, а не sendfile(2),
+    так что слой в RAM экономит именно эти системные вызовы.
+    """
+    MAX_TRACKED = 8192  # сколько имён-кандидатов помнит счётчик обращений
+    def __init__(self, max_bytes, max_item_bytes, promote_hits=1):
+        self.max_bytes = max_bytes; self.max_item_bytes = max_item_bytes; self.promote_hits = max(promote_hits, 1)
+        self._items = OrderedDict(); self._total_bytes = 0; self._lock = threading.Lock(); self._hits = OrderedDict(); self._promotions = 0
+    @property
+    def enabled(self): return self.max_bytes > 0
+    def get(self, filename):
+        with self._lock:
+            data = self._items.get(filename)
+            if data is not None: self._items.move_to_end(filename)
+            return data
+    def put(self, filename, data):
+        if not self.enabled or len(data) > self.max_item_bytes: return
+        with self._lock:
+            if filename in self._items: self._items.move_to_end(filename); return
+            self._items[filename] = data; self._total_bytes += len(data)
+            while self._total_bytes > self.max_bytes and self._items:
+                _, evicted = self._items.popitem(last=False); self._total_bytes -= len(evicted)
+    def load(self, filename, source):
+        """
+        Учитывает попадание на диск; на promote_hits-м читает файл из локального кэша source в память,
+        если он помещается в слой. Возвращает данные или None - тогда файл отдаётся с диска.
+        """
+        if not self.enabled or not self._count_hit(filename): return None
+        size = source.size(filename)
+        if size is None or size > self.max_item_bytes: return None
+        data = source.read(filename)
+        if data is None: return None
+        self.put(filename, data); self._promotions += 1; return data
+    def _count_hit(self, filename):
+        with self._lock:
+            hits = self._hits.pop(filename, 0) + 1
+            if hits >= self.promote_hits: return True
+            self._hits[filename] = hits
+            if len(self._hits) > self.MAX_TRACKED: self._hits.popitem(last=False)
+            return False
+    def stats(self):
+        with self._lock: return {"files": len(self._items), "bytes": self._total_bytes, "max_bytes": self.max_bytes, "promote_hits": self.promote_hits, "promotions": self._promotions}
+
+# --- Потоковое восстановление из Google Drive ---
+class DriveRestoreStream:
+    """
+    Итератор по кускам файла, скачиваемого из Google Drive: каждый кусок пишется во временный файл
+    кэша и сразу отдаётся клиенту, так что первый байт не ждёт конца скачивания. После последнего
+    куска файл атомарно переименовывается. Если клиент отключился, close() докачивает файл, чтобы
+    работа не пропала. Запросы того же файла, ждущие в single-flight, освобождаются по завершении.
+    """
+    def __init__(self, tts, filename, chunks, call):
+        self.tts = tts; self.filename = filename; self._chunks = iter(chunks); self._call = call
+        self._writer = tts.local_cache.open_writer(filename); self._started = time.perf_counter()
+        self._pending = None; self._finished = False
+    def prefetch(self):
+        """Скачивает первый кусок до начала ответа, чтобы ошибка Drive не превратилась в оборванный 200."""
+        try: self._pending = self._next_chunk()
+        except StopIteration: pass
+        except Exception: return False
+        return True
+    def _next_chunk(self):
+        try: chunk = next(self._chunks); self._writer.write(chunk); return chunk
+        except StopIteration: self._finish(); raise
+        except Exception as e: self._finish(e); raise
+    def __iter__(self): return self
+    def __next__(self):
+        if self._pending is not None: chunk, self._pending = self._pending, None; return chunk
+        if self._finished: raise StopIteration
+        return self._next_chunk()
+    def close(self):
+        if self._finished: return
         try:
-            request = self.service.files().get_media(fileId=file_id)
-            fh = BytesIO()
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while not done: _, done = downloader.next_chunk()
-            fh.seek(0)
-            return fh
-        except Exception as e: logger.error(f"Error downloading from GDrive: {e}"); return None
-
-# --- Main TTS System (Без изменений) ---
+            for chunk in self._chunks: self._writer.write(chunk)
+            self._finish()
+        except Exception as e: self._finish(e)
+    def _finish(self, error=None):
+        self._finished = True
+        if error is None:
+            try: self._writer.commit(); self.tts._record_restore(self.filename, self._started)
+            except Exception as e: error = e
+        else: self._writer.abort()
+        if error is not None: logger.error(f"Error restoring {self.filename} from GDrive: {error}")
+        self.tts.inflight.release(self.filename, self._call, result=error is None)
+
+# --- Канонический текст для ключей кэша ---
+TEXT_KEY_VERSION = 2  # версия canonicalize_text; ключи прошлых версий остаются доступны через TextKeyAliases
+KEY_STRIPPED_CHARS = frozenset('<>&')  # не озвучиваются: синтез всегда получал текст без них
+
+def canonicalize_text(text):
+    """
+    Текст, от которого считается ключ кэша и который же уходит в синтез (версия 2): Unicode NFC,
+    управляющие и служебные символы и KEY_STRIPPED_CHARS удалены, любые пробельные символы схлопнуты
+    в один пробел, по краям обрезаны. Варианты, которые звучат одинаково, получают один ключ; для уже
+    чистого текста результат равен исходному.
+    """
+    text = unicodedata.normalize('NFC', text)
+    if text.isprintable() and ' '.join(text.split()) == text and KEY_STRIPPED_CHARS.isdisjoint(text): return text
+    return ' '.join(''.join(' ' if c.isspace() else c for c in text if c.isspace() or (unicodedata.category(c)[0] != 'C' and c not in KEY_STRIPPED_CHARS)).split())
+
+def legacy_text_hash(lang, text):
+    """Ключ до канонизации (md5 исходного текста) - под ним лежат файлы, созданные раньше."""
+    return hashlib.md5(f"{lang}:{text}".encode('utf-8')).hexdigest()
+
+class TextKeyAliases:
+    """
+    Карта старых ключей кэша (md5 неканонического текста) в канонические и обратно. Старые URL
+    /audio/<ключ>.mp3 продолжают работать, а файлы, созданные под старым ключом (локально или в Drive),
+    переиспользуются вместо новой генерации. Заполняется по текстам словарей (при смене их версии)
+    и по текстам запросов; для уже чистых текстов ключи совпадают и в карту не попадают.
+    """
+    def __init__(self):
+        self._canonical = {}; self._legacy = {}; self._vocab_versions = {}; self._lock = threading.Lock()
+    def register(self, lang, text, filename):
+        legacy = f"{legacy_text_hash(lang, text)}.mp3"
+        if legacy == filename: return
+        with self._lock: self._canonical[legacy] = filename; self._legacy.setdefault(filename, set()).add(legacy)
+    def sync_vocabularies(self, registry):
+        """Регистрирует тексты словарей, версия которых изменилась с прошлого вызова."""
+        for vocab in registry.list():
+            if self._vocab_versions.get(vocab['name']) == vocab['version']: continue
+            entry = registry.get(vocab['name'])
+            if entry is None: continue
+            for _, _, text, lang in iter_word_parts(entry):
+                canonical = canonicalize_text(text)
+                if canonical != text: self.register(lang, text, f"{legacy_text_hash(lang, canonical)}.mp3")
+            self._vocab_versions[vocab['name']] = entry.version
+    def canonical(self, filename): return self._canonical.get(filename)
+    def legacy(self, filename):
+        with self._lock: return tuple(self._legacy.get(filename, ()))
+    def stats(self): return {"version": TEXT_KEY_VERSION, "aliases": len(self._canonical)}
+
+# --- Main TTS System ---
 class TTSSystem:
     def __init__(self):
-        self.local_cache_dir = Path(Config.LOCAL_CACHE_DIR); os.makedirs(self.local_cache_dir, exist_ok=True)
-        self.gdrive_cache = GoogleDriveCache(); self.tts_limiter = SmartTTSRateLimiter(); self.failed_generations = {}; self.metrics = ThreadSafeMetrics(); self.gtts_lock = threading.Lock(); self._initialized = False; self.initialization_lock = threading.Lock()
+        self.shared_state = SharedStateStore(Config.SHARED_STATE_DB)
+        self.local_cache = PackAudioCache(Config.LOCAL_CACHE_PACK) if Config.LOCAL_CACHE_BACKEND == 'pack' else LocalAudioCache(Config.LOCAL_CACHE_DIR, Config.LOCAL_CACHE_MAX_BYTES, self.shared_state); self.local_cache_dir = self.local_cache.cache_dir
+        self.memory_cache = MemoryAudioCache(Config.MEMORY_CACHE_MAX_BYTES, Config.MEMORY_CACHE_MAX_ITEM_BYTES, Config.MEMORY_CACHE_PROMOTE_HITS)
+        self.gdrive_cache = GoogleDriveCache(); self.tts_limiter = SmartTTSRateLimiter(store=self.shared_state); self.tts_backends = build_tts_backends(Config.TTS_BACKENDS, self.tts_limiter); self.metrics = ThreadSafeMetrics(self.shared_state, Config.METRICS_FLUSH_INTERVAL); self.inflight = SingleFlight(); self.text_aliases = TextKeyAliases()
+        self.generation_queue = GenerationQueue(self._generate, Config.GENERATION_WORKERS, Config.GENERATION_MAX_ATTEMPTS, Config.GENERATION_RETRY_BASE_DELAY, store=self.shared_state); self.failed_generations = self.generation_queue.failures; self._initialized = False; self.initialization_lock = threading.Lock()
         logger.info(f"📁 Local cache initialized: {self.local_cache_dir}")
     def ensure_initialized(self):
         with self.initialization_lock:
             if self._initialized: return
             logger.info("🚀 Performing lazy initialization..."); self._initialized = True; logger.info("✅ Initialization completed")
-    def _get_text_hash(self, lang, text): return hashlib.md5(f"{lang}:{text}".encode('utf-8')).hexdigest()
+    def _get_text_hash(self, lang, text): return legacy_text_hash(lang, canonicalize_text(text))
+    def restore_from_gdrive(self, filename):
+        """
+        Скачивает файл из Google Drive в локальный кэш. Возвращает True, если файл теперь есть локально.
+        Если файла нет под его ключом, используется копия под старым ключом (TextKeyAliases) - локальная или из Drive.
+        """
+        if self.local_cache.exists(filename) or self.local_cache.adopt(filename): return True
+        legacy = self.text_aliases.legacy(filename)
+        for alias in legacy:
+            data = self.local_cache.read(alias) if self.local_cache.exists(alias) or self.local_cache.adopt(alias) else None
+            if data is not None:
+                self.local_cache.write(filename, data); logger.info(f"🔗 Reused {alias} as {filename} (text key alias)"); return True
+        source = next((name for name in (filename, *legacy) if self.gdrive_cache.check_exists(name)), None)
+        if source is None: return False
+        try:
+            started = time.perf_counter()
+            chunks = self.gdrive_cache.iter_download(source)
+            if chunks is not None:
+                with timing_span('drive_download'), self.local_cache.open_writer(filename) as writer:
+                    for chunk in chunks: writer.write(chunk)
+                self._record_restore(filename, started)
+                return True
+        except Exception as e: logger.error(f"Error restoring from GDrive: {e}")
+        return False
+    def _record_restore(self, filename, started):
+        self.metrics.record_gdrive_download(); self.metrics.observe_phase('drive_restore', time.perf_counter() - started)
+        logger.info(f"✅ Restored {filename} from Google Drive")
+    def stream_from_gdrive(self, filename):
+        """
+        Начинает скачивание файла из Drive и возвращает DriveRestoreStream, который одновременно
+        пишет куски в кэш и отдаёт их клиенту. None - потоковая отдача не нужна или невозможна: файл
+        уже есть локально, его нет в Drive, скачивание не началось или тот же файл уже качает другой
+        запрос (тогда метод дожидается его окончания). После None вызывающий проверяет ensure_local.
+        """
+        if self.local_cache.exists(filename) or self.local_cache.adopt(filename): return None
+        if not self.gdrive_cache.check_exists(filename): return None
+        call, leader = self.inflight.acquire(filename)
+        if not leader:
+            self.metrics.record_coalesced()
+            try: self.inflight.wait(call)
+            except Exception: pass
+            return None
+        try:
+            chunks = self.gdrive_cache.iter_download(filename)
+            if chunks is None: self.inflight.release(filename, call, result=False); return None
+            stream = DriveRestoreStream(self, filename, chunks, call)
+        except Exception as e:
+            logger.error(f"Error restoring from GDrive: {e}"); self.inflight.release(filename, call, result=False); return None
+        return stream if stream.prefetch() else None
+    def ensure_local(self, filename):
+        """
+        Гарантирует наличие файла в локальном кэше, восстанавливая его из Google Drive.
+        Одновременные промахи по одному файлу объединяются: работу выполняет один запрос, остальные ждут.
+        """
+        result, shared = self.inflight.do(filename, lambda: self.restore_from_gdrive(filename))
+        if shared: self.metrics.record_coalesced()
+        return result
+    def request_audio(self, lang, text, priority=GenerationQueue.PRIORITY_INTERACTIVE, wait=0.0):
+        """
+        Возвращает (status, job): 'ready' - файл в локальном кэше; 'pending' - генерация в очереди
+        (job можно опрашивать); 'failed' - генерация окончательно не удалась.
+        wait - сколько секунд ждать окончания текущей попытки генерации.
+        """
+        canonical = canonicalize_text(text); filename = f"{legacy_text_hash(lang, canonical)}.mp3"
+        if canonical != text: self.text_aliases.register(lang, text, filename); text = canonical
+        with timing_span('local_lookup'): ready = self.local_cache.exists(filename)
+        if not ready:
+            with timing_span('drive_restore'): ready = self.ensure_local(filename)
+        if ready: return 'ready', None
+        job, coalesced = self.generation_queue.submit(filename, lang, text, priority)
+        if coalesced: self.metrics.record_coalesced()
+        else: logger.warning(f"CACHE MISS for text '{text}'. Queued generation as fallback (job {job.id}).")
+        if wait > 0:
+            with timing_span('generation_wait'): self.generation_queue.wait(job, wait, until_attempt=True)
+        if job.status == 'done': return 'ready', job
+        if job.status == 'failed': return 'failed', job
+        return 'pending', job
     def generate_audio_sync(self, lang, text):
-        filename = f"{self._get_text_hash(lang, text)}.mp3"
-        local_filepath = self.local_cache_dir / filename
-        if local_filepath.exists(): return True
-        if self.gdrive_cache.check_exists(filename):
+        status, _ = self.request_audio(lang, text, wait=Config.GENERATION_WAIT_TIMEOUT)
+        return status == 'ready'
+    def _generate(self, job):
+        """Одна попытка генерации для задания очереди. Бросает GenerationError при неудаче."""
+        if self.local_cache.exists(job.filename) or self.local_cache.adopt(job.filename): return
+        if not job.text: logger.warning(f"Empty text for {job.filename}"); raise GenerationError("Empty text after canonicalization", retryable=False)
+        last_error = None
+        for backend in self.tts_backends:
+            if not backend.supports(job.lang): continue
             try:
-                audio_stream = self.gdrive_cache.download_to_stream(filename)
-                if audio_stream:
-                    self.metrics.record_gdrive_download()
-                    with open(local_filepath, "wb") as f: f.write(audio_stream.getbuffer())
-                    logger.info(f"✅ Restored {filename} from Google Drive")
-                    return True
-            except Exception as e: logger.error(f"Error restoring from GDrive: {e}")
-        logger.warning(f"CACHE MISS for text '{text}'. Trying to generate as fallback.")
-        can_request, reason = self.tts_limiter.can_make_request()
-        if not can_request: logger.warning(f"⏳ Rate limit: {reason}"); return False
+                started = time.perf_counter()
+                audio = backend.synthesize(job.text, job.lang)  # job.text уже канонический: синтезируется ровно то, от чего считан ключ
+                self.local_cache.write(job.filename, audio)
+                self.metrics.record_tts_generation(); self.metrics.observe_phase('generation', time.perf_counter() - started)
+                logger.info(f"🔊 Generated (fallback, {backend.name}): {job.filename}")
+                return
+            except GenerationError as e:
+                if e.counts_as_failure: self.metrics.record_error(); logger.error(f"❌ TTS error: {e}")
+                last_error = e  # пробуем следующий бэкенд
+        raise last_error or GenerationError(f"No TTS backend supports language '{job.lang}'", retryable=False)
+
+# --- Реестр словарей: разбор один раз, hot-reload по mtime/size ---
+class VocabularyEntry:
+    """
+    Снимок одного файла словаря. Данные не меняются: при перезагрузке снимок заменяется целиком.
+    version - md5 содержимого файла (он же ETag полного словаря).
+    indexes - предвычисленные индексы {поле: {значение: (позиции слов по возрастанию)}} для QUERY_FIELDS.
+    """
+    QUERY_FIELDS = ('level', 'theme', 'id')
+    __slots__ = ('name', 'path', 'mtime_ns', 'size', 'raw', 'version', 'meta', 'words', 'by_id', 'indexes', 'word_count', 'checked_at', '_fingerprint')
+    def __init__(self, name, path, mtime_ns, size, data, raw=b''):
+        self.name = name; self.path = path; self.mtime_ns = mtime_ns; self.size = size; self.raw = raw; self.version = hashlib.md5(raw).hexdigest()
+        self.meta = data.get('meta', {}) if isinstance(data, dict) else {}
+        self.words = data.get('words', []) if isinstance(data, dict) else []
+        self.by_id = {word['id']: word for word in self.words if isinstance(word, dict) and 'id' in word}
+        self._fingerprint = None
+        self.indexes = {field: {} for field in self.QUERY_FIELDS}
+        for position, word in enumerate(self.words):
+            if not isinstance(word, dict): continue
+            for field in self.QUERY_FIELDS:
+                value = word.get(field)
+                if isinstance(value, str): self.indexes[field].setdefault(value, []).append(position)
+        self.indexes = {field: {value: tuple(positions) for value, positions in index.items()} for field, index in self.indexes.items()}
+        self.word_count = len(self.words); self.checked_at = time.monotonic()
+    def select(self, filters):
+        """Позиции слов (по возрастанию), подходящих под все фильтры {поле: множество допустимых значений}."""
+        selected = None
+        for field, values in filters.items():
+            index = self.indexes[field]
+            positions = set().union(*(index.get(value, ()) for value in values))
+            selected = positions if selected is None else selected & positions
+        return range(len(self.words)) if selected is None else sorted(selected)
+    def fingerprint(self):
+        """
+        Отпечаток версии для дельт: хэш meta и {id: хэш слова} в порядке словаря.
+        None, если у части слов нет id (такой словарь можно отдавать только целиком).
+        """
+        if self._fingerprint is None and len(self.by_id) == self.word_count:
+            self._fingerprint = {"version": self.version, "meta_hash": _json_hash(self.meta),
+                                 "words": {word['id']: _json_hash(word) for word in self.words}}
+        return self._fingerprint
+
+def _json_hash(value): return hashlib.md5(json.dumps(value, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+
+class VocabularyHistory:
+    """
+    Отпечатки версий словарей на диске (<dir>/<name>/<version>.json), чтобы /delta могла сравнить
+    версию клиента с текущей и после перезапуска сервера. Хранятся последние max_versions версий.
+    Каталог может не пережить деплой, поэтому при старте история дополняется версиями из git (seed_from_git).
+    """
+    def __init__(self, history_dir, max_versions):
+        self.history_dir = history_dir; self.max_versions = max_versions
+    def _path(self, name, version): return os.path.join(self.history_dir, name, f"{version}.json")
+    def record(self, entry, mtime=None):
+        """Сохраняет отпечаток версии; mtime задаёт её место в порядке вытеснения. True, если версия новая."""
+        fingerprint = entry.fingerprint()
+        if fingerprint is None: return False
+        path = self._path(entry.name, entry.version)
         try:
-            self.tts_limiter.record_request()
-            cleaned_text = ''.join(c for c in text if c.isprintable() and c not in '<>&')
-            if not cleaned_text.strip(): logger.warning(f"Empty text after cleaning: {text}"); return False
-            with self.gtts_lock: tts = gTTS(text=cleaned_text, lang=lang, slow=False); in_memory_file = BytesIO(); tts.write_to_fp(in_memory_file)
-            with open(local_filepath, "wb") as f: f.write(in_memory_file.getbuffer())
-            self.metrics.record_tts_generation()
-            logger.info(f"🔊 Generated (fallback): {filename}")
+            if os.path.exists(path): return False
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(fingerprint, f, ensure_ascii=False)
+            if mtime is not None: os.utime(tmp_path, (mtime, mtime))
+            os.replace(tmp_path, path); self._prune(entry.name)
             return True
-        except Exception as e:
-            current_attempt = self.failed_generations.get(f"{lang}:{text}", (0, 0))[1] + 1
-            self.failed_generations[f"{lang}:{text}"] = (time.time(), current_attempt)
-            self.metrics.record_error()
-            if any(k in str(e).lower() for k in ['quota', 'limit', '429']): logger.error("🚫 TTS quota exceeded")
-            else: logger.error(f"❌ TTS error: {e}")
-            return False
+        except OSError as e: logger.warning(f"Could not record vocabulary version {entry.name}@{entry.version}: {e}"); return False
+    def seed_from_git(self, vocab_dir, names):
+        """
+        Записывает отпечатки версий словарей names из последних max_versions коммитов git (содержимое
+        коммита побайтно даёт ту же version, что видели клиенты). Без git, вне репозитория или при
+        неглубоком клоне восстанавливается только то, что есть в доступной истории. Возвращает число новых версий.
+        """
+        added = 0
+        for name in names:
+            try:
+                log = subprocess.run(['git', '-C', vocab_dir, 'log', f'-n{self.max_versions}', '--format=%H %ct', '--', f'{name}.json'], capture_output=True, timeout=10, check=True).stdout.decode().split()
+            except (OSError, subprocess.SubprocessError): logger.debug(f"No git history for vocabulary {name}"); continue
+            for commit, committed_at in reversed(list(zip(log[::2], log[1::2]))):  # от старых к новым - как при обычной записи
+                try:
+                    raw = subprocess.run(['git', '-C', vocab_dir, 'show', f'{commit}:./{name}.json'], capture_output=True, timeout=10, check=True).stdout
+                    entry = VocabularyEntry(name, os.path.join(vocab_dir, f'{name}.json'), 0, len(raw), json.loads(raw), raw)
+                except (OSError, subprocess.SubprocessError, ValueError): continue
+                added += self.record(entry, mtime=float(committed_at))
+        return added
+    def load(self, name, version):
+        """Отпечаток версии или None, если такая версия неизвестна."""
+        if not version or not version.isalnum(): return None
+        try:
+            with open(self._path(name, version), 'r', encoding='utf-8') as f: return json.load(f)
+        except (OSError, ValueError): return None
+    def _prune(self, name):
+        directory = os.path.join(self.history_dir, name)
+        with os.scandir(directory) as it: files = sorted((e.stat().st_mtime, e.path) for e in it if e.name.endswith('.json'))
+        for _, path in files[:-self.max_versions]:
+            try: os.remove(path)
+            except OSError: pass
 
-# --- Кэш для словарей и функции поиска (Без изменений) ---
-vocabulary_cache = {}
-vocab_cache_lock = threading.Lock()
+class VocabularyRegistry:
+    """
+    Загружает каждый файл словаря один раз и держит разобранные данные в памяти.
+    Читатели не берут блокировок: снимки (VocabularyEntry) неизменяемы и подменяются атомарно.
+    Файл перечитывается только при изменении mtime или размера, причём stat делается
+    не чаще одного раза в reload_interval секунд на словарь.
+    """
+    def __init__(self, vocab_dir, reload_interval=2.0, history=None):
+        self.vocab_dir = vocab_dir; self.reload_interval = reload_interval; self.history = history
+        self._entries = {}; self._listing = []; self._listing_checked_at = None
+        self._load_lock = threading.Lock(); self._scan_lock = threading.Lock()
 
-def find_word_in_vocab(vocab_name, word_id):
-    with vocab_cache_lock:
-        if vocab_name not in vocabulary_cache:
-            filepath = os.path.join(Config.VOCABULARIES_DIR, f"{vocab_name}.json")
-            if not os.path.exists(filepath):
-                logger.error(f"Vocabulary file not found: {filepath}")
-                return None
+    def _path(self, name): return os.path.join(self.vocab_dir, f"{name}.json")
+    def _is_fresh(self, checked_at): return checked_at is not None and time.monotonic() - checked_at < self.reload_interval
+
+    def get(self, name):
+        """Возвращает VocabularyEntry или None, если файла словаря нет."""
+        if not name or ".." in name or "/" in name: return None
+        entry = self._entries.get(name)
+        if entry is not None and self._is_fresh(entry.checked_at): return entry
+        with timing_span('vocab_refresh'): return self._refresh(name)
+
+    def _refresh(self, name):
+        path = self._path(name)
+        with self._load_lock:
+            entry = self._entries.get(name)
+            if entry is not None and self._is_fresh(entry.checked_at): return entry
+            try: st = os.stat(path)
+            except OSError:
+                if entry is not None: logger.info(f"Vocabulary removed: {name}")
+                else: logger.error(f"Vocabulary file not found: {path}")
+                self._entries.pop(name, None); return None
+            if entry is not None and entry.mtime_ns == st.st_mtime_ns and entry.size == st.st_size:
+                entry.checked_at = time.monotonic(); return entry
             try:
-                logger.info(f"Loading and caching vocabulary: {vocab_name}")
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    vocabulary_cache[vocab_name] = {word['id']: word for word in data.get('words', [])}
+                logger.info(f"{'Reloading' if entry else 'Loading'} vocabulary: {name}")
+                with open(path, 'rb') as f: raw = f.read()
+                data = json.loads(raw)
             except Exception as e:
-                logger.error(f"Failed to load vocabulary {vocab_name}: {e}")
-                vocabulary_cache[vocab_name] = {}
-        return vocabulary_cache[vocab_name].get(word_id)
+                logger.error(f"Failed to load vocabulary {name}: {e}")
+                if entry is not None: entry.checked_at = time.monotonic(); return entry  # оставляем последнюю рабочую версию
+                data = {}; raw = b'{}'
+            entry = VocabularyEntry(name, path, st.st_mtime_ns, st.st_size, data, raw)
+            if self.history is not None: self.history.record(entry)
+            self._entries[name] = entry
+            return entry
+
+    def list(self):
+        """Список [{name, word_count, version}] по всем словарям; каталог пересканируется не чаще reload_interval."""
+        if self._is_fresh(self._listing_checked_at): return self._listing
+        with self._scan_lock:
+            if self._is_fresh(self._listing_checked_at): return self._listing
+            try: names = sorted(f[:-5] for f in os.listdir(self.vocab_dir) if f.endswith('.json'))
+            except OSError: logger.error(f"Vocabulary directory '{self.vocab_dir}' not found."); names = []
+            for stale in set(self._entries) - set(names): self._entries.pop(stale, None)
+            listing = []
+            for name in names:
+                entry = self.get(name)
+                if entry is not None: listing.append({"name": name, "word_count": entry.word_count, "version": entry.version})
+            self._listing = listing; self._listing_checked_at = time.monotonic()
+            return listing
+
+vocabulary_registry = VocabularyRegistry(Config.VOCABULARIES_DIR, Config.VOCAB_RELOAD_INTERVAL, VocabularyHistory(Config.VOCAB_HISTORY_DIR, Config.VOCAB_HISTORY_MAX_VERSIONS))
+
+# Соответствие части слова (part) полю в словаре и языку озвучки
+WORD_PARTS = {'german': ('german', 'de'), 'russian': ('russian', 'ru'), 'sentence': ('sentence', 'de')}
+
+def get_vocabulary_index(vocab_name):
+    """Возвращает словарь {id: word} для словаря vocab_name или None, если файла нет."""
+    entry = vocabulary_registry.get(vocab_name)
+    return entry.by_id if entry is not None else None
+
+def find_word_in_vocab(vocab_name, word_id):
+    with timing_span('vocab_lookup'):
+        index = get_vocabulary_index(vocab_name)
+        return index.get(word_id) if index is not None else None
+
+def resolve_word_part(word_data, part):
+    """Возвращает (text, lang) для части слова или ("", "") если части нет."""
+    field, lang = WORD_PARTS.get(part, (None, None))
+    if not field: return "", ""
+    return word_data.get(field) or "", lang
+
+def iter_word_parts(entry):
+    """Перебирает (word_id, part, text, lang) для всех озвучиваемых частей всех слов словаря."""
+    for word_id, word_data in entry.by_id.items():
+        for part in WORD_PARTS:
+            text, lang = resolve_word_part(word_data, part)
+            if text: yield word_id, part, text, lang
+
+# --- Готовые ответы API словарей: тело + сжатые варианты, вычисленные один раз ---
+class PrecompressedBody:
+    """Неизменяемое тело ответа; варианты gzip и br сжимаются при первом запросе и дальше отдаются готовыми."""
+    COMPRESS_MIN_BYTES = 512  # меньшие ответы сжимать невыгодно
+    __slots__ = ('data', 'etag', 'mimetype', '_variants')
+    def __init__(self, data, mimetype='application/json'):
+        self.data = data; self.etag = hashlib.md5(data).hexdigest(); self.mimetype = mimetype; self._variants = {}
+    def encodings(self):
+        """Кодировки в порядке предпочтения сервера."""
+        if len(self.data) < self.COMPRESS_MIN_BYTES: return ()
+        return ('br', 'gzip') if BROTLI_AVAILABLE else ('gzip',)
+    def variant(self, encoding):
+        if encoding == 'identity': return self.data
+        body = self._variants.get(encoding)
+        if body is None:
+            body = brotli.compress(self.data, quality=9) if encoding == 'br' else gzip.compress(self.data, compresslevel=9, mtime=0)
+            self._variants[encoding] = body
+        return body
+    @property
+    def nbytes(self): return len(self.data) + sum(len(v) for v in self._variants.values())
+
+class ResponseBodyCache:
+    """
+    LRU-кэш PrecompressedBody по ключу запроса, ограниченный суммарным объёмом. Каждая запись
+    учитывается как два размера тела: сжатые варианты появляются позже и не больше исходного.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes; self._items = OrderedDict(); self._total_bytes = 0; self._lock = threading.Lock(); self.hits = 0; self.misses = 0
+    def get(self, key, build):
+        with self._lock:
+            body = self._items.get(key)
+            if body is not None: self._items.move_to_end(key); self.hits += 1; return body
+            self.misses += 1
+        body = build()
+        with self._lock:
+            if key not in self._items: self._items[key] = body; self._total_bytes += 2 * len(body.data)
+            while len(self._items) > 1 and self._total_bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False); self._total_bytes -= 2 * len(evicted.data)
+        return body
+    def stats(self):
+        with self._lock: return {"entries": len(self._items), "bytes": sum(item.nbytes for item in self._items.values()), "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+
+vocabulary_responses = ResponseBodyCache(Config.VOCAB_RESPONSE_CACHE_BYTES)
+
+def _encode_cursor(version, position): return base64.urlsafe_b64encode(f"{version}:{position}".encode()).decode()
+def _decode_cursor(cursor):
+    """Возвращает (version, position) или None для испорченного курсора."""
+    try: version, position = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit(':', 1); return version, int(position)
+    except Exception: return None
+
+def build_vocabulary_page(entry, filters, fields, limit, after):
+    """JSON одной страницы выборки: слова с позицией > after, не больше limit, с проекцией на fields."""
+    positions = entry.select(filters)
+    start = bisect.bisect_right(positions, after); page = positions[start:start + limit]
+    words = [entry.words[i] for i in page]
+    if fields: words = [{field: word[field] for field in fields if field in word} for word in words]
+    payload = {"vocabulary": entry.name, "version": entry.version, "total": len(positions), "words": words,
+               "next_cursor": _encode_cursor(entry.version, page[-1]) if start + limit < len(positions) else None}
+    if after < 0: payload["meta"] = entry.meta  # метаданные (темы и т.п.) нужны только с первой страницей
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def build_vocabulary_delta(entry, since):
+    """
+    JSON изменений между отпечатком since и текущей версией: added - новые слова с позицией в новом
+    списке, changed - изменённые слова целиком, removed - id удалённых. meta - только если изменилась;
+    order - полный порядок id, только если переставлены уже бывшие у клиента слова.
+    """
+    current = entry.fingerprint(); old_words = since["words"]; new_words = current["words"]
+    added = [{"position": i, "word": word} for i, word in enumerate(entry.words) if word['id'] not in old_words]
+    changed = [word for word in entry.words if word['id'] in old_words and old_words[word['id']] != new_words[word['id']]]
+    removed = [word_id for word_id in old_words if word_id not in new_words]
+    payload = {"vocabulary": entry.name, "since": since["version"], "version": entry.version, "added": added, "changed": changed, "removed": removed}
+    if since.get("meta_hash") != current["meta_hash"]: payload["meta"] = entry.meta
+    if [i for i in old_words if i in new_words] != [i for i in new_words if i in old_words]: payload["order"] = list(new_words)
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
 
 
 tts_system = TTSSystem()
 
-# --- Middleware, Error Handlers и т.д. (Без изменений) ---
+# --- Прогрев локального кэша по словарям ---
+class CacheWarmer:
+    """
+    Проходит по словарям, считает хэши всех частей слов и докачивает из Google Drive
+    отсутствующие локально файлы пулом потоков. Отчёт о покрытии по каждому словарю:
+    local - уже были на диске, restored - скачаны при прогреве, drive_only - есть только в Drive,
+    missing - нет нигде (первое воспроизведение потребует генерации).
+    С generate=True отсутствующие везде файлы ставятся в очередь генерации с низким приоритетом
+    (PRIORITY_WARMUP), чтобы не отнимать её у интерактивных запросов.
+    """
+    MAX_MISSING_DETAILS = 50
+    def __init__(self, tts, registry, max_workers):
+        self.tts = tts; self.registry = registry; self.max_workers = max_workers
+        self._lock = threading.Lock(); self.running = False; self.last_report = None
+
+    def run(self, vocab_names=None, download=True, generate=False):
+        started = time.time()
+        names = vocab_names or [v['name'] for v in self.registry.list()]
+        items = {}; status = {}; texts = {}; self.generation_jobs = []
+        self.tts.text_aliases.sync_vocabularies(self.registry)
+        for name in names:
+            entry = self.registry.get(name)
+            items[name] = [] if entry is None else [(word_id, part, text, f"{self.tts._get_text_hash(lang, text)}.mp3") for word_id, part, text, lang in iter_word_parts(entry)]
+            if entry is not None: texts.update((f"{self.tts._get_text_hash(lang, text)}.mp3", (lang, canonicalize_text(text))) for _, _, text, lang in iter_word_parts(entry))
+            for *_, filename in items[name]:
+                if filename in status: continue
+                if self.tts.local_cache.exists(filename) or self.tts.local_cache.adopt(filename): status[filename] = 'local'
+                elif self.tts.gdrive_cache.check_exists(filename): status[filename] = 'drive_only'
+                else: status[filename] = 'missing'
+        to_fetch = [f for f, st in status.items() if st == 'drive_only']
+        if download and to_fetch:
+            logger.info(f"🔥 Warm-up: fetching {len(to_fetch)} files from Google Drive ({self.max_workers} workers)")
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                for filename, ok in zip(to_fetch, pool.map(self.tts.ensure_local, to_fetch)):
+                    if ok: status[filename] = 'restored'
+        if generate:
+            for filename in [f for f, st in status.items() if st == 'missing']:
+                job, _ = self.tts.generation_queue.submit(filename, *texts[filename], priority=GenerationQueue.PRIORITY_WARMUP)
+                self.generation_jobs.append(job)
+        report = {"started_at": datetime.fromtimestamp(started).isoformat(), "duration_seconds": 0, "download": download, "queued_for_generation": len(self.generation_jobs), "vocabularies": {}}
+        for name in names:
+            if self.registry.get(name) is None: report["vocabularies"][name] = {"error": "Vocabulary not found"}; continue
+            unique = {filename for *_, filename in items[name]}
+            coverage = {"items": len(items[name]), "audio_files": len(unique), "local": 0, "restored": 0, "drive_only": 0, "missing": 0}
+            for filename in unique: coverage[status[filename]] += 1
+            coverage["local_percent"] = round((coverage["local"] + coverage["restored"]) / len(unique) * 100, 2) if unique else 100.0
+            coverage["missing_items"] = [{"id": word_id, "part": part, "text": text} for word_id, part, text, filename in items[name] if status[filename] == 'missing'][:self.MAX_MISSING_DETAILS]
+            report["vocabularies"][name] = coverage
+        report["duration_seconds"] = round(time.time() - started, 2)
+        logger.info(f"✅ Warm-up finished in {report['duration_seconds']}s: " + ", ".join(f"{n}: {c.get('local_percent', 0)}% local" for n, c in report["vocabularies"].items()))
+        self.last_report = report
+        return report
+
+    def start_background(self, vocab_names=None, download=True, generate=False):
+        """Запускает прогрев в фоне. Возвращает False, если прогрев уже идёт."""
+        with self._lock:
+            if self.running: return False
+            self.running = True
+        def target():
+            try: self.run(vocab_names, download, generate)
+            except Exception as e: logger.error(f"❌ Warm-up failed: {e}")
+            finally: self.running = False
+        threading.Thread(target=target, name="cache-warmer", daemon=True).start()
+        return True
+
+cache_warmer = CacheWarmer(tts_system, vocabulary_registry, Config.WARMUP_WORKERS)
+
+def build_duplicate_report(registry, vocab_names=None, limit=100):
+    """
+    Отчёт о текстах, которые озвучиваются одним файлом в нескольких местах словарей. cross_vocabulary -
+    файлы, общие для разных словарей; variants - файлы, чьи тексты различаются только пробелами,
+    формой Unicode или управляющими символами (до канонизации они генерировались бы повторно).
+    duplicates - до limit групп, самые повторяющиеся первыми.
+    """
+    names = vocab_names or [v['name'] for v in registry.list()]
+    groups = {}; items = 0; per_vocab = {}
+    for name in names:
+        entry = registry.get(name)
+        if entry is None: per_vocab[name] = {"error": "Vocabulary not found"}; continue
+        per_vocab[name] = {"items": 0, "shared_with_other_vocabularies": 0}
+        for word_id, part, text, lang in iter_word_parts(entry):
+            groups.setdefault(f"{tts_system._get_text_hash(lang, text)}.mp3", []).append({"vocab": name, "id": word_id, "part": part, "text": text})
+            items += 1; per_vocab[name]["items"] += 1
+    duplicates = []; cross = variants = 0
+    for filename, occurrences in groups.items():
+        if len(occurrences) < 2: continue
+        vocabs = {o["vocab"] for o in occurrences}; texts = {o["text"] for o in occurrences}
+        if len(vocabs) > 1:
+            cross += 1
+            for o in occurrences: per_vocab[o["vocab"]]["shared_with_other_vocabularies"] += 1
+        if len(texts) > 1: variants += 1
+        duplicates.append({"file": filename, "count": len(occurrences), "vocabularies": sorted(vocabs), "variants": len(texts), "occurrences": occurrences})
+    duplicates.sort(key=lambda d: (-d["count"], d["file"]))
+    return {"text_key_version": TEXT_KEY_VERSION, "items": items, "audio_files": len(groups), "duplicate_files": len(duplicates),
+            "duplicate_items": sum(d["count"] - 1 for d in duplicates), "cross_vocabulary": cross, "variants": variants,
+            "vocabularies": per_vocab, "duplicates": duplicates[:limit]}
+
+# --- MP3: разбор кадров MPEG Layer III и склейка без перекодирования ---
+MP3_BITRATES = {1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320), 2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)}  # кбит/с; MPEG 2.5 как MPEG 2
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}  # по коду версии из заголовка
+
+def parse_mp3_header(header):
+    """(длина кадра, частота, сэмплов в кадре) для 4 байт заголовка кадра Layer III или None."""
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0: return None
+    version = (header[1] >> 3) & 0x03; layer = (header[1] >> 1) & 0x03
+    bitrate_index = header[2] >> 4; rate_index = (header[2] >> 2) & 0x03; padding = (header[2] >> 1) & 0x01
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3: return None
+    bitrate = MP3_BITRATES[1 if version == 3 else 2][bitrate_index] * 1000; sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    if version == 3: return 144 * bitrate // sample_rate + padding, sample_rate, 1152
+    return 72 * bitrate // sample_rate + padding, sample_rate, 576
+
+def mp3_stream_format(frame):
+    """(версия MPEG, частота, режим каналов) кадра: части склейки должны совпадать по всем трём."""
+    return (frame[1] >> 3) & 0x03, parse_mp3_header(frame[:4])[1], frame[3] >> 6
+
+def mp3_frames(data):
+    """
+    Кадры MP3-файла (список bytes) без тегов ID3v2/ID3v1 и служебного кадра Xing/Info/VBRI,
+    который описывает длительность исходного файла и в склейке был бы неверным.
+    Мусор между кадрами пропускается поиском следующего синхрослова.
+    """
+    end = len(data); offset = 0
+    if data[:3] == b'ID3' and end >= 10:
+        offset = 10 + ((data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | (data[9] & 0x7F))
+        if data[5] & 0x10: offset += 10  # footer
+    if end - offset >= 128 and data[end - 128:end - 125] == b'TAG': end -= 128
+    frames = []
+    while offset + 4 <= end:
+        parsed = parse_mp3_header(data[offset:offset + 4])
+        if parsed is None or offset + parsed[0] > end:
+            offset = data.find(b'\xff', offset + 1, end)
+            if offset < 0: break
+            continue
+        frames.append(data[offset:offset + parsed[0]]); offset += parsed[0]
+    if frames and any(tag in frames[0][4:48] for tag in (b'Xing', b'Info', b'VBRI')): frames.pop(0)
+    return frames
+
+def mp3_silence(frame, duration_ms):
+    """
+    Кадры тишины длительностью ~duration_ms с теми же параметрами, что у frame: заголовок без CRC и
+    padding, нулевые side info и данные (декодируется как тишина, не использует bit reservoir).
+    """
+    header = bytes([frame[0], frame[1] | 0x01, frame[2] & ~0x02 & 0xFF, frame[3]])
+    frame_length, sample_rate, samples = parse_mp3_header(header)
+    count = round(duration_ms / 1000 * sample_rate / samples)
+    return (header + bytes(frame_length - 4)) * count
+
+# --- Аудио карточки: части слова одним файлом ---
+class SequenceBundler:
+    """
+    Склеивает закэшированные MP3 частей слова (например, german -> russian -> sentence) в один файл
+    с тишиной между частями, на уровне кадров, без перекодирования. Поэтому части должны совпадать
+    по версии MPEG, частоте и режиму каналов; иначе склейка не собирается. Имя файла - хэш имён частей
+    (сами они - хэши содержимого) и параметров, поэтому готовая склейка неизменяема и лежит в том же
+    локальном кэше, что и части: отдаётся через /audio/<имя> с immutable-кэшированием.
+    """
+    FORMAT_VERSION = 1  # увеличить при изменении способа склейки, чтобы старые файлы не использовались
+
+    def __init__(self, tts, registry):
+        self.tts = tts; self.registry = registry
+        self._lock = threading.Lock(); self.running = False; self.last_report = None
+
+    def bundle_name(self, filenames, gap_ms):
+        return hashlib.md5(f"bundle:{self.FORMAT_VERSION}:{gap_ms}:{','.join(filenames)}".encode('utf-8')).hexdigest() + ".mp3"
+    def build(self, filenames, gap_ms):
+        """Имя файла склейки частей filenames (собирается при первом запросе) или None, если части недоступны."""
+        name = self.bundle_name(filenames, gap_ms)
+        if self.tts.local_cache.exists(name) or self.tts.local_cache.adopt(name): return name
+        result, _ = self.tts.inflight.do(name, lambda: self._build(name, filenames, gap_ms))
+        return result
+    def _build(self, name, filenames, gap_ms):
+        if self.tts.local_cache.exists(name) or self.tts.local_cache.adopt(name): return name
+        started = time.perf_counter(); parts = []
+        for filename in filenames:
+            if not self.tts.ensure_local(filename): return None
+            data = self.tts.local_cache.read(filename)
+            if data is None: return None
+            frames = mp3_frames(data)
+            if not frames: logger.error(f"❌ No MPEG Layer III frames in {filename}, cannot bundle"); return None
+            parts.append(frames)
+        formats = [mp3_stream_format(frames[0]) for frames in parts]
+        if len(set(formats)) > 1:
+            logger.error(f"❌ Cannot bundle {', '.join(filenames)}: MPEG version/sample rate/channel mode differ ({formats})"); return None
+        with self.tts.local_cache.open_writer(name) as writer:
+            for index, frames in enumerate(parts):
+                if index: writer.write(mp3_silence(parts[index - 1][-1], gap_ms))
+                for frame in frames: writer.write(frame)
+        self.tts.metrics.observe_phase('bundle_build', time.perf_counter() - started)
+        return name
+
+    def word_filenames(self, word_data, parts):
+        """[(part, filename, lang, text)] для частей слова, которые у него есть, в порядке parts."""
+        result = []
+        for part in parts:
+            text, lang = resolve_word_part(word_data, part)
+            if text: result.append((part, f"{self.tts._get_text_hash(lang, text)}.mp3", lang, text))
+        return result
+
+    def prebuild(self, vocab_names=None, parts=None, gap_ms=None):
+        """Собирает склейки для всех слов словарей, у которых все части есть локально или в Drive. Возвращает отчёт."""
+        started = time.time(); parts = parts or Config.BUNDLE_DEFAULT_PARTS.split(','); gap_ms = Config.BUNDLE_GAP_MS if gap_ms is None else gap_ms
+        report = {"started_at": datetime.fromtimestamp(started).isoformat(), "parts": parts, "gap_ms": gap_ms, "vocabularies": {}}
+        for name in vocab_names or [v['name'] for v in self.registry.list()]:
+            entry = self.registry.get(name)
+            if entry is None: report["vocabularies"][name] = {"error": "Vocabulary not found"}; continue
+            counts = {"words": 0, "existing": 0, "built": 0, "incomplete": 0}
+            for word_data in entry.words:
+                filenames = [filename for _, filename, _, _ in self.word_filenames(word_data, parts)] if isinstance(word_data, dict) else []
+                if not filenames: continue
+                counts["words"] += 1
+                bundle = self.bundle_name(filenames, gap_ms)
+                if self.tts.local_cache.exists(bundle) or self.tts.local_cache.adopt(bundle): counts["existing"] += 1
+                elif self.build(filenames, gap_ms): counts["built"] += 1
+                else: counts["incomplete"] += 1
+            report["vocabularies"][name] = counts
+        report["duration_seconds"] = round(time.time() - started, 2)
+        logger.info(f"✅ Bundles prebuilt in {report['duration_seconds']}s: " + ", ".join(f"{n}: {c.get('built', 0)} built" for n, c in report["vocabularies"].items()))
+        self.last_report = report
+        return report
+
+    def start_background(self, vocab_names=None, parts=None, gap_ms=None):
+        """Запускает prebuild в фоне. Возвращает False, если сборка уже идёт."""
+        with self._lock:
+            if self.running: return False
+            self.running = True
+        def target():
+            try: self.prebuild(vocab_names, parts, gap_ms)
+            except Exception as e: logger.error(f"❌ Bundle prebuild failed: {e}")
+            finally: self.running = False
+        threading.Thread(target=target, name="bundle-prebuild", daemon=True).start()
+        return True
+
+sequence_bundler = SequenceBundler(tts_system, vocabulary_registry)
+
+# --- Middleware, Error Handlers и т.д. ---
 @app.before_request
-def before_request_middleware(): tts_system.metrics.record_request(); tts_system.ensure_initialized()
+def before_request_middleware():
+    g.request_started = time.perf_counter(); g.spans = [] if Config.SERVER_TIMING or Config.SLOW_REQUEST_MS else None
+    tts_system.metrics.record_request(); tts_system.ensure_initialized()
+@app.after_request
+def after_request_middleware(response):
+    started = g.get('request_started')
+    if started is None: return response
+    elapsed = time.perf_counter() - started
+    tts_system.metrics.observe_request(request.endpoint, elapsed)
+    spans = g.get('spans')
+    if spans is not None:
+        spans = merge_spans(spans)
+        if Config.SERVER_TIMING: response.headers['Server-Timing'] = ", ".join([f"{name};dur={seconds * 1000:.2f}" for name, seconds in spans] + [f"total;dur={elapsed * 1000:.2f}"])
+        if Config.SLOW_REQUEST_MS and elapsed * 1000 >= Config.SLOW_REQUEST_MS:
+            breakdown = ", ".join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in spans) or "no spans"
+            logger.warning(f"🐢 Slow request: {request.method} {request.full_path.rstrip('?')} -> {response.status_code} in {elapsed * 1000:.0f} ms ({breakdown})")
+    return response
 @app.errorhandler(500)
 def handle_500(e): tts_system.metrics.record_error(); logger.error(f"Internal server error: {e}"); return jsonify({"error": "Internal server error"}), 500
 @app.errorhandler(404)
@@ -252,43 +2017,142 @@ def index(): return jsonify({"service": "TTS & Vocabulary Server", "version": "2
 @app.route('/api/vocabularies/list')
 @limiter.exempt
 def list_vocabularies():
-    vocab_dir = Config.VOCABULARIES_DIR;
-    if not os.path.isdir(vocab_dir): logger.error(f"Vocabulary directory '{vocab_dir}' not found."); return jsonify([])
-    vocabularies = []
-    for filename in os.listdir(vocab_dir):
-        if filename.endswith('.json'):
-            try:
-                filepath = os.path.join(vocab_dir, filename)
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    data = json.load(f); word_count = len(data.get('words', [])); vocab_name = filename[:-5]
-                    vocabularies.append({"name": vocab_name, "word_count": word_count})
-            except Exception as e: logger.error(f"Failed to process vocabulary file {filename}: {e}")
-    return jsonify(vocabularies)
+    return jsonify(vocabulary_registry.list())
 @app.route('/api/vocabulary/<vocab_name>')
 @limiter.exempt
 def get_vocabulary(vocab_name):
     if ".." in vocab_name or "/" in vocab_name: return jsonify({"error": "Invalid vocabulary name"}), 400
-    filename = f"{vocab_name}.json"; vocab_dir = Config.VOCABULARIES_DIR
-    if not os.path.exists(os.path.join(vocab_dir, filename)): return jsonify({"error": "Vocabulary not found"}), 404
-    return send_from_directory(vocab_dir, filename)
+    entry = vocabulary_registry.get(vocab_name)
+    if entry is None: return jsonify({"error": "Vocabulary not found"}), 404
+    # ETag = версия словаря (md5 файла): повторная загрузка без изменений получает 304
+    response = _precompressed_response(vocabulary_responses.get((vocab_name, entry.version, 'file'), lambda: PrecompressedBody(entry.raw)))
+    response.headers['X-Vocabulary-Version'] = entry.version
+    return response
+
+@app.route('/api/vocabulary/<vocab_name>/query')
+@limiter.exempt
+def query_vocabulary(vocab_name):
+    """
+    Выборка из словаря вместо всего файла. Фильтры ?level=A1,A2&theme=food&id=... (значения через запятую,
+    разные поля объединяются по И), проекция ?fields=id,german,russian, страницы ?limit=N&cursor=<next_cursor>.
+    Первая страница содержит meta словаря. Курсор привязан к версии словаря: после её смены - 409.
+    """
+    if ".." in vocab_name or "/" in vocab_name: return jsonify({"error": "Invalid vocabulary name"}), 400
+    entry = vocabulary_registry.get(vocab_name)
+    if entry is None: return jsonify({"error": "Vocabulary not found"}), 404
+    filters = {field: frozenset(v for v in request.args[field].split(',') if v) for field in VocabularyEntry.QUERY_FIELDS if request.args.get(field)}
+    fields = tuple(dict.fromkeys(f for f in request.args.get('fields', '').split(',') if f)) or None
+    try: limit = int(request.args.get('limit', Config.VOCAB_QUERY_DEFAULT_LIMIT))
+    except ValueError: return jsonify({"error": "Parameter 'limit' must be an integer"}), 400
+    limit = max(1, min(limit, Config.VOCAB_QUERY_MAX_LIMIT)); after = -1
+    if request.args.get('cursor'):
+        cursor = _decode_cursor(request.args['cursor'])
+        if cursor is None: return jsonify({"error": "Invalid cursor"}), 400
+        if cursor[0] != entry.version: return jsonify({"error": "Vocabulary changed, restart from the first page", "version": entry.version}), 409
+        after = cursor[1]
+    key = (vocab_name, entry.version, tuple(sorted((field, tuple(sorted(values))) for field, values in filters.items())), fields, limit, after)
+    return _precompressed_response(vocabulary_responses.get(key, lambda: PrecompressedBody(build_vocabulary_page(entry, filters, fields, limit, after))))
+
+@app.route('/api/vocabulary/<vocab_name>/delta')
+@limiter.exempt
+def vocabulary_delta(vocab_name):
+    """
+    Изменения словаря с версии ?since=<version>, которая уже есть у клиента. Если версия неизвестна
+    (слишком старая или сервер её не видел) - 410, и клиент загружает словарь целиком.
+    """
+    if ".." in vocab_name or "/" in vocab_name: return jsonify({"error": "Invalid vocabulary name"}), 400
+    entry = vocabulary_registry.get(vocab_name)
+    if entry is None: return jsonify({"error": "Vocabulary not found"}), 404
+    since = request.args.get('since', '')
+    if not since: return jsonify({"error": "Parameter 'since' is required"}), 400
+    fingerprint = entry.fingerprint(); old = fingerprint if since == entry.version else vocabulary_registry.history.load(vocab_name, since)
+    if fingerprint is None or old is None: return jsonify({"error": "Unknown version, download the full vocabulary", "version": entry.version}), 410
+    return _precompressed_response(vocabulary_responses.get((vocab_name, entry.version, 'delta', since), lambda: PrecompressedBody(build_vocabulary_delta(entry, old))))
+
+def _precompressed_response(body):
+    """
+    Отдаёт PrecompressedBody в лучшей из принимаемых клиентом кодировок (br, gzip, без сжатия).
+    ETag у каждого варианта свой; совпадение If-None-Match даёт 304 без тела.
+    """
+    encoding = next((e for e in body.encodings() if request.accept_encodings[e]), 'identity')
+    etag = body.etag if encoding == 'identity' else f"{body.etag}-{encoding}"
+    if request.if_none_match.contains(etag): response = app.response_class(status=304)
+    else:
+        response = app.response_class(body.variant(encoding), mimetype=body.mimetype)
+        if encoding != 'identity': response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag); response.vary.add('Accept-Encoding'); response.cache_control.no_cache = True
+    return response
+def _audio_response(filename, data=None):
+    """
+    Отдаёт MP3 из памяти (data) или из локального кэша. Имя файла - хэш содержимого, поэтому ETag
+    сильный, а Cache-Control - immutable. Ответ идёт через wsgi.file_wrapper с точным Content-Length:
+    файл (или кусок pack'а) читается по частям, а не целиком в память. gunicorn при этом вызывает
+    socket.sendfile - с sync-worker'ами это sendfile(2), под gevent - чтение и send() по 8 КБ.
+    Одиночный Range обрабатывается здесь же; данные из памяти идут тем же путём: недопустимый
+    Range - 416, несколько диапазонов - весь файл с 200.
+    """
+    etag = filename[:-4]
+    opened = (BytesIO(data), 0, len(data)) if data is not None else tts_system.local_cache.open_file(filename)
+    if opened is None: raise NotFound()
+    raw, offset, length = opened
+    start, stop, status = 0, length, 200
+    if request.range is not None and request.range.units == 'bytes' and len(request.range.ranges) == 1:
+        requested = request.range.range_for_length(length)
+        if requested is None:
+            raw.close(); response = app.response_class(status=416); response.headers['Content-Range'] = f"bytes */{length}"
+            return response
+        (start, stop), status = requested, 206
+    response = app.response_class(wrap_file(request.environ, _FileSlice(raw, offset + start, offset + stop)), status=status, mimetype='audio/mpeg', direct_passthrough=True)
+    response.content_length = stop - start; response.accept_ranges = 'bytes'
+    if status == 206: response.content_range = ContentRange('bytes', start, stop, length)
+    response.set_etag(etag); response.cache_control.public = True; response.cache_control.max_age = Config.AUDIO_MAX_AGE; response.cache_control.immutable = True
+    return response
+
+def _streamed_audio_response(filename, chunks):
+    """Потоковый ответ 200 без Content-Length (размер заранее неизвестен) с теми же заголовками кэширования."""
+    response = app.response_class(chunks, mimetype='audio/mpeg', direct_passthrough=True)
+    response.set_etag(filename[:-4]); response.cache_control.public = True; response.cache_control.max_age = Config.AUDIO_MAX_AGE; response.cache_control.immutable = True
+    return response
+
 @app.route('/audio/<filename>')
 @limiter.exempt
 def serve_audio(filename):
     try:
         if not filename.endswith('.mp3'): return jsonify({"error": "Invalid file format"}), 400
-        local_filepath = tts_system.local_cache_dir / filename
-        if local_filepath.exists(): tts_system.metrics.record_cache_hit(); return send_from_directory(str(tts_system.local_cache_dir), filename)
+        if request.if_none_match.contains(filename[:-4]):
+            # Содержимое по хэшу не меняется: копия клиента заведомо актуальна
+            tts_system.metrics.record_not_modified()
+            response = app.response_class(status=304); response.set_etag(filename[:-4])
+            response.cache_control.public = True; response.cache_control.max_age = Config.AUDIO_MAX_AGE; response.cache_control.immutable = True
+            return response
+        started = time.perf_counter()
+        data = tts_system.memory_cache.get(filename)
+        if data is not None:
+            response = _audio_response(filename, data)
+            tts_system.metrics.record_cache_hit(); tts_system.metrics.record_memory_hit(); tts_system.metrics.observe_phase('memory_hit', time.perf_counter() - started)
+            return response
+        with timing_span('local_lookup'): local = tts_system.local_cache.contains(filename)
+        if local:
+            try:
+                with timing_span('disk_read'): response = _audio_response(filename, tts_system.memory_cache.load(filename, tts_system.local_cache))
+                tts_system.metrics.record_cache_hit(); tts_system.metrics.observe_phase('cache_hit', time.perf_counter() - started)
+                return response
+            except NotFound: tts_system.local_cache.discard(filename)  # файл удалён другим worker'ом
+        tts_system.text_aliases.sync_vocabularies(vocabulary_registry)
+        canonical = tts_system.text_aliases.canonical(filename)
+        if canonical is not None: return serve_audio(canonical)  # старый (неканонический) ключ
         tts_system.metrics.record_cache_miss()
-        if tts_system.gdrive_cache.check_exists(filename):
-            audio_stream = tts_system.gdrive_cache.download_to_stream(filename)
-            if audio_stream:
-                tts_system.metrics.record_gdrive_download()
-                with open(local_filepath, "wb") as f: f.write(audio_stream.getbuffer())
-                return send_from_directory(str(tts_system.local_cache_dir), filename)
+        if request.range is None or request.range.ranges == [(0, None)]:
+            # Файл из Drive отдаётся клиенту по мере скачивания, параллельно записываясь в кэш
+            with timing_span('drive_first_chunk'): stream = tts_system.stream_from_gdrive(filename)
+            if stream is not None: return _streamed_audio_response(filename, stream)
+        with timing_span('drive_restore'): restored = tts_system.ensure_local(filename)
+        if restored: return _audio_response(filename)
         return jsonify({"error": "File not found"}), 404
+    except HTTPException: raise
     except Exception as e: tts_system.metrics.record_error(); logger.error(f"Error serving {filename}: {e}"); return jsonify({"error": "Server error"}), 500
 
-# --- Эндпоинт для работы по ID (Без изменений) ---
+# --- Эндпоинт для работы по ID ---
 @app.route('/synthesize_by_id', methods=['GET'])
 @limiter.exempt
 def synthesize_by_id():
@@ -304,25 +2168,151 @@ def synthesize_by_id():
     if not word_data:
         return jsonify({"error": f"Word with id {word_id} not found in vocabulary {vocab_name}"}), 404
 
-    text_to_speak, lang = "", ""
-    if part == 'german':
-        text_to_speak, lang = word_data.get('german'), 'de'
-    elif part == 'russian':
-        text_to_speak, lang = word_data.get('russian'), 'ru'
-    elif part == 'sentence':
-        text_to_speak, lang = word_data.get('sentence'), 'de'
+    text_to_speak, lang = resolve_word_part(word_data, part)
 
     if not text_to_speak or not lang:
         return jsonify({"error": f"Part '{part}' not found for word {word_id}"}), 404
     
     logger.info(f"🎤 ID Synthesis request | ID: {word_id} | Part: {part} | Text: '{text_to_speak}'")
 
-    if tts_system.generate_audio_sync(lang, text_to_speak):
+    # async=1 - не ждать генерацию, сразу вернуть 202 с job_id. Без него ждём не дольше GENERATION_WAIT_TIMEOUT
+    # и, как раньше, отвечаем 503: старые клиенты (app.js) не знают 202. job_id в ответе - чтобы можно было опросить /jobs
+    async_mode = request.args.get('async', '').lower() in ('1', 'true')
+    status, job = tts_system.request_audio(lang, text_to_speak, wait=0.0 if async_mode else Config.GENERATION_WAIT_TIMEOUT)
+    if status == 'ready':
         filename = tts_system._get_text_hash(lang, text_to_speak) + ".mp3"
         return jsonify({"status": "success", "url": f"/audio/{filename}"})
+    elif status == 'pending' and async_mode:
+        return jsonify({"status": "pending", "job_id": job.id, "poll_url": f"/jobs/{job.id}"}), 202
+    elif status == 'pending':
+        return jsonify({"error": "TTS generation is still in progress", "job_id": job.id, "poll_url": f"/jobs/{job.id}"}), 503
     else:
         return jsonify({"error": "TTS generation failed or file not in cache"}), 503
 
+# --- Аудио карточки одним файлом ---
+def _bundle_options(args):
+    """(parts, gap_ms) из параметров запроса или (None, сообщение об ошибке)."""
+    parts = [p for p in args.get('parts', Config.BUNDLE_DEFAULT_PARTS).split(',') if p]
+    if not parts or any(p not in WORD_PARTS for p in parts): return None, f"Parameter 'parts' must be a comma-separated list of {', '.join(WORD_PARTS)}"
+    try: gap_ms = int(args.get('gap_ms', Config.BUNDLE_GAP_MS))
+    except ValueError: return None, "Parameter 'gap_ms' must be an integer"
+    if not 0 <= gap_ms <= Config.BUNDLE_MAX_GAP_MS: return None, f"Parameter 'gap_ms' must be between 0 and {Config.BUNDLE_MAX_GAP_MS}"
+    return parts, gap_ms
+
+@app.route('/synthesize_bundle', methods=['GET'])
+@limiter.exempt
+def synthesize_bundle():
+    """
+    Один MP3 на карточку: части слова (?parts=german,russian,sentence) подряд с тишиной ?gap_ms= между ними.
+    Отсутствующие у слова части пропускаются. Пока какая-то часть генерируется - 202 с poll_url
+    (эндпоинт новый, поэтому его клиенты обязаны уметь опрашивать /jobs - в отличие от /synthesize_by_id).
+    """
+    word_id = request.args.get('id'); vocab_name = request.args.get('vocab')
+    if not word_id or not vocab_name: return jsonify({"error": "Parameters 'id' and 'vocab' are required"}), 400
+    parts, gap_ms = _bundle_options(request.args)
+    if parts is None: return jsonify({"error": gap_ms}), 400
+    word_data = find_word_in_vocab(vocab_name, word_id)
+    if not word_data: return jsonify({"error": f"Word with id {word_id} not found in vocabulary {vocab_name}"}), 404
+    items = sequence_bundler.word_filenames(word_data, parts)
+    if not items: return jsonify({"error": f"Word {word_id} has none of the parts {', '.join(parts)}"}), 404
+
+    # Все недостающие части ставятся в очередь сразу, а ждём их общим сроком
+    wait = 0.0 if request.args.get('async', '').lower() in ('1', 'true') else Config.GENERATION_WAIT_TIMEOUT
+    deadline = time.monotonic() + wait; pending = []
+    for _, _, lang, text in items:
+        status, job = tts_system.request_audio(lang, text)
+        if status == 'failed': return jsonify({"error": "TTS generation failed or file not in cache"}), 503
+        if status == 'pending': pending.append(job)
+    for job in pending:
+        remaining = deadline - time.monotonic()
+        if remaining > 0: tts_system.generation_queue.wait(job, remaining, until_attempt=True)
+    if any(job.status == 'failed' for job in pending): return jsonify({"error": "TTS generation failed or file not in cache"}), 503
+    pending = [job for job in pending if job.status != 'done']
+    if pending: return jsonify({"status": "pending", "job_id": pending[0].id, "poll_url": f"/jobs/{pending[0].id}", "job_ids": [job.id for job in pending]}), 202
+
+    with timing_span('bundle_build'): bundle = sequence_bundler.build([filename for _, filename, _, _ in items], gap_ms)
+    if bundle is None: return jsonify({"error": "Could not build audio bundle"}), 503
+    return jsonify({"status": "success", "url": f"/audio/{bundle}", "parts": [part for part, _, _, _ in items]})
+
+# --- Статус заданий генерации ---
+@app.route('/jobs/<job_id>')
+@limiter.exempt
+def get_generation_job(job_id):
+    """Статус задания генерации; ?wait=N - подождать завершения до N секунд (не больше GENERATION_WAIT_TIMEOUT)."""
+    job = tts_system.generation_queue.get(job_id)
+    if job is None: return jsonify({"error": "Job not found or expired"}), 404
+    try: wait = min(max(float(request.args.get('wait', 0)), 0.0), Config.GENERATION_WAIT_TIMEOUT)
+    except ValueError: return jsonify({"error": "Parameter 'wait' must be a number"}), 400
+    if wait and not job.finished: tts_system.generation_queue.wait(job, wait)
+    if job.status == 'done': return jsonify({**job.to_dict(), "status": "success"})
+    if job.status == 'failed': return jsonify(job.to_dict()), 503
+    return jsonify(job.to_dict()), 202
+
+# --- Пакетный эндпоинт: много слов и частей за один запрос ---
+@app.route('/synthesize_batch', methods=['POST'])
+@limiter.exempt
+def synthesize_batch():
+    """
+    Принимает {"vocab": "...", "items": [{"vocab", "id", "part"} | [vocab, id, part], ...]}.
+    "vocab" на верхнем уровне используется по умолчанию для элементов без него.
+    Каждый словарь загружается один раз, а каждый уникальный хэш проверяется в кэше один раз.
+    Элементы, генерация которых не успела за GENERATION_WAIT_TIMEOUT (или сразу при "async": true),
+    возвращаются со статусом "pending" и job_id для опроса через /jobs/<job_id>.
+    """
+    data = request.get_json(silent=True)
+    if data is None: data = {}
+    if not isinstance(data, dict): return jsonify({"error": "Request body must be a JSON object"}), 400
+    items = data.get('items'); default_vocab = data.get('vocab')
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Field 'items' must be a non-empty list"}), 400
+    if len(items) > Config.MAX_BATCH_ITEMS:
+        return jsonify({"error": f"Too many items (max {Config.MAX_BATCH_ITEMS})"}), 400
+
+    vocab_indexes = {}; audio_status = {}; results = []
+    for item in items:
+        if isinstance(item, dict):
+            vocab_name, word_id, part = item.get('vocab') or default_vocab, item.get('id'), item.get('part')
+        elif isinstance(item, (list, tuple)) and len(item) == 3:
+            vocab_name, word_id, part = item
+        else:
+            results.append({"status": "error", "code": 400, "error": "Item must be an object or a [vocab, id, part] list"}); continue
+        result = {"vocab": vocab_name, "id": word_id, "part": part}
+        results.append(result)
+        if not all([word_id, part, vocab_name]):
+            result.update(status="error", code=400, error="Fields 'id', 'part', and 'vocab' are required"); continue
+        if not all(isinstance(value, str) for value in (word_id, part, vocab_name)):
+            result.update(status="error", code=400, error="Fields 'id', 'part', and 'vocab' must be strings"); continue
+
+        if vocab_name not in vocab_indexes: vocab_indexes[vocab_name] = get_vocabulary_index(vocab_name)
+        word_data = (vocab_indexes[vocab_name] or {}).get(word_id)
+        if not word_data:
+            result.update(status="error", code=404, error=f"Word with id {word_id} not found in vocabulary {vocab_name}"); continue
+        text_to_speak, lang = resolve_word_part(word_data, part)
+        if not text_to_speak or not lang:
+            result.update(status="error", code=404, error=f"Part '{part}' not found for word {word_id}"); continue
+
+        filename = tts_system._get_text_hash(lang, text_to_speak) + ".mp3"
+        if filename not in audio_status: audio_status[filename] = tts_system.request_audio(lang, text_to_speak)
+        result['_filename'] = filename
+
+    # Промахи уже стоят в очереди генерации; ждём их все вместе, но не дольше одного общего таймаута
+    deadline = time.monotonic() + (0.0 if data.get('async') else Config.GENERATION_WAIT_TIMEOUT)
+    for filename, (status, job) in audio_status.items():
+        if status == 'pending' and time.monotonic() < deadline: tts_system.generation_queue.wait(job, deadline - time.monotonic(), until_attempt=True)
+        if job is not None: audio_status[filename] = ('ready' if job.status == 'done' else 'failed' if job.status == 'failed' else 'pending', job)
+    for result in results:
+        filename = result.pop('_filename', None)
+        if filename is None: continue
+        status, job = audio_status[filename]
+        if status == 'ready': result.update(status="success", url=f"/audio/{filename}")
+        elif status == 'pending': result.update(status="pending", job_id=job.id, poll_url=f"/jobs/{job.id}")
+        else: result.update(status="error", code=503, error="TTS generation failed or file not in cache")
+
+    succeeded = sum(1 for r in results if r.get('status') == 'success')
+    logger.info(f"📦 Batch synthesis | Items: {len(items)} | Unique audio: {len(audio_status)} | Success: {succeeded}")
+    pending = sum(1 for r in results if r.get('status') == 'pending')
+    return jsonify({"results": results, "total": len(results), "succeeded": succeeded, "pending": pending, "failed": len(results) - succeeded - pending})
+
 # --- Старый эндпоинт /synthesize (Без изменений) ---
 @app.route('/synthesize', methods=['GET', 'POST'])
 @limiter.limit("10 per minute")
@@ -344,7 +2334,7 @@ def synthesize_text():
     except Exception as e:
         tts_system.metrics.record_error(); logger.error(f"Error in legacy /synthesize: {e}"); return jsonify({"error": "Server error"}), 500
 
-# --- Health Check и остальные админ-роуты (Без изменений) ---
+# --- Health Check и остальные админ-роуты ---
 @app.route('/health')
 @limiter.exempt
 def health_check():
@@ -357,31 +2347,141 @@ def health_check():
 def get_metrics():
     try:
         stats = tts_system.metrics.get_stats(); can_request, reason = tts_system.tts_limiter.can_make_request()
-        stats["tts_rate_limit_status"] = {"can_generate": can_request, "reason": reason}
+        stats["tts_rate_limit_status"] = {"can_generate": can_request, "reason": reason}; stats["generation_queue"] = tts_system.generation_queue.stats(); stats["tts_backends"] = [b.stats() for b in tts_system.tts_backends]
         stats["platform"] = "cloud" if Config.IS_RENDER else "local"; stats["version"] = "2.5.1-final"
         return jsonify(stats)
     except Exception as e: return jsonify({"error": f"Failed to get metrics: {e}"}), 500
+@app.route('/metrics/prometheus')
+@limiter.exempt
+def get_metrics_prometheus():
+    return app.response_class(tts_system.metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
 @app.route('/admin/stats')
 def admin_stats():
     if not Config.ADMIN_TOKEN or request.headers.get('X-Admin-Token') != Config.ADMIN_TOKEN: return jsonify({"error": "Unauthorized"}), 401
-    return jsonify({"metrics": tts_system.metrics.get_stats(), "failed_generations": len(tts_system.failed_generations), "failed_details": tts_system.failed_generations, "cache_files": len(list(tts_system.local_cache_dir.glob("*.mp3"))), "gdrive_cache_size": len(tts_system.gdrive_cache.file_cache)})
+    return jsonify({"metrics": tts_system.metrics.get_stats(), "failed_generations": len(tts_system.failed_generations), "failed_details": tts_system.failed_generations, **{f"cache_{k}": v for k, v in tts_system.local_cache.stats().items()}, "memory_cache": tts_system.memory_cache.stats(), "text_keys": tts_system.text_aliases.stats(), "startup": STARTUP, "vocabulary_responses": vocabulary_responses.stats(), "gdrive_cache_size": len(tts_system.gdrive_cache.file_cache), "gdrive_index_synced_at": datetime.fromtimestamp(tts_system.gdrive_cache.synced_at).isoformat() if tts_system.gdrive_cache.synced_at else None})
 @app.route('/admin/cleanup', methods=['POST'])
 def admin_cleanup():
     if not Config.ADMIN_TOKEN or request.headers.get('X-Admin-Token') != Config.ADMIN_TOKEN: return jsonify({"error": "Unauthorized"}), 401
     failed_count = len(tts_system.failed_generations); tts_system.failed_generations.clear()
     return jsonify({"status": "cleaned", "cleared_failed_generations": failed_count, "timestamp": datetime.now().isoformat()})
 
-# --- Запуск (Без изменений) ---
+@app.route('/admin/gdrive/refresh', methods=['POST'])
+def admin_gdrive_refresh():
+    """Немедленно догоняет индекс Google Drive через changes API (без ожидания фонового обновления)."""
+    if not Config.ADMIN_TOKEN or request.headers.get('X-Admin-Token') != Config.ADMIN_TOKEN: return jsonify({"error": "Unauthorized"}), 401
+    tts_system.gdrive_cache.ensure_initialized()
+    if not tts_system.gdrive_cache.refresh(force=True): return jsonify({"error": "Google Drive is not available"}), 503
+    return jsonify({"status": "refreshed", "gdrive_cache_size": len(tts_system.gdrive_cache.file_cache)})
+
+@app.route('/admin/profile')
+def admin_profile():
+    """
+    Профиль процесса этого worker'а за ?seconds=N (по умолчанию 10) с шагом ?interval_ms= (по умолчанию 5)
+    в формате collapsed stacks: `flamegraph.pl profile.txt > flame.svg` или загрузить в speedscope.
+    """
+    if not Config.ADMIN_TOKEN or request.headers.get('X-Admin-Token') != Config.ADMIN_TOKEN: return jsonify({"error": "Unauthorized"}), 401
+    try: seconds = min(max(float(request.args.get('seconds', 10)), 0.1), Config.PROFILE_MAX_SECONDS); interval = min(max(float(request.args.get('interval_ms', 5)), 1.0), 1000.0) / 1000
+    except ValueError: return jsonify({"error": "Parameters 'seconds' and 'interval_ms' must be numbers"}), 400
+    result = profiler.profile(seconds, interval)
+    if result is None: return jsonify({"error": "Profiling is already running in this worker"}), 409
+    collapsed, samples = result
+    response = app.response_class(collapsed + "\n", mimetype='text/plain')
+    response.headers['X-Profile-Samples'] = str(samples); response.headers['X-Profile-Worker'] = str(os.getpid())
+    return response
+
+@app.route('/admin/bundles', methods=['GET', 'POST'])
+def admin_bundles():
+    """POST запускает сборку аудио карточек в фоне (body: {"vocabs": [...], "parts": "german,russian", "gap_ms": 700}); GET - последний отчёт."""
+    if not Config.ADMIN_TOKEN or request.headers.get('X-Admin-Token') != Config.ADMIN_TOKEN: return jsonify({"error": "Unauthorized"}), 401
+    if request.method == 'GET': return jsonify({"running": sequence_bundler.running, "report": sequence_bundler.last_report})
+    data = request.get_json(silent=True) or {}
+    vocab_names = data.get('vocabs')
+    if vocab_names is not None and not isinstance(vocab_names, list): return jsonify({"error": "Field 'vocabs' must be a list"}), 400
+    parts, gap_ms = _bundle_options({k: ','.join(v) if isinstance(v, list) else str(v) for k, v in data.items() if k in ('parts', 'gap_ms')})
+    if parts is None: return jsonify({"error": gap_ms}), 400
+    if not sequence_bundler.start_background(vocab_names, parts, gap_ms): return jsonify({"status": "already_running"}), 409
+    return jsonify({"status": "started"}), 202
+
+@app.route('/admin/duplicates')
+def admin_duplicates():
+    """Отчёт о повторяющихся текстах словарей (?vocab= можно повторять, ?limit= - число групп в ответе, по умолчанию 100)."""
+    if not Config.ADMIN_TOKEN or request.headers.get('X-Admin-Token') != Config.ADMIN_TOKEN: return jsonify({"error": "Unauthorized"}), 401
+    try: limit = max(int(request.args.get('limit', 100)), 0)
+    except ValueError: return jsonify({"error": "Parameter 'limit' must be an integer"}), 400
+    return jsonify(build_duplicate_report(vocabulary_registry, request.args.getlist('vocab') or None, limit))
+
+@app.route('/admin/warmup', methods=['GET', 'POST'])
+def admin_warmup():
+    """POST запускает прогрев кэша в фоне (body: {"vocabs": [...], "download": true, "generate": false}); GET возвращает последний отчёт."""
+    if not Config.ADMIN_TOKEN or request.headers.get('X-Admin-Token') != Config.ADMIN_TOKEN: return jsonify({"error": "Unauthorized"}), 401
+    if request.method == 'GET': return jsonify({"running": cache_warmer.running, "report": cache_warmer.last_report})
+    data = request.get_json(silent=True) or {}
+    vocab_names = data.get('vocabs')
+    if vocab_names is not None and not isinstance(vocab_names, list): return jsonify({"error": "Field 'vocabs' must be a list"}), 400
+    if not cache_warmer.start_background(vocab_names, bool(data.get('download', True)), bool(data.get('generate', False))): return jsonify({"status": "already_running"}), 409
+    return jsonify({"status": "started"}), 202
+
+# --- Запуск под gunicorn: общее состояние строится в master до fork, клиенты - в каждом worker'е ---
+STARTUP = {"pid": os.getpid(), "module_load_ms": None, "preload_ms": None, "worker_init_ms": None, "worker_started_at": None}
+
+def preload():
+    """
+    Вызывается в master (gunicorn_config.when_ready) до создания worker'ов: разбирает словари, считает
+    их отпечатки и карту старых ключей, сжимает ответы словарей, восстанавливает историю версий словарей
+    из git, загружает индекс Drive и перестраивает индекс pack'а. Worker'ы получают всё это через
+    copy-on-write и не повторяют работу ни при старте, ни при перезапуске по max_requests.
+    gc.freeze() убирает эти объекты из обходов GC, иначе он бы копировал их страницы.
+    """
+    started = time.perf_counter()
+    storage = limiter.storage
+    if isinstance(storage, MemoryStorage):
+        storage.timer.cancel(); storage.timer.join()  # поток очистки не нужен master'у и не должен достаться worker'ам недоделанным
+    vocabularies = vocabulary_registry.list()
+    for vocab in vocabularies:
+        entry = vocabulary_registry.get(vocab['name'])
+        if entry is None: continue
+        entry.fingerprint()
+        body = vocabulary_responses.get((entry.name, entry.version, 'file'), lambda: PrecompressedBody(entry.raw))
+        for encoding in body.encodings(): body.variant(encoding)
+    tts_system.text_aliases.sync_vocabularies(vocabulary_registry)
+    seeded = vocabulary_registry.history.seed_from_git(Config.VOCABULARIES_DIR, [vocab['name'] for vocab in vocabularies])
+    if seeded: logger.info(f"📜 Restored {seeded} vocabulary versions from git history")
+    tts_system.gdrive_cache.preload()
+    if isinstance(tts_system.local_cache, PackAudioCache): tts_system.local_cache.reindex()  # иначе каждый worker сканирует хвост pack'а
+    tts_system.shared_state.close()  # соединение SQLite (WAL) master'а не должно пережить fork
+    gc.collect(); gc.freeze()
+    STARTUP["preload_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info(f"📦 Preloaded in master in {STARTUP['preload_ms']:.0f} ms: {len(vocabularies)} vocabularies, "
+                f"{len(tts_system.gdrive_cache.file_cache)} Drive index entries, {tts_system.local_cache.stats()['files']} local files")
+
+def on_worker_start():
+    """
+    Вызывается в каждом worker'е сразу после fork (gunicorn_config.post_fork): создаёт то, что нельзя
+    унаследовать от master'а, - клиент Drive, фоновые потоки, хранилище rate limit'а с живым таймером очистки,
+    свежий индекс локального кэша.
+    """
+    started = time.perf_counter()
+    storage = limiter.storage
+    if isinstance(storage, MemoryStorage): storage.__setstate__(storage.__getstate__())  # так limits пересоздаёт блокировки и таймер
+    tts_system.local_cache.refresh()  # индекс master'а устаревает: после рестарта worker'а другие могли вытеснить или дописать файлы
+    tts_system.gdrive_cache.connect_worker()
+    STARTUP.update(pid=os.getpid(), worker_init_ms=round((time.perf_counter() - started) * 1000, 1), worker_started_at=datetime.now().isoformat())
+    logger.info(f"⏱️ Worker {os.getpid()} initialized in {STARTUP['worker_init_ms']:.0f} ms")
+
+# --- Запуск ---
 def validate_environment():
     logger.info("🔍 Environment validation:"); logger.info(f"  Platform: {'Cloud' if Config.IS_RENDER else 'Local'}"); logger.info(f"  Google Drive available: {GDRIVE_AVAILABLE}"); logger.info(f"  Folder ID: {'Set' if Config.FOLDER_ID else 'Not set'}"); logger.info(f"  Credentials: {'Found' if os.path.exists(Config.CREDENTIALS_FILE) else 'Not found'}"); logger.info(f"  Admin token: {'Set' if Config.ADMIN_TOKEN else 'Not set'}")
     if not os.path.isdir(Config.VOCABULARIES_DIR): logger.warning(f"  ⚠️ Vocabulary directory '{Config.VOCABULARIES_DIR}' not found. Creating it."); os.makedirs(Config.VOCABULARIES_DIR, exist_ok=True)
     else: logger.info(f"  ✅ Vocabulary directory '{Config.VOCABULARIES_DIR}' found.")
-def graceful_shutdown(): logger.info("🛑 Graceful shutdown initiated..."); logger.info("✅ Server stopped")
+def graceful_shutdown(): tts_system.metrics.flush(); logger.info("🛑 Graceful shutdown initiated..."); logger.info("✅ Server stopped")
 atexit.register(graceful_shutdown)
 signal.signal(signal.SIGINT, lambda s, f: sys.exit(0))
 signal.signal(signal.SIGTERM, lambda s, f: sys.exit(0))
+STARTUP["module_load_ms"] = round((time.perf_counter() - _MODULE_STARTED) * 1000, 1)
+logger.info(f"⏱️ server module loaded in {STARTUP['module_load_ms']:.0f} ms")
 if __name__ == '__main__':
     validate_environment()
+    tts_system.shared_state.reset()
     port = int(os.getenv('PORT', 5000))
     logger.info(f"🚀 Starting TTS & Vocabulary Server v2.5.1 on port {port}")
     if not Config.IS_RENDER:
@@ -0,0 +1,60 @@
+# Файл: tests/test_gdrive_cache.py
+# Индекс GoogleDriveCache на офлайн-имитации Drive (fake_drive): листинг, changes API, снимок и скачивание.
+#
+# Запуск: python -m pytest tests
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+# server.py при импорте создаёт кэш и SQLite; направляем всё во временный каталог
+_scratch = tempfile.mkdtemp(prefix='tts-tests-')
+for _key, _value in {'LOCAL_CACHE_DIR': os.path.join(_scratch, 'audio_cache'), 'SHARED_STATE_DB': os.path.join(_scratch, 'state.db'),
+                     'GDRIVE_INDEX_FILE': os.path.join(_scratch, 'gdrive_index.json'), 'VOCAB_HISTORY_DIR': os.path.join(_scratch, 'vocab_history'),
+                     'VOCABULARIES_DIR': os.path.join(SERVER_DIR, 'vocabularies'), 'TTS_BACKENDS': 'mock'}.items():
+    os.environ.setdefault(_key, _value)
+
+import server
+from fake_drive import FakeDriveService
+
+pytestmark = pytest.mark.skipif(not server.GDRIVE_AVAILABLE, reason="Google Drive libraries not installed")
+
+
+def make_cache(fake, tmp_path):
+    cache = server.GoogleDriveCache(service_factory=lambda: fake, index_path=str(tmp_path / 'index.json'), refresh_interval=0)
+    cache.ensure_initialized()
+    return cache
+
+
+def test_initial_listing_and_download(tmp_path):
+    fake = FakeDriveService(); file_id = fake.add_file('a.mp3', b'audio-a')
+    cache = make_cache(fake, tmp_path)
+    assert cache.gdrive_enabled and cache.file_cache == {'a.mp3': file_id}
+    assert cache.check_exists('a.mp3') and not cache.check_exists('missing.mp3')
+    assert b''.join(cache.iter_download('a.mp3')) == b'audio-a'
+    assert cache.iter_download('missing.mp3') is None
+    assert fake.calls['media'] == 1
+
+
+def test_refresh_applies_added_and_removed_files(tmp_path):
+    fake = FakeDriveService(); fake.add_file('a.mp3', b'audio-a')
+    cache = make_cache(fake, tmp_path)
+    b_id = fake.add_file('b.mp3', b'audio-b'); fake.remove_file('a.mp3')
+    fake.add_file('elsewhere.mp3', b'x', parents=['other-folder'])
+    assert cache.refresh()
+    assert cache.file_cache == {'b.mp3': b_id}
+    assert fake.calls['files.list'] == 1  # обновление идёт через changes API, без повторного листинга
+    assert b''.join(cache.iter_download('b.mp3')) == b'audio-b'
+
+
+def test_snapshot_shared_between_instances(tmp_path):
+    fake = FakeDriveService(); a_id = fake.add_file('a.mp3', b'audio-a')
+    make_cache(fake, tmp_path)
+    c_id = fake.add_file('c.mp3', b'audio-c')
+    other = make_cache(fake, tmp_path)  # как другой worker: берёт снимок и догоняет его изменениями
+    assert other.file_cache == {'a.mp3': a_id, 'c.mp3': c_id}
+    assert fake.calls['files.list'] == 1
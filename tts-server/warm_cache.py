@@ -0,0 +1,71 @@
+# Файл: warm_cache.py
+# Прогрев локального кэша аудио перед деплоем: докачивает из Google Drive все файлы,
+# нужные словарям, и печатает отчёт о покрытии.
+#
+# Использование:
+#   python warm_cache.py                       # все словари
+#   python warm_cache.py --vocab A1-standard-course --workers 16
+#   python warm_cache.py --dry-run --json      # только отчёт, без загрузок
+#   python warm_cache.py --generate-missing    # плюс сгенерировать то, чего нет нигде (долго: лимит gTTS)
+#   python warm_cache.py --bundles             # плюс собрать аудио карточек (/synthesize_bundle) из готовых частей
+#   python warm_cache.py --duplicates          # только отчёт о текстах, повторяющихся в словарях
+
+import argparse
+import json
+import os
+import sys
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))  # пути в Config относительны каталогу сервера
+
+from server import build_duplicate_report, cache_warmer, sequence_bundler, tts_system, vocabulary_registry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Warm up the local TTS audio cache from Google Drive")
+    parser.add_argument('--vocab', action='append', dest='vocabs', help="vocabulary name (can be repeated); default: all")
+    parser.add_argument('--workers', type=int, default=cache_warmer.max_workers, help="parallel Google Drive downloads")
+    parser.add_argument('--dry-run', action='store_true', help="only report coverage, do not download")
+    parser.add_argument('--generate-missing', action='store_true', help="generate files missing everywhere (low-priority queue) and wait for them")
+    parser.add_argument('--bundles', action='store_true', help="prebuild per-word sequence bundles after warming")
+    parser.add_argument('--bundle-parts', help="comma-separated part order for bundles (default: BUNDLE_DEFAULT_PARTS)")
+    parser.add_argument('--bundle-gap-ms', type=int, help="silence between bundle parts (default: BUNDLE_GAP_MS)")
+    parser.add_argument('--duplicates', action='store_true', help="only report texts voiced by the same audio file in several places")
+    parser.add_argument('--json', action='store_true', help="print the full report as JSON")
+    args = parser.parse_args()
+
+    if args.duplicates:
+        report = build_duplicate_report(vocabulary_registry, args.vocabs, limit=None if args.json else 20)
+        if args.json: print(json.dumps(report, ensure_ascii=False, indent=2)); return 0
+        print(f"{report['items']} items -> {report['audio_files']} audio files: {report['duplicate_files']} shared by {report['duplicate_items'] + report['duplicate_files']} items, "
+              f"{report['cross_vocabulary']} across vocabularies, {report['variants']} with text variants")
+        for name, c in report["vocabularies"].items():
+            if "error" not in c: print(f"  {name:<28} {c['items']:>6} items, {c['shared_with_other_vocabularies']:>5} shared with other vocabularies")
+        for d in report["duplicates"]:
+            print(f"  {d['count']:>3}x {d['file']} {d['occurrences'][0]['text']!r} in {', '.join(d['vocabularies'])}")
+        return 0
+
+    cache_warmer.max_workers = args.workers
+    report = cache_warmer.run(args.vocabs, download=not args.dry_run, generate=args.generate_missing and not args.dry_run)
+    if cache_warmer.generation_jobs:
+        print(f"Waiting for {len(cache_warmer.generation_jobs)} generation jobs...", file=sys.stderr)
+        for job in cache_warmer.generation_jobs:
+            while not tts_system.generation_queue.wait(job, 60): pass
+        report["generated"] = sum(1 for job in cache_warmer.generation_jobs if job.status == 'done')
+    if args.bundles and not args.dry_run:
+        report["bundles"] = sequence_bundler.prebuild(args.vocabs, args.bundle_parts.split(',') if args.bundle_parts else None, args.bundle_gap_ms)
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print(f"{'vocabulary':<28} {'files':>6} {'local':>6} {'restored':>8} {'drive':>6} {'missing':>7} {'local %':>8}")
+        for name, c in report["vocabularies"].items():
+            if "error" in c: print(f"{name:<28} {c['error']}"); continue
+            print(f"{name:<28} {c['audio_files']:>6} {c['local']:>6} {c['restored']:>8} {c['drive_only']:>6} {c['missing']:>7} {c['local_percent']:>8}")
+        if "generated" in report: print(f"generated: {report['generated']} of {report['queued_for_generation']}")
+        for name, c in report.get("bundles", {}).get("vocabularies", {}).items():
+            if "error" not in c: print(f"bundles {name}: {c['built']} built, {c['existing']} existing, {c['incomplete']} incomplete of {c['words']}")
+    return 1 if any(c.get("missing") or c.get("drive_only") or "error" in c for c in report["vocabularies"].values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())